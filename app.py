@@ -22,10 +22,14 @@ import gradio as gr
 
 from audiocraft.data.audio_utils import convert_audio
 from audiocraft.data.audio import audio_write
-from audiocraft.models import MusicGen
+from audiocraft.models import ModelRegistry
 
 
 MODEL = None  # Last used model
+# Models stay resident once loaded, so switching back and forth between them is free.
+MEMORY_BUDGET_GB = os.environ.get('MUSICGEN_MEMORY_BUDGET_GB')
+REGISTRY = ModelRegistry(
+    memory_budget=int(float(MEMORY_BUDGET_GB) * 2**30) if MEMORY_BUDGET_GB else None)
 IS_BATCHED = "facebook/MusicGen" in os.environ.get('SPACE_ID', '')
 MAX_BATCH_SIZE = 12
 BATCHED_DURATION = 15
@@ -89,7 +93,7 @@ def load_model(version='melody'):
     global MODEL
     print("Loading model", version)
     if MODEL is None or MODEL.name != version:
-        MODEL = MusicGen.get_pretrained(version)
+        MODEL = REGISTRY.get(version)
 
 
 def _do_predictions(texts, melodies, duration, progress=False, **gen_kwargs):
@@ -23,6 +23,7 @@ import torchaudio as ta
 import av
 
 from .audio_utils import f32_pcm, i16_pcm, normalize_audio
+from ..utils import metrics
 
 
 _av_initialized = False
@@ -187,9 +188,10 @@ def audio_write(stem_name: tp.Union[str, Path],
     elif wav.dim() > 2:
         raise ValueError("Input wav should be at most 2 dimension.")
     assert wav.isfinite().all()
-    wav = normalize_audio(wav, normalize, strategy, peak_clip_headroom_db,
-                          rms_headroom_db, loudness_headroom_db, log_clipping=log_clipping,
-                          sample_rate=sample_rate, stem_name=str(stem_name))
+    with metrics.stage('audio_normalize'):
+        wav = normalize_audio(wav, normalize, strategy, peak_clip_headroom_db,
+                              rms_headroom_db, loudness_headroom_db, log_clipping=log_clipping,
+                              sample_rate=sample_rate, stem_name=str(stem_name))
     kwargs: dict = {}
     if format == 'mp3':
         suffix = '.mp3'
@@ -206,7 +208,8 @@ def audio_write(stem_name: tp.Union[str, Path],
     if make_parent_dir:
         path.parent.mkdir(exist_ok=True, parents=True)
     try:
-        ta.save(path, wav, sample_rate, **kwargs)
+        with metrics.stage('audio_write'):
+            ta.save(path, wav, sample_rate, **kwargs)
     except Exception:
         if path.exists():
             # we do not want to leave half written files around.
@@ -8,3 +8,4 @@
 from .musicgen import MusicGen
 from .lm import LMModel
 from .encodec import CompressionModel, EncodecModel
+from .registry import ModelRegistry
@@ -0,0 +1,269 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Cross-request batching in front of `MusicGen.generate`.
+
+Generating a single sample only uses a batch of 2 (conditional and unconditional
+for classifier free guidance), which leaves most of the matmul throughput unused.
+`BatchingScheduler` collects the requests arriving within a short window, buckets them
+by model, duration and generation parameters, and runs each bucket as a single batched
+generation, handing back to each caller its own slice of the output. The parameters that MusicGen
+accepts per sample (temperature, top-k, top-p, CFG coefficient and seed) do not split the buckets. Requests can also
+receive their audio by chunks while it is being generated, see `MusicGen.generate_stream`.
+"""
+
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import threading
+import time
+import typing as tp
+
+import torch
+
+from .musicgen import MusicGen, PER_SAMPLE_PARAMS
+from ..utils import metrics
+
+
+logger = logging.getLogger(__name__)
+# model, duration, chunk duration if streaming, shared parameters and names of the per sample ones.
+BucketKey = tp.Tuple[str, float, tp.Optional[float], tp.Tuple[tp.Tuple[str, tp.Any], ...], tp.Tuple[str, ...]]
+
+
+ProgressCallback = tp.Callable[[int, int], None]
+StreamCallback = tp.Callable[[torch.Tensor], None]
+
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'audiocraft_queue_depth', "Number of generation requests waiting to be batched.")
+QUEUE_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'audiocraft_queue_wait_seconds', "Time spent by the requests waiting to be batched.")
+BATCH_SIZE = metrics.REGISTRY.histogram(
+    'audiocraft_batch_size', "Number of requests in each batched generation.",
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+GENERATED_TOKENS = metrics.REGISTRY.counter(
+    'audiocraft_generated_tokens', "Number of generation steps times the batch size, "
+    "each step generating one token per codebook.")
+TOKENS_PER_SECOND = metrics.REGISTRY.gauge(
+    'audiocraft_tokens_per_second', "Decoding throughput of the last batched generation, "
+    "in generation steps times the batch size per second.")
+
+
+@dataclass
+class GenerationRequest:
+    description: str
+    future: Future
+    progress_callback: tp.Optional[ProgressCallback] = None
+    stream_callback: tp.Optional[StreamCallback] = None
+    params: tp.Dict[str, tp.Any] = field(default_factory=dict)
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class BatchingScheduler:
+    """Scheduler grouping concurrent generation requests into batched generations.
+
+    A bucket is flushed either when its oldest request has waited for `window` seconds,
+    or as soon as it holds `max_batch_size` requests. Generations run one after the other
+    on a dedicated worker thread, which is also the only one touching the generation
+    parameters of the models.
+
+    Args:
+        get_model (callable): Function returning the MusicGen model for a given name,
+            typically `ModelRegistry.get`.
+        window (float): Maximum time in seconds a request waits for other requests to batch with.
+        max_batch_size (int): Maximum number of requests in a single generation.
+        stats_history (int): Number of recent queue waiting times kept for the statistics.
+    """
+    def __init__(self, get_model: tp.Callable[[str], MusicGen], window: float = 0.05,
+                 max_batch_size: int = 8, stats_history: int = 1000):
+        assert window >= 0
+        assert max_batch_size > 0
+        self.get_model = get_model
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._buckets: tp.Dict[BucketKey, tp.List[GenerationRequest]] = {}
+        self._cond = threading.Condition()
+        self._num_pending = 0
+        self._closed = False
+        self.batch_sizes: tp.Counter[int] = Counter()
+        self.queue_waits: tp.Deque[float] = deque(maxlen=stats_history)
+        self._worker = threading.Thread(target=self._run, name='batching-scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, description: str, model: str, duration: float,
+               progress_callback: tp.Optional[ProgressCallback] = None, seed: tp.Optional[int] = None,
+               stream_callback: tp.Optional[StreamCallback] = None, chunk_duration: float = 1.,
+               **params) -> Future:
+        """Queue a generation and return a future on the generated audio, of shape [C, T].
+
+        Args:
+            description (str): Text conditioning.
+            model (str): Name of the model to use.
+            duration (float): Duration of the generated audio in seconds.
+            progress_callback (callable, optional): Called from the worker thread with the number
+                of generated and total steps, see `MusicGen.set_custom_progress_callback`.
+            seed (int, optional): If given, the request is sampled with its own random number generator
+                seeded with it, and the padding of the shorter descriptions is masked, see
+                `MusicGen.set_generation_params`, so that its output does not depend on the other requests
+                in the same batch.
+            stream_callback (callable, optional): If given, called from the worker thread with each
+                chunk of audio, of shape [C, T'], as soon as it is generated. The future still
+                resolves to the whole audio once the generation is over.
+            chunk_duration (float): Duration in seconds of the streamed chunks.
+            **params: Other generation parameters, see `MusicGen.set_generation_params`. Requests
+                with different values for the parameters in `PER_SAMPLE_PARAMS` can still be batched.
+        """
+        future: Future = Future()
+        stream = float(chunk_duration) if stream_callback is not None else None
+        per_sample = {name: value for name, value in params.items() if name in PER_SAMPLE_PARAMS}
+        if seed is not None:
+            per_sample['seed'] = seed
+        shared = tuple(sorted((name, value) for name, value in params.items() if name not in per_sample))
+        key = (model, float(duration), stream, shared, tuple(sorted(per_sample)))
+        request = GenerationRequest(description, future, progress_callback, stream_callback, per_sample)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Cannot submit to a closed scheduler.")
+            self._buckets.setdefault(key, []).append(request)
+            self._num_pending += 1
+            QUEUE_DEPTH.set(self._num_pending)
+            self._cond.notify()
+        return future
+
+    def close(self, wait: bool = True):
+        """Stop accepting requests. Pending requests are still processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if wait:
+            self._worker.join()
+
+    def _oldest_bucket(self) -> BucketKey:
+        # Should be called with `self._cond` held and at least one bucket pending.
+        return min(self._buckets, key=lambda key: self._buckets[key][0].enqueued_at)
+
+    def _next_batch(self) -> tp.Optional[tp.Tuple[BucketKey, tp.List[GenerationRequest]]]:
+        # Should be called with `self._cond` held. Returns None if nothing is ready yet.
+        ready = None
+        for key, requests in self._buckets.items():
+            if len(requests) >= self.max_batch_size:
+                ready = key
+                break
+        if ready is None:
+            key = self._oldest_bucket()
+            if self._closed or time.monotonic() - self._buckets[key][0].enqueued_at >= self.window:
+                ready = key
+        if ready is None:
+            return None
+        requests = self._buckets.pop(ready)
+        batch, remaining = requests[:self.max_batch_size], requests[self.max_batch_size:]
+        if remaining:
+            self._buckets[ready] = remaining
+        self._num_pending -= len(batch)
+        QUEUE_DEPTH.set(self._num_pending)
+        return ready, batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._buckets:
+                        if self._closed:
+                            return
+                        self._cond.wait()
+                        continue
+                    next_batch = self._next_batch()
+                    if next_batch is not None:
+                        break
+                    oldest = self._buckets[self._oldest_bucket()][0]
+                    self._cond.wait(max(0., oldest.enqueued_at + self.window - time.monotonic()))
+            self._process(*next_batch)
+
+    def _process(self, key: BucketKey, batch: tp.List[GenerationRequest]):
+        name, duration, chunk_duration, shared, per_sample = key
+        # generation parameters are given for this generation only, the model state is left untouched.
+        params = dict(shared, duration=duration)
+        params.update({param: [request.params[param] for request in batch] for param in per_sample})
+        if 'seed' in per_sample:
+            params.setdefault('mask_condition_padding', True)
+        start = time.monotonic()
+        waits = [start - request.enqueued_at for request in batch]
+        self.batch_sizes[len(batch)] += 1
+        self.queue_waits.extend(waits)
+        BATCH_SIZE.observe(len(batch))
+        for wait in waits:
+            QUEUE_WAIT_SECONDS.observe(wait)
+        logger.info("Generating batch of %d with %s, waited %.3fs max in queue", len(batch), name, max(waits))
+        callbacks = [request.progress_callback for request in batch if request.progress_callback is not None]
+        # the progress callback is called once per generation step, we keep the number of steps
+        # and the time of the first and last ones to measure the decoding throughput.
+        num_steps = 0
+        first_step_time = last_step_time = 0.
+
+        def _progress_callback(generated_tokens: int, tokens_to_generate: int):
+            nonlocal num_steps, first_step_time, last_step_time
+            last_step_time = time.perf_counter()
+            if not num_steps:
+                first_step_time = last_step_time
+            num_steps += 1
+            GENERATED_TOKENS.inc(len(batch))
+            for callback in callbacks:
+                callback(generated_tokens, tokens_to_generate)
+
+        try:
+            model = self.get_model(name)
+            model.set_custom_progress_callback(_progress_callback)
+            try:
+                descriptions = [request.description for request in batch]
+                if chunk_duration is None:
+                    outputs = model.generate(descriptions, progress=True, **params)
+                else:
+                    outputs = self._generate_stream(model, descriptions, batch, chunk_duration, params)
+            finally:
+                model.set_custom_progress_callback(None)
+        except Exception as exc:
+            for request in batch:
+                request.future.set_exception(exc)
+            return
+        if last_step_time > first_step_time:
+            TOKENS_PER_SECOND.set((num_steps - 1) * len(batch) / (last_step_time - first_step_time))
+        outputs = outputs.detach()
+        for request, output in zip(batch, outputs):
+            request.future.set_result(output)
+        logger.debug("Batch of %d generated in %.3fs", len(batch), time.monotonic() - start)
+
+    def _generate_stream(self, model: MusicGen, descriptions: tp.List[str], batch: tp.List[GenerationRequest],
+                         chunk_duration: float, params: tp.Dict[str, tp.Any]) -> torch.Tensor:
+        chunks = []
+        for chunk in model.generate_stream(descriptions, progress=True, chunk_duration=chunk_duration, **params):
+            chunks.append(chunk)
+            for request, request_chunk in zip(batch, chunk.detach()):
+                assert request.stream_callback is not None
+                request.stream_callback(request_chunk)
+        return torch.cat(chunks, dim=-1)
+
+    def stats(self) -> tp.Dict[str, tp.Any]:
+        """Batch sizes formed so far and queue waiting times over the recent requests,
+        to tune `window` and `max_batch_size` between throughput and latency.
+        """
+        num_batches = sum(self.batch_sizes.values())
+        num_requests = sum(size * count for size, count in self.batch_sizes.items())
+        waits = torch.tensor(list(self.queue_waits), dtype=torch.float64)
+        stats: tp.Dict[str, tp.Any] = {
+            'num_batches': num_batches,
+            'num_requests': num_requests,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'mean_batch_size': num_requests / num_batches if num_batches else 0.,
+        }
+        if len(waits):
+            stats.update({
+                'queue_wait_mean': waits.mean().item(),
+                'queue_wait_p50': waits.quantile(0.5).item(),
+                'queue_wait_p99': waits.quantile(0.99).item(),
+                'queue_wait_max': waits.max().item(),
+            })
+        return stats
@@ -0,0 +1,248 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Continuous batching for the LM: sequences join and leave the batch between decoding steps.
+
+With `LMModel.generate`, a batch runs from the first step to `max_gen_len`, new requests
+wait for the whole batch to finish, and short requests keep using compute until the longest
+one is done. `ContinuousBatchingEngine` instead keeps a fixed number of slots, each holding
+one sequence at its own pattern step, with its own keys and values in the transformer
+(see `StreamingTransformer.init_slots`). Queued sequences are prefilled into the free
+slots between decoding steps, and finished ones are returned right away.
+"""
+
+from collections import deque
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+import time
+import typing as tp
+
+import torch
+
+from .lm import LMModel
+from ..modules.conditioners import ConditioningAttributes
+from ..utils import metrics
+from ..utils.sampling import resolve_top_k, sample_next_token
+
+
+UNKNOWN_TOKEN = -1
+
+
+@dataclass
+class GenerationRow:
+    """A sequence generated by a `ContinuousBatchingEngine`.
+
+    Args:
+        conditions (ConditioningAttributes): Conditioning of the sequence.
+        max_gen_len (int): Number of timesteps to generate, including the prompt.
+        prompt (torch.Tensor, optional): Prompt tokens of shape [K, T].
+    """
+    conditions: ConditioningAttributes
+    max_gen_len: int
+    prompt: tp.Optional[torch.Tensor] = None
+    # set by the engine: slot of the sequence once admitted, and tokens of shape [K, max_gen_len] once done.
+    slot: tp.Optional[int] = None
+    tokens: tp.Optional[torch.Tensor] = None
+    added_at: float = field(default_factory=time.monotonic)
+    admitted_at: tp.Optional[float] = None
+    finished_at: tp.Optional[float] = None
+
+
+class ContinuousBatchingEngine:
+    """Generation engine admitting and retiring sequences between decoding steps.
+
+    The engine keeps the LM in streaming mode with `max_batch_size` slots (twice as many rows with CFG),
+    it should be used as a context manager, and the LM should not be used for anything else meanwhile.
+    As with `LMModel.generate`, the conditions of the sequences in the batch are padded
+    to the longest one. Sampling parameters are shared by all the sequences.
+
+    Args:
+        lm (LMModel): Language model, using the custom attention.
+        max_batch_size (int): Number of slots, i.e. of sequences generated together.
+        max_gen_len (int): Maximum number of timesteps of a sequence.
+        use_sampling, temp, top_k, top_p, cfg_coef: See `LMModel.generate`.
+    """
+    def __init__(self, lm: LMModel, max_batch_size: int = 8, max_gen_len: int = 1500,
+                 use_sampling: bool = True, temp: float = 1.0, top_k: int = 250, top_p: float = 0.0,
+                 cfg_coef: tp.Optional[float] = None):
+        assert not lm.training, "generation shouldn't be used in training mode."
+        assert not lm.two_step_cfg, "Two step CFG is not supported with continuous batching."
+        assert not lm.fuser.fuse2cond['prepend'], "Prepend conditions are not supported with continuous batching."
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.max_gen_len = max_gen_len
+        self.use_sampling = use_sampling
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.cfg_coef = cfg_coef
+        self.device = next(iter(lm.parameters())).device
+        self.pending: tp.Deque[GenerationRow] = deque()
+        self.rows: tp.List[tp.Optional[GenerationRow]] = [None] * max_batch_size
+        pattern = lm.pattern_provider.get_pattern(max_gen_len)
+        self.capacity = self._build_sequence(pattern, max_gen_len, None)[0].shape[-1]
+        # pattern sequences of the slots, next step to generate and number of steps of each slot.
+        self._sequences = torch.full((max_batch_size, lm.num_codebooks, self.capacity), lm.special_token_id,
+                                     dtype=torch.long, device=self.device)
+        self._offsets = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self._lengths = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        # conditions of all the rows, conditional ones first then unconditional ones, as in `LMModel.generate`.
+        self._condition_tensors: tp.Dict[str, tp.Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._exit_stack: tp.Optional[ExitStack] = None
+
+    def __enter__(self):
+        assert self._exit_stack is None, "The engine is already running."
+        self._exit_stack = ExitStack()
+        self._exit_stack.enter_context(torch.no_grad())
+        self._exit_stack.enter_context(self.lm.streaming())
+        rows = 2 * self.max_batch_size
+        self.lm.transformer.init_slots(rows, self.capacity)
+        # the fuser only uses its offsets to detect the first step.
+        self.lm.fuser._streaming_state['offsets'] = torch.zeros(rows, dtype=torch.long, device=self.device)
+        return self
+
+    def __exit__(self, *exc):
+        assert self._exit_stack is not None
+        self._exit_stack.close()
+        self._exit_stack = None
+        self._condition_tensors = {}
+
+    def add(self, conditions: ConditioningAttributes, max_gen_len: int,
+            prompt: tp.Optional[torch.Tensor] = None) -> GenerationRow:
+        """Queue a sequence, admitted at the next `step` with a free slot."""
+        assert max_gen_len <= self.max_gen_len, f"At most {self.max_gen_len} timesteps can be generated."
+        assert prompt is None or prompt.shape[-1] < max_gen_len
+        row = GenerationRow(conditions, max_gen_len, prompt)
+        self.pending.append(row)
+        return row
+
+    @property
+    def num_active(self) -> int:
+        return sum(row is not None for row in self.rows)
+
+    @property
+    def is_idle(self) -> bool:
+        return not self.pending and not self.num_active
+
+    def _build_sequence(self, pattern, max_gen_len: int, prompt: tp.Optional[torch.Tensor]):
+        K = self.lm.num_codebooks
+        gen_codes = torch.full((1, K, max_gen_len), UNKNOWN_TOKEN, dtype=torch.long, device=self.device)
+        start_offset = 0
+        if prompt is not None:
+            start_offset = prompt.shape[-1]
+            gen_codes[0, :, :start_offset] = prompt
+        gen_sequence, _, _ = pattern.build_pattern_sequence(gen_codes, self.lm.special_token_id)
+        start_offset_sequence = pattern.get_first_step_with_timesteps(start_offset)
+        assert start_offset_sequence is not None and start_offset_sequence > 0
+        return gen_sequence[0], start_offset_sequence
+
+    def _set_conditions(self, slot: int, condition_tensors: tp.Dict[str, tp.Tuple[torch.Tensor, torch.Tensor]]):
+        # Write the conditional and unconditional conditions of a sequence in its rows.
+        rows = torch.tensor([slot, self.max_batch_size + slot], device=self.device)
+        for name, (embeds, mask) in condition_tensors.items():
+            if name not in self._condition_tensors:
+                num_rows = 2 * self.max_batch_size
+                self._condition_tensors[name] = (embeds.new_zeros(num_rows, 0, embeds.shape[-1]),
+                                                 mask.new_zeros(num_rows, 0))
+            all_embeds, all_mask = self._condition_tensors[name]
+            length = max(all_embeds.shape[1], embeds.shape[1])
+            all_embeds = torch.nn.functional.pad(all_embeds, (0, 0, 0, length - all_embeds.shape[1]))
+            all_mask = torch.nn.functional.pad(all_mask, (0, length - all_mask.shape[1]))
+            all_embeds[rows] = torch.nn.functional.pad(embeds, (0, 0, 0, length - embeds.shape[1]))
+            all_mask[rows] = torch.nn.functional.pad(mask, (0, length - mask.shape[1]))
+            self._condition_tensors[name] = (all_embeds, all_mask)
+        # the cross attention keys and values are cached for the previous conditions.
+        self.lm.transformer.clear_cross_attention_cache()
+
+    def _admit(self, row: GenerationRow, slot: int):
+        lm = self.lm
+        pattern = lm.pattern_provider.get_pattern(row.max_gen_len)
+        gen_sequence, start_offset_sequence = self._build_sequence(pattern, row.max_gen_len, row.prompt)
+        self._sequences[slot] = lm.special_token_id
+        self._sequences[slot, :, :gen_sequence.shape[-1]] = gen_sequence
+        self._offsets[slot] = start_offset_sequence
+        self._lengths[slot] = gen_sequence.shape[-1]
+        cfg_conditions = lm._get_cfg_conditions([row.conditions], two_step_cfg=False)
+        assert isinstance(cfg_conditions, dict)
+        self._set_conditions(slot, cfg_conditions)
+        rows = torch.tensor([slot, self.max_batch_size + slot], device=self.device)
+        # the decoding steps feed the last known step, the steps before it are prefilled.
+        prefix = gen_sequence[None, :, :start_offset_sequence - 1]
+        if prefix.shape[-1] == 0:
+            lm.transformer.reset_slots(rows)
+        else:
+            with metrics.stage('lm_prefill'):
+                slots_state = lm.get_streaming_state()
+                lm.set_streaming_state({})
+                condition_tensors = {name: (embeds[rows], mask[rows])
+                                     for name, (embeds, mask) in self._condition_tensors.items()}
+                lm._get_cfg_logits(prefix, condition_tensors, {}, self.cfg_coef)
+                prefill_state = lm.transformer.get_streaming_state()
+                lm.set_streaming_state(slots_state)
+                lm.transformer.fill_slots(rows, prefill_state)
+                lm.transformer.clear_cross_attention_cache()
+        row.slot = slot
+        row.admitted_at = time.monotonic()
+        self.rows[slot] = row
+
+    def _retire(self, slot: int) -> GenerationRow:
+        row = self.rows[slot]
+        assert row is not None
+        pattern = self.lm.pattern_provider.get_pattern(row.max_gen_len)
+        length = int(self._lengths[slot])
+        codes, _, _ = pattern.revert_pattern_sequence(self._sequences[slot:slot + 1, :, :length].contiguous(),
+                                                      special_token=UNKNOWN_TOKEN)
+        assert (codes >= 0).all() and (codes < self.lm.card).all()
+        row.tokens = codes[0]
+        row.finished_at = time.monotonic()
+        self.rows[slot] = None
+        return row
+
+    def step(self) -> tp.List[GenerationRow]:
+        """Admit queued sequences into the free slots, then run one decoding step
+        for all the slots, returning the sequences completed by this step.
+        """
+        assert self._exit_stack is not None, "The engine should be used as a context manager."
+        for slot, row in enumerate(self.rows):
+            if row is None and self.pending:
+                self._admit(self.pending.popleft(), slot)
+        if not self.num_active:
+            return []
+
+        step_begin = time.perf_counter()
+        B, K = self._sequences.shape[:2]
+        free = [slot for slot, row in enumerate(self.rows) if row is None]
+        if free:
+            # free slots still run, they are restarted so that they never run out of capacity.
+            self.lm.transformer.reset_slots(torch.tensor(free + [B + slot for slot in free], device=self.device))
+        active = torch.tensor([row is not None for row in self.rows], device=self.device)
+        offsets = torch.where(active, self._offsets, torch.ones_like(self._offsets))
+        # each slot feeds its last known step and predicts the next one.
+        inputs = self._sequences.gather(2, (offsets - 1).view(B, 1, 1).expand(B, K, 1))
+        logits = self.lm._get_cfg_logits(inputs, self._condition_tensors, {}, self.cfg_coef)[:, :, -1]
+        if self.use_sampling and self.temp > 0.0:
+            next_token = sample_next_token(logits, temp=self.temp, top_k=resolve_top_k(self.top_k, self.top_p),
+                                           top_p=self.top_p)
+        else:
+            next_token = logits.argmax(dim=-1, keepdim=True)
+        # only the unknown tokens are written, special tokens and prompt tokens are kept.
+        index = offsets.view(B, 1, 1).expand(B, K, 1)
+        current = self._sequences.gather(2, index)
+        write = (current == UNKNOWN_TOKEN) & active.view(B, 1, 1)
+        self._sequences.scatter_(2, index, torch.where(write, next_token, current))
+        self._offsets = self._offsets + active.long()
+        done = (active & (self._offsets >= self._lengths)).nonzero()[:, 0].tolist()
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - step_begin, stage='lm_step')
+        return [self._retire(slot) for slot in done]
+
+    def generate(self, rows: tp.List[GenerationRow]) -> tp.List[GenerationRow]:
+        """Run until the given sequences, already added, are all complete."""
+        remaining = set(map(id, rows))
+        while remaining:
+            for row in self.step():
+                remaining.discard(id(row))
+        return rows
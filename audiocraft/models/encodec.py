@@ -5,6 +5,8 @@
 # LICENSE file in the root directory of this source tree.
 
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import typing as tp
 
 from einops import rearrange
@@ -12,24 +14,119 @@ import torch
 from torch import nn
 
 from .. import quantization as qt
+from ..modules.streaming import StreamingModule
 
 
-class CompressionModel(ABC, nn.Module):
+class CompressionModel(ABC, StreamingModule):
 
     @abstractmethod
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
         ...
 
     @abstractmethod
-    def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+    def encode(self, x: torch.Tensor,
+               lengths: tp.Optional[torch.Tensor] = None) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         """See `EncodecModel.encode`"""
         ...
 
+    def encode_batch(self,
+                     wavs: tp.Sequence[torch.Tensor]) -> tp.Tuple[tp.List[torch.Tensor], tp.Optional[torch.Tensor]]:
+        """Encode waveforms of different lengths in a single pass. They are padded with zeros
+        at the end to the longest one and masked past their length, see `SEANetEncoder.forward`,
+        and the codes of each one are trimmed to its own number of frames, `ceil(T * frame_rate / sample_rate)`.
+        With a constant padding in the encoder, these match the codes of encoding each waveform alone.
+
+        Args:
+            wavs (tp.Sequence[torch.Tensor]): Float tensors of shape [C, T], one per item.
+        Returns:
+            codes, scale (tp.Tuple[tp.List[torch.Tensor], tp.Optional[torch.Tensor]]): Tuple composed of:
+                codes a list of int tensors of shape [K, T'], one per item.
+                scale a float tensor containing the scale of each item for audio renormalization.
+        """
+        assert len(wavs) > 0
+        lengths = [wav.shape[-1] for wav in wavs]
+        x = wavs[0].new_zeros(len(wavs), wavs[0].shape[0], max(lengths))
+        for item, wav in zip(x, wavs):
+            item[..., :wav.shape[-1]] = wav
+        codes, scale = self.encode(x, torch.tensor(lengths, device=x.device))
+        frames = [-(-length * self.frame_rate // self.sample_rate) for length in lengths]
+        return [item[..., :num_frames] for item, num_frames in zip(codes, frames)], scale
+
     @abstractmethod
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         """See `EncodecModel.decode`"""
         ...
 
+    def decode_chunked(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None,
+                       chunk_length: int = 1500, overlap: int = 50, num_workers: int = 0) -> torch.Tensor:
+        """Decode the given codes by chunks of `chunk_length` frames, overlapping by `overlap` frames,
+        so that the memory used by the intermediate activations of the decoder does not grow with
+        the length of the codes. The outputs of consecutive chunks are crossfaded linearly over their
+        overlap, which hides the padding at the edges of each chunk as long as the overlap covers
+        the receptive field of the decoder.
+
+        Args:
+            codes (torch.Tensor): Int tensor of shape [B, K, T].
+            scale (tp.Optional[torch.Tensor]): Float tensor containing the scale value.
+            chunk_length (int): Number of frames decoded at once.
+            overlap (int): Number of frames shared by consecutive chunks.
+            num_workers (int): If more than 1, decode that many chunks in parallel threads, only on CPU.
+                The memory then grows with the number of workers.
+        Returns:
+            out (torch.Tensor): Float tensor of shape [B, C, T], the reconstructed audio,
+                matching the output of `decode` up to the crossfades.
+        """
+        assert not self._is_streaming, "Chunked decoding is not supported in streaming mode."
+        assert 0 <= overlap < chunk_length
+        assert num_workers <= 1 or codes.device.type == 'cpu', "Parallel decoding is only supported on CPU."
+        T = codes.shape[-1]
+        if T <= chunk_length:
+            return self.decode(codes, scale)
+        stride = chunk_length - overlap
+        starts = range(0, T - overlap, stride)
+        out: tp.Optional[torch.Tensor] = None
+        # grad mode is local to each thread.
+        grad_enabled = torch.is_grad_enabled()
+
+        def _decode(start: int) -> torch.Tensor:
+            with torch.set_grad_enabled(grad_enabled):
+                return self.decode(codes[..., start:start + chunk_length], scale)
+
+        def _write(start: int, chunk: torch.Tensor):
+            nonlocal out
+            if out is None:
+                out = chunk.new_empty(*chunk.shape[:-1], T * chunk.shape[-1] // chunk_length)
+            hop_length = out.shape[-1] // T
+            _write_crossfaded(out, chunk, start * hop_length, overlap * hop_length if start else 0)
+
+        if num_workers <= 1:
+            for start in starts:
+                _write(start, _decode(start))
+        else:
+            with ThreadPoolExecutor(num_workers) as executor:
+                # at most `num_workers` chunks are decoded or waiting to be written at the same time.
+                pending: tp.Deque[tp.Tuple[int, Future]] = deque()
+                for start in starts:
+                    pending.append((start, executor.submit(_decode, start)))
+                    if len(pending) == num_workers:
+                        done, future = pending.popleft()
+                        _write(done, future.result())
+                while pending:
+                    done, future = pending.popleft()
+                    _write(done, future.result())
+        assert out is not None
+        return out
+
+    @abstractmethod
+    def flush_encoder(self) -> torch.Tensor:
+        """See `EncodecModel.flush_encoder`"""
+        ...
+
+    @abstractmethod
+    def flush_decoder(self, scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        """See `EncodecModel.flush_decoder`"""
+        ...
+
     @property
     @abstractmethod
     def channels(self) -> int:
@@ -67,6 +164,17 @@ class CompressionModel(ABC, nn.Module):
         ...
 
 
+def _write_crossfaded(out: torch.Tensor, chunk: torch.Tensor, offset: int, fade: int):
+    """Write `chunk` in `out` at `offset`, crossfading linearly its first `fade` samples
+    with the ones already there.
+    """
+    if fade:
+        ramp = (torch.arange(fade, device=chunk.device, dtype=chunk.dtype) + 0.5) / fade
+        out[..., offset:offset + fade] *= 1 - ramp
+        out[..., offset:offset + fade] += ramp * chunk[..., :fade]
+    out[..., offset + fade:offset + chunk.shape[-1]] = chunk[..., fade:]
+
+
 class EncodecModel(CompressionModel):
     """Encodec model operating on the raw waveform.
 
@@ -132,11 +240,18 @@ class EncodecModel(CompressionModel):
         """
         return self.quantizer.bins
 
-    def preprocess(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+    def preprocess(self, x: torch.Tensor,
+                   lengths: tp.Optional[torch.Tensor] = None) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         scale: tp.Optional[torch.Tensor]
         if self.renormalize:
             mono = x.mean(dim=1, keepdim=True)
-            volume = mono.pow(2).mean(dim=2, keepdim=True).sqrt()
+            if lengths is None:
+                volume = mono.pow(2).mean(dim=2, keepdim=True).sqrt()
+            else:
+                # the padding of each item is left out of its volume.
+                mask = torch.arange(x.shape[-1], device=x.device) < lengths[:, None, None]
+                energy = (mono.pow(2) * mask).sum(dim=2, keepdim=True)
+                volume = (energy / lengths.clamp(min=1).view(-1, 1, 1)).sqrt()
             scale = 1e-8 + volume
             x = x / scale
             scale = scale.view(-1, 1)
@@ -169,11 +284,19 @@ class EncodecModel(CompressionModel):
 
         return q_res
 
-    def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+    def encode(self, x: torch.Tensor,
+               lengths: tp.Optional[torch.Tensor] = None) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         """Encode the given input tensor to quantized representation along with scale parameter.
 
+        In streaming mode, see `StreamingModule.streaming`, the input can be given by chunks.
+        The codes of the frames whose whole receptive field has been given are returned for each chunk,
+        and the ones of the last frames with `flush_encoder`, the concatenation of all the codes
+        matching the encoding of the whole input. Renormalization is not supported in streaming mode.
+
         Args:
             x (torch.Tensor): Float tensor of shape [B, C, T]
+            lengths (tp.Optional[torch.Tensor]): Int tensor of shape [B], the number of samples of each item
+                if they are padded at the end, used to compute their scale, see `encode_batch`.
 
         Returns:
             codes, scale (tp.Tuple[torch.Tensor, torch.Tensor]): Tuple composed of:
@@ -181,15 +304,34 @@ class EncodecModel(CompressionModel):
                 scale a float tensor containing the scale for audio renormalizealization.
         """
         assert x.dim() == 3
-        x, scale = self.preprocess(x)
-        emb = self.encoder(x)
+        assert not (self._is_streaming and self.renormalize), "Renormalization doesn't support streaming."
+        x, scale = self.preprocess(x, lengths)
+        emb = self.encoder(x) if lengths is None else self.encoder(x, lengths)
         codes = self.quantizer.encode(emb)
         return codes, scale
 
+    def flush_encoder(self) -> torch.Tensor:
+        """Return the codes of the last frames in streaming mode, once the whole input has been given
+        to `encode`, and reset the state of the encoder for a new input.
+
+        Returns:
+            codes (torch.Tensor): Int tensor of shape [B, K, T].
+        """
+        assert self._is_streaming, "Only supported in streaming mode."
+        assert isinstance(self.encoder, StreamingModule), "The encoder does not support streaming."
+        emb = self.encoder.flush()
+        assert emb is not None, "Nothing to flush, `encode` was never called."
+        return self.quantizer.encode(emb)
+
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         """Decode the given codes to a reconstructed representation, using the scale to perform
         audio denormalization if needed.
 
+        In streaming mode, see `StreamingModule.streaming`, the codes can be given by chunks, e.g. one
+        frame at a time. The samples that do not depend on future frames are returned for each chunk,
+        and the last ones with `flush_decoder`, the concatenation of all the samples matching the decoding
+        of the whole codes, while the memory used only depends on the size of the chunks.
+
         Args:
             codes (torch.Tensor): Int tensor of shape [B, K, T]
             scale (tp.Optional[torch.Tensor]): Float tensor containing the scale value.
@@ -203,6 +345,22 @@ class EncodecModel(CompressionModel):
         # out contains extra padding added by the encoder and decoder
         return out
 
+    def flush_decoder(self, scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        """Return the last samples in streaming mode, once all the codes have been given to `decode`,
+        and reset the state of the decoder for new codes.
+
+        Args:
+            scale (tp.Optional[torch.Tensor]): Float tensor containing the scale value.
+
+        Returns:
+            out (torch.Tensor): Float tensor of shape [B, C, T], the reconstructed audio.
+        """
+        assert self._is_streaming, "Only supported in streaming mode."
+        assert isinstance(self.decoder, StreamingModule), "The decoder does not support streaming."
+        out = self.decoder.flush()
+        assert out is not None, "Nothing to flush, `decode` was never called."
+        return self.postprocess(out, scale)
+
 
 class FlattenedCompressionModel(CompressionModel):
     """Wraps a CompressionModel and flatten its codebooks, e.g.
@@ -282,21 +440,36 @@ class FlattenedCompressionModel(CompressionModel):
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
         raise NotImplementedError("Not supported, use encode and decode.")
 
-    def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
-        indices, scales = self.model.encode(x)
+    def encode(self, x: torch.Tensor,
+               lengths: tp.Optional[torch.Tensor] = None) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+        indices, scales = self.model.encode(x, lengths)
+        return (self._flatten(indices), scales)
+
+    def encode_batch(self,
+                     wavs: tp.Sequence[torch.Tensor]) -> tp.Tuple[tp.List[torch.Tensor], tp.Optional[torch.Tensor]]:
+        # trimmed at the frame rate of the wrapped model, before flattening.
+        codes, scales = self.model.encode_batch(wavs)
+        return [self._flatten(indices[None])[0] for indices in codes], scales
+
+    def _flatten(self, indices: torch.Tensor) -> torch.Tensor:
         B, K, T = indices.shape
         indices = rearrange(indices, 'b (k v) t -> b k t v', k=self.codebooks_per_step)
         if self.extend_cardinality:
             for virtual_step in range(1, self.num_virtual_steps):
                 indices[..., virtual_step] += self.model.cardinality * virtual_step
-        indices = rearrange(indices, 'b k t v -> b k (t v)')
-        return (indices, scales)
+        return rearrange(indices, 'b k t v -> b k (t v)')
 
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
-        B, K, T = codes.shape
+        T = codes.shape[-1]
         assert T % self.num_virtual_steps == 0
         codes = rearrange(codes, 'b k (t v) -> b (k v) t', v=self.num_virtual_steps)
         # We silently ignore potential errors from the LM when
         # using extend_cardinality.
         codes = codes % self.model.cardinality
         return self.model.decode(codes, scale)
+
+    def flush_encoder(self) -> torch.Tensor:
+        return self._flatten(self.model.flush_encoder())
+
+    def flush_decoder(self, scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        return self.model.flush_decoder(scale)
@@ -4,17 +4,22 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import partial
 import logging
 import math
+import time
 import typing as tp
 
 import torch
 from torch import nn
 
-from ..utils import utils
+from ..utils import metrics
+from ..utils.sampling import (
+    PerRow, get_sampling_probs, resolve_top_k, sample_from_probs, sample_next_token, speculative_sample)
 from ..modules.streaming import StreamingModule, State
+from ..modules.int8 import quantize_linears_
 from ..modules.transformer import StreamingTransformer, create_norm_fn
 from ..modules.conditioners import (
     ConditionFuser,
@@ -32,6 +37,13 @@ logger = logging.getLogger(__name__)
 ConditionTensors = tp.Dict[str, ConditionType]
 CFGConditions = tp.Union[ConditionTensors, tp.Tuple[ConditionTensors, ConditionTensors]]
 
+SPECULATIVE_DRAFT_STEPS = metrics.REGISTRY.counter(
+    'audiocraft_speculative_draft_steps', "Number of sequence steps proposed by draft models, "
+    "times the batch size.")
+SPECULATIVE_ACCEPTED_STEPS = metrics.REGISTRY.counter(
+    'audiocraft_speculative_accepted_steps', "Number of sequence steps proposed by draft models "
+    "and accepted, times the batch size.")
+
 
 def get_init_fn(method: str, input_dim: int, init_depth: tp.Optional[int] = None):
     """LM layer initialization.
@@ -161,6 +173,8 @@ class LMModel(StreamingModule):
         self.dim = dim
         self.pattern_provider = pattern_provider
         self.two_step_cfg = two_step_cfg
+        # fraction of the draft steps accepted during the last speculative generation.
+        self.last_acceptance_rate: tp.Optional[float] = None
         self.emb = nn.ModuleList([ScaledEmbedding(embed_dim, dim, lr=emb_lr) for _ in range(n_q)])
         if 'activation' in kwargs:
             kwargs['activation'] = get_activation_fn(kwargs['activation'])
@@ -174,6 +188,10 @@ class LMModel(StreamingModule):
         self._init_weights(weight_init, depthwise_init, zero_bias_init)
         self._fsdp: tp.Optional[nn.Module]
         self.__dict__['_fsdp'] = None
+        # `_get_cfg_logits` compiled for the decoding steps, created on first use, see `_decode`.
+        self._compiled_cfg_logits: tp.Optional[tp.Callable[..., torch.Tensor]] = None
+        # see `mask_condition_padding`.
+        self._mask_condition_padding = False
 
     def _init_weights(self, weight_init: tp.Optional[str], depthwise_init: tp.Optional[str], zero_bias_init: bool):
         """Initialization of the transformer module weights.
@@ -217,6 +235,30 @@ class LMModel(StreamingModule):
     def num_codebooks(self) -> int:
         return self.n_q
 
+    def quantize_(self) -> 'LMModel':
+        """Quantize in place the linear layers of the transformer and the output heads to int8,
+        for inference on CPU, see `audiocraft.modules.int8`. The embeddings and conditioners are kept as is.
+        """
+        assert not self.training, "Quantized models only support inference."
+        self.transformer.quantize_()
+        quantize_linears_(self.linears)
+        self._compiled_cfg_logits = None
+        return self
+
+    @contextmanager
+    def mask_condition_padding(self, enabled: bool = True):
+        """Within this context, the cross attention ignores the padding of the conditions, e.g. past
+        the shorter descriptions of a batch, so that the output for an item does not depend on the other items.
+        The models were trained attending to that padding, so this changes their outputs on batches
+        mixing conditions of different lengths. It is off by default, and in particular for training.
+        """
+        previous = self._mask_condition_padding
+        self._mask_condition_padding = enabled
+        try:
+            yield
+        finally:
+            self._mask_condition_padding = previous
+
     def forward(self, sequence: torch.Tensor,
                 conditions: tp.List[ConditioningAttributes],
                 condition_tensors: tp.Optional[ConditionTensors] = None) -> torch.Tensor:
@@ -249,8 +291,12 @@ class LMModel(StreamingModule):
             assert not conditions, "Shouldn't pass both conditions and condition_tensors."
 
         input_, cross_attention_input = self.fuser(input_, condition_tensors)
+        cross_attention_mask = None
+        if self._mask_condition_padding:
+            cross_attention_mask = self.fuser.get_cross_attention_mask(condition_tensors)
 
-        out = self.transformer(input_, cross_attention_src=cross_attention_input)
+        out = self.transformer(input_, cross_attention_src=cross_attention_input,
+                               cross_attention_mask=cross_attention_mask)
         if self.out_norm:
             out = self.out_norm(out)
         logits = torch.stack([self.linears[k](out) for k in range(K)], dim=1)  # [B, K, S, card]
@@ -306,37 +352,28 @@ class LMModel(StreamingModule):
         logits_mask = logits_mask[None, :, :].expand(B, -1, -1)  # [K, T] -> [B, K, T]
         return LMOutput(logits, logits_mask)
 
-    def _sample_next_token(self,
-                           sequence: torch.Tensor,
-                           cfg_conditions: CFGConditions,
-                           unconditional_state: State,
-                           use_sampling: bool = False,
-                           temp: float = 1.0,
-                           top_k: int = 0,
-                           top_p: float = 0.0,
-                           cfg_coef: tp.Optional[float] = None) -> torch.Tensor:
-        """Sample next token from the model given a sequence and a set of conditions. The model supports
-        multiple sampling strategies (greedy sampling, softmax, top-k, top-p...).
+    def _get_cfg_logits(self,
+                        sequence: torch.Tensor,
+                        cfg_conditions: CFGConditions,
+                        unconditional_state: State,
+                        cfg_coef: tp.Optional[PerRow] = None) -> torch.Tensor:
+        """Compute the logits for all the steps of the given sequence, applying classifier free guidance
+        if conditions are given.
 
         Args:
-            sequence (torch.Tensor): Current sequence of shape [B, K, S]
-                with K corresponding to the number of codebooks and S the number of sequence steps.
-                S = 1 in streaming mode, except for the first step that contains a bigger prompt.
-            condition_tensors (Dict[str, ConditionType): Set of conditions. If CFG is used,
-                should be twice the batch size, being the concatenation of the conditions + null conditions.
-            use_sampling (bool): Whether to use a sampling strategy or not.
-            temp (float): Sampling temperature.
-            top_k (int): K for "top-k" sampling.
-            top_p (float): P for "top-p" sampling.
-            cfg_coef (float): classifier free guidance coefficient
+            sequence (torch.Tensor): Current sequence of shape [B, K, S].
+            cfg_conditions (CFGConditions): Conditions, see `_sample_next_token`.
+            unconditional_state (State): Streaming state of the unconditional pass with two step CFG.
+            cfg_coef (float or torch.Tensor): classifier free guidance coefficient, or one per item of shape [B].
         Returns:
-            next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
+            torch.Tensor: Logits of shape [B, K, S, card].
         """
         B = sequence.shape[0]
         cfg_coef = self.cfg_coef if cfg_coef is None else cfg_coef
+        if isinstance(cfg_coef, torch.Tensor):
+            cfg_coef = cfg_coef.view(B, 1, 1, 1)
         model = self if self._fsdp is None else self._fsdp
-        if self.two_step_cfg and cfg_conditions != {}:
-            assert isinstance(cfg_conditions, tuple)
+        if isinstance(cfg_conditions, tuple):
             condition_tensors, null_condition_tensors = cfg_conditions
             cond_logits = model(sequence, conditions=[], condition_tensors=condition_tensors)
             state = self.get_streaming_state()
@@ -344,9 +381,8 @@ class LMModel(StreamingModule):
             uncond_logits = model(sequence, conditions=[], condition_tensors=null_condition_tensors)
             unconditional_state.update(self.get_streaming_state())
             self.set_streaming_state(state)
-            logits = uncond_logits + (cond_logits - uncond_logits) * self.cfg_coef
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
         else:
-            assert isinstance(cfg_conditions, dict)
             condition_tensors = cfg_conditions
             if condition_tensors:
                 # Preparing for CFG, predicting both conditional and unconditional logits.
@@ -359,19 +395,56 @@ class LMModel(StreamingModule):
                 logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
             else:
                 logits = all_logits
+        return logits
 
-        logits = logits.permute(0, 1, 3, 2)  # [B, K, card, T]
-        logits = logits[..., -1]  # [B x K x card]
+    def _sample_next_token(self,
+                           sequence: torch.Tensor,
+                           cfg_conditions: CFGConditions,
+                           unconditional_state: State,
+                           use_sampling: bool = False,
+                           temp: PerRow = 1.0,
+                           top_k: tp.Union[int, torch.Tensor] = 0,
+                           top_p: PerRow = 0.0,
+                           cfg_coef: tp.Optional[PerRow] = None,
+                           min_p: float = 0.0,
+                           repetition_penalty: float = 1.0,
+                           seen: tp.Optional[torch.Tensor] = None,
+                           compiled: bool = False,
+                           generators: tp.Optional[tp.Sequence[torch.Generator]] = None) -> torch.Tensor:
+        """Sample next token from the model given a sequence and a set of conditions. The model supports
+        multiple sampling strategies (greedy sampling, softmax, top-k, top-p...).
 
-        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
-        if use_sampling and temp > 0.0:
-            probs = torch.softmax(logits / temp, dim=-1)
-            if top_p > 0.0:
-                next_token = utils.sample_top_p(probs, p=top_p)
-            elif top_k > 0:
-                next_token = utils.sample_top_k(probs, k=top_k)
-            else:
-                next_token = utils.multinomial(probs, num_samples=1)
+        Args:
+            sequence (torch.Tensor): Current sequence of shape [B, K, S]
+                with K corresponding to the number of codebooks and S the number of sequence steps.
+                S = 1 in streaming mode, except for the first step that contains a bigger prompt.
+            condition_tensors (Dict[str, ConditionType): Set of conditions. If CFG is used,
+                should be twice the batch size, being the concatenation of the conditions + null conditions.
+            use_sampling (bool): Whether to use a sampling strategy or not.
+            temp (float or torch.Tensor): Sampling temperature.
+            top_k (int or torch.Tensor): K for "top-k" sampling.
+            top_p (float or torch.Tensor): P for "top-p" sampling.
+            cfg_coef (float or torch.Tensor): classifier free guidance coefficient.
+                The four parameters above can also be tensors of shape [B], with one value per item.
+            min_p (float): Minimum probability relative to the most likely token for sampling.
+            repetition_penalty (float): Penalty applied to the tokens in `seen`.
+            seen (torch.Tensor, optional): Tokens already generated for each codebook, as a boolean tensor
+                of shape [B, K, card], required when using a repetition penalty.
+            compiled (bool): Compute the logits with the compiled model, see `_decode`.
+            generators (list of torch.Generator, optional): One random number generator per item.
+        Returns:
+            next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
+        """
+        get_cfg_logits = self._get_compiled_cfg_logits() if compiled else self._get_cfg_logits
+        logits = get_cfg_logits(sequence, cfg_conditions, unconditional_state, cfg_coef)
+        logits = logits[:, :, -1]  # [B x K x card]
+
+        # Sample if temp > 0. Else, do greedy sampling to avoid zero division error.
+        # With a temperature per item, `sample_next_token` uses greedy decoding for the items with temp = 0.
+        if use_sampling and (isinstance(temp, torch.Tensor) or temp > 0.0):
+            next_token = sample_next_token(
+                logits, temp=temp, top_k=resolve_top_k(top_k, top_p), top_p=top_p, min_p=min_p,
+                repetition_penalty=repetition_penalty, seen=seen, generators=generators)
         else:
             next_token = torch.argmax(logits, dim=-1, keepdim=True)
 
@@ -384,30 +457,148 @@ class LMModel(StreamingModule):
                  num_samples: tp.Optional[int] = None,
                  max_gen_len: int = 256,
                  use_sampling: bool = True,
-                 temp: float = 1.0,
-                 top_k: int = 250,
-                 top_p: float = 0.0,
-                 cfg_coef: tp.Optional[float] = None,
+                 temp: PerRow = 1.0,
+                 top_k: tp.Union[int, torch.Tensor] = 250,
+                 top_p: PerRow = 0.0,
+                 cfg_coef: tp.Optional[PerRow] = None,
                  two_step_cfg: bool = False,
                  remove_prompts: bool = False,
                  check: bool = False,
-                 callback: tp.Optional[tp.Callable[[int, int], None]] = None) -> torch.Tensor:
+                 callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                 static_kv_cache: bool = False,
+                 min_p: float = 0.0,
+                 repetition_penalty: float = 1.0,
+                 draft: tp.Optional['LMModel'] = None,
+                 num_draft_steps: int = 4,
+                 compile_decode: bool = False,
+                 past_context: tp.Optional[int] = None,
+                 cfg_conditions: tp.Optional[CFGConditions] = None,
+                 generators: tp.Optional[tp.Sequence[torch.Generator]] = None,
+                 mask_condition_padding: bool = False) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be perform in a greedy fashion or using sampling with top K and top P strategies.
 
         Args:
-            prompt (Optional[torch.Tensor]): Prompt tokens of shape [B, K, T].
+            prompt (Optional[torch.Tensor]): Prompt tokens of shape [B, K, T]. Prompts of different lengths
+                are padded at the end with -1, the generation then starts after the shortest one,
+                and the tokens of the longer ones are kept, see `get_prompt_length`.
             conditions_tensors (Dict[str, torch.Tensor]): Set of conditions or None.
             num_samples (int or None): Number of samples to generate when no prompt and no conditions are given.
             max_gen_len (int): Maximum generation length.
             use_sampling (bool): Whether to use a sampling strategy or not.
-            temp (float): Sampling temperature.
-            top_k (int): K for "top-k" sampling.
-            top_p (float): P for "top-p" sampling.
-            remove_prompts (bool): Whether to remove prompts from generation or not.
+            temp (float or torch.Tensor): Sampling temperature.
+            top_k (int or torch.Tensor): K for "top-k" sampling.
+            top_p (float or torch.Tensor): P for "top-p" sampling.
+            cfg_coef (float or torch.Tensor, optional): Classifier free guidance coefficient,
+                defaults to the one of the model. The temperature, top-k, top-p and CFG coefficient
+                can be tensors of shape [B] to use different values for each item, see `_sample_next_token`.
+            remove_prompts (bool): Whether to remove prompts from generation or not. Only the timesteps
+                of the shortest prompt are removed.
+            static_kv_cache (bool): Preallocate the self attention keys and values for the whole generation
+                and write them in place, instead of reallocating them at every step.
+            min_p (float): If positive, only sample tokens with a probability of at least `min_p` times
+                that of the most likely token.
+            repetition_penalty (float): Penalty for the tokens already present in each codebook,
+                1 meaning no penalty, see `utils.sampling.apply_repetition_penalty`.
+            draft (LMModel, optional): If given, use speculative decoding with this smaller model
+                proposing `num_draft_steps` steps at a time, see `_decode_speculative`.
+            num_draft_steps (int): Number of steps proposed by the draft model before each verification.
+            compile_decode (bool): Run the decoding steps after the prefill with `torch.compile`,
+                over fixed shapes thanks to the slots of the transformer, see `_decode`.
+            past_context (int, optional): If given, each step only attends to that many previous steps,
+                with the keys and values kept in ring buffers, so that the cost of a step does not grow
+                with `max_gen_len`, see `StreamingTransformer.sliding_window`.
+            cfg_conditions (CFGConditions, optional): Condition tensors already computed from `conditions`
+                with `_get_cfg_conditions`, to reuse them over several generations. The `conditions` are still
+                used for the number of samples and by the draft model.
+            generators (list of torch.Generator, optional): One random number generator per sample,
+                so that the tokens sampled for an item do not depend on the other items of the batch.
+            mask_condition_padding (bool): Ignore the padding of the conditions in the cross attention,
+                see `mask_condition_padding`. Together with `generators`, the tokens generated for an item
+                then do not depend at all on the other items of the batch.
         Returns:
             torch.Tensor: Generated tokens.
         """
+        out_codes = torch.cat(list(self.generate_stream(
+            prompt, conditions, num_samples, max_gen_len, use_sampling, temp, top_k, top_p,
+            cfg_coef=cfg_coef, two_step_cfg=two_step_cfg, remove_prompts=remove_prompts,
+            check=check, callback=callback, static_kv_cache=static_kv_cache,
+            min_p=min_p, repetition_penalty=repetition_penalty,
+            draft=draft, num_draft_steps=num_draft_steps, compile_decode=compile_decode,
+            past_context=past_context, cfg_conditions=cfg_conditions, generators=generators,
+            mask_condition_padding=mask_condition_padding)), dim=-1)
+        return out_codes
+
+    @staticmethod
+    def get_prompt_length(prompt: torch.Tensor) -> int:
+        """Return the number of leading timesteps known for all the items of prompt tokens [B, K, T],
+        the shorter prompts being padded at the end with -1.
+        """
+        return int((prompt != -1).all(dim=1).long().cumprod(dim=-1).sum(dim=-1).min()) if prompt.numel() else 0
+
+    def _get_compiled_cfg_logits(self) -> tp.Callable[..., torch.Tensor]:
+        if self._compiled_cfg_logits is None:
+            # the decoding steps all have the same shapes, recompiling would only hide a bug.
+            self._compiled_cfg_logits = torch.compile(self._get_cfg_logits, dynamic=False)
+        return self._compiled_cfg_logits
+
+    def _get_cfg_conditions(self, conditions: tp.List[ConditioningAttributes], two_step_cfg: bool) -> CFGConditions:
+        # below we create set of conditions: one conditional and one unconditional
+        # to do that we merge the regular condition together with the null condition
+        # we then do 1 forward pass instead of 2.
+        # the reason for that is two-fold:
+        # 1. it is about x2 faster than doing 2 forward passes
+        # 2. avoid the streaming API treating the 2 passes as part of different time steps
+        # We also support doing two different passes, in particular to ensure that
+        # the padding structure is exactly the same between train anf test.
+        # With a batch size of 1, this can be slower though.
+        if not conditions:
+            return {}
+        with metrics.stage('conditioning'):
+            null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
+            if two_step_cfg:
+                return (
+                    self.condition_provider(self.condition_provider.tokenize(conditions)),
+                    self.condition_provider(self.condition_provider.tokenize(null_conditions)),
+                )
+            tokenized = self.condition_provider.tokenize(conditions + null_conditions)
+            return self.condition_provider(tokenized)
+
+    @torch.no_grad()
+    def generate_stream(self,
+                        prompt: tp.Optional[torch.Tensor] = None,
+                        conditions: tp.List[ConditioningAttributes] = [],
+                        num_samples: tp.Optional[int] = None,
+                        max_gen_len: int = 256,
+                        use_sampling: bool = True,
+                        temp: PerRow = 1.0,
+                        top_k: tp.Union[int, torch.Tensor] = 250,
+                        top_p: PerRow = 0.0,
+                        cfg_coef: tp.Optional[PerRow] = None,
+                        two_step_cfg: bool = False,
+                        remove_prompts: bool = False,
+                        check: bool = False,
+                        callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                        static_kv_cache: bool = False,
+                        min_p: float = 0.0,
+                        repetition_penalty: float = 1.0,
+                        draft: tp.Optional['LMModel'] = None,
+                        num_draft_steps: int = 4,
+                        compile_decode: bool = False,
+                        past_context: tp.Optional[int] = None,
+                        cfg_conditions: tp.Optional[CFGConditions] = None,
+                        generators: tp.Optional[tp.Sequence[torch.Generator]] = None,
+                        mask_condition_padding: bool = False) -> tp.Iterator[torch.Tensor]:
+        """Same as `generate`, but yields the tokens as soon as they are available, i.e. as soon
+        as all the codebooks of a timestep have been generated according to the codebooks pattern.
+        Concatenating the yielded tokens along the last dimension gives the output of `generate`.
+
+        Note that the model is in streaming mode until the generator is exhausted or closed,
+        so it should not be used for anything else in the meantime.
+
+        Returns:
+            Iterator[torch.Tensor]: Generated tokens for the newly completed timesteps, of shape [B, K, T'].
+        """
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
         device = first_param.device
@@ -425,38 +616,18 @@ class LMModel(StreamingModule):
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsitent inputs shapes"
         num_samples = possible_num_samples[0]
 
-        # below we create set of conditions: one conditional and one unconditional
-        # to do that we merge the regular condition together with the null condition
-        # we then do 1 forward pass instead of 2.
-        # the reason for that is two-fold:
-        # 1. it is about x2 faster than doing 2 forward passes
-        # 2. avoid the streaming API treating the 2 passes as part of different time steps
-        # We also support doing two different passes, in particular to ensure that
-        # the padding structure is exactly the same between train anf test.
-        # With a batch size of 1, this can be slower though.
-        cfg_conditions: CFGConditions
         two_step_cfg = self.two_step_cfg if two_step_cfg is None else two_step_cfg
-        if conditions:
-            null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
-            if two_step_cfg:
-                cfg_conditions = (
-                    self.condition_provider(self.condition_provider.tokenize(conditions)),
-                    self.condition_provider(self.condition_provider.tokenize(null_conditions)),
-                )
-            else:
-                conditions = conditions + null_conditions
-                tokenized = self.condition_provider.tokenize(conditions)
-                cfg_conditions = self.condition_provider(tokenized)
-        else:
-            cfg_conditions = {}
+        if cfg_conditions is None:
+            cfg_conditions = self._get_cfg_conditions(conditions, two_step_cfg)
 
         if prompt is None:
             assert num_samples > 0
             prompt = torch.zeros((num_samples, self.num_codebooks, 0), dtype=torch.long, device=device)
 
         B, K, T = prompt.shape
-        start_offset = T
-        assert start_offset < max_gen_len
+        assert T < max_gen_len
+        assert generators is None or len(generators) == B, "Expected one generator per sample."
+        start_offset = self.get_prompt_length(prompt)
 
         pattern = self.pattern_provider.get_pattern(max_gen_len)
         # this token is used as default value for codes that are not generated yet
@@ -465,7 +636,7 @@ class LMModel(StreamingModule):
         # we generate codes up to the max_gen_len that will be mapped to the pattern sequence
         gen_codes = torch.full((B, K, max_gen_len), unknown_token, dtype=torch.long, device=device)
         # filling the gen_codes with the prompt if needed
-        gen_codes[..., :start_offset] = prompt
+        gen_codes[..., :T] = prompt
         # create the gen_sequence with proper interleaving from the pattern: [B, K, S]
         gen_sequence, indexes, mask = pattern.build_pattern_sequence(gen_codes, self.special_token_id)
         # retrieve the start_offset in the sequence:
@@ -473,10 +644,96 @@ class LMModel(StreamingModule):
         start_offset_sequence = pattern.get_first_step_with_timesteps(start_offset)
         assert start_offset_sequence is not None
 
-        with self.streaming():
+        sampling_params: tp.Dict[str, tp.Any] = dict(use_sampling=use_sampling, temp=temp, top_k=top_k,
+                                                     top_p=top_p, cfg_coef=cfg_coef, min_p=min_p)
+        for name, value in sampling_params.items():
+            if isinstance(value, torch.Tensor):
+                assert value.shape == (B,), f"{name} should be a number or have one value per item."
+                sampling_params[name] = value.to(device)
+        if past_context is not None:
+            assert not compile_decode, "Compiled decoding is not supported with a past context."
+            # prepended conditions would leave the attention window after `past_context` steps.
+            assert not self.fuser.fuse2cond['prepend'], "Prepend conditions are not supported with a past context."
+        if draft is None:
+            assert not (compile_decode and two_step_cfg), "Two step CFG is not supported with a compiled decoding."
+            steps = self._decode(gen_sequence, mask, start_offset_sequence, cfg_conditions, static_kv_cache,
+                                 check, repetition_penalty, compile_decode, past_context, generators,
+                                 mask_condition_padding, **sampling_params)
+        else:
+            assert not compile_decode, "Compiled decoding is not supported with speculative decoding."
+            assert past_context is None, "A past context is not supported with speculative decoding."
+            assert generators is None, "Per sample generators are not supported with speculative decoding."
+            assert not mask_condition_padding, "Condition padding masks are not supported with speculative decoding."
+            assert repetition_penalty == 1.0, "Repetition penalty is not supported with speculative decoding."
+            assert not (two_step_cfg or self.two_step_cfg or draft.two_step_cfg), \
+                "Two step CFG is not supported with speculative decoding."
+            assert draft is not self, "The draft model needs its own streaming state."
+            assert draft.card == self.card and draft.num_codebooks == self.num_codebooks
+            assert draft.pattern_provider.get_pattern(max_gen_len).layout == pattern.layout, \
+                "The draft model should use the same codebooks pattern."
+            draft_cfg_conditions = draft._get_cfg_conditions(conditions, two_step_cfg=False)
+            steps = self._decode_speculative(
+                draft, gen_sequence, start_offset_sequence, cfg_conditions, draft_cfg_conditions,
+                static_kv_cache, num_draft_steps, **sampling_params)
+
+        # the prompt comes first, unless it should be removed.
+        if start_offset > 0 and not remove_prompts:
+            yield prompt[..., :start_offset]
+        # number of timesteps yielded so far
+        emitted = start_offset
+
+        gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
+        try:
+            for offset in steps:
+                # `offset` is the sequence step that was just filled.
+                if callback is not None:
+                    callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
+                num_complete = min(pattern.get_num_complete_timesteps(offset), max_gen_len)
+                if num_complete > emitted:
+                    new_codes, _, _ = pattern.revert_pattern_sequence(
+                        gen_sequence, special_token=unknown_token, timesteps=slice(emitted, num_complete))
+                    # ensure the returned codes are all valid
+                    assert (new_codes >= 0).all() and (new_codes <= self.card).all()
+                    yield new_codes
+                    emitted = num_complete
+        finally:
+            # leaves the streaming mode right away if the caller stops early.
+            steps.close()
+
+        # ensure sequence has been entirely filled
+        assert not (gen_sequence == unknown_token).any()
+        # ensure gen_sequence pattern and mask are matching
+        # which means the gen_sequence is valid according to the pattern
+        assert (
+            gen_sequence == torch.where(mask[None, ...].expand(B, -1, -1), gen_sequence, self.special_token_id)
+        ).all()
+        assert emitted == max_gen_len
+
+    def _decode(self, gen_sequence: torch.Tensor, mask: torch.Tensor, start_offset_sequence: int,
+                cfg_conditions: CFGConditions, static_kv_cache: bool, check: bool,
+                repetition_penalty: float, compile_decode: bool = False, past_context: tp.Optional[int] = None,
+                generators: tp.Optional[tp.Sequence[torch.Generator]] = None, mask_condition_padding: bool = False,
+                **sampling_params) -> tp.Generator[int, None, None]:
+        # Fill the unknown tokens of `gen_sequence` [B, K, S] one sequence step at a time,
+        # yielding each step once filled. With `compile_decode`, the first step, which processes
+        # the prompt, runs eagerly, then the keys and values move to the slots of the transformer,
+        # which have the same shapes at every step, and the following steps run compiled.
+        # With `past_context`, the keys and values are kept in ring buffers, which are already static.
+        B, K, gen_sequence_len = gen_sequence.shape
+        unknown_token = -1
+        # tokens already present in each codebook, for the repetition penalty.
+        seen: tp.Optional[torch.Tensor] = None
+        if repetition_penalty != 1.0:
+            # the prompt tokens count as seen, special and unknown tokens are scattered to an extra slot.
+            known = gen_sequence.masked_fill(gen_sequence == unknown_token, self.special_token_id)
+            seen = torch.zeros((B, K, self.card + 1), dtype=torch.bool, device=gen_sequence.device)
+            seen = seen.scatter_(-1, known, True)[..., :self.card]
+        # all the sequence steps but the last one are fed to the model.
+        kv_cache_capacity = gen_sequence_len if static_kv_cache and past_context is None else None
+        with self.streaming(), self.transformer.static_kv_cache(kv_cache_capacity), \
+                self.transformer.sliding_window(past_context), self.mask_condition_padding(mask_condition_padding):
             unconditional_state = self.get_streaming_state()
             prev_offset = 0
-            gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
             for offset in range(start_offset_sequence, gen_sequence_len):
                 # get current sequence (note that the streaming API is providing the caching over previous offsets)
                 curr_sequence = gen_sequence[..., prev_offset:offset]
@@ -486,42 +743,134 @@ class LMModel(StreamingModule):
                     assert (curr_sequence == torch.where(curr_mask, curr_sequence, self.special_token_id)).all()
                     # should never happen as gen_sequence is filled progressively
                     assert not (curr_sequence == unknown_token).any()
+                step_begin = time.perf_counter()
                 # sample next token from the model, next token shape is [B, K, 1]
+                compiled = compile_decode and offset > start_offset_sequence
                 next_token = self._sample_next_token(
-                    curr_sequence, cfg_conditions, unconditional_state, use_sampling, temp, top_k, top_p,
-                    cfg_coef=cfg_coef)
+                    curr_sequence, cfg_conditions, unconditional_state,
+                    repetition_penalty=repetition_penalty, seen=seen, compiled=compiled,
+                    generators=generators, **sampling_params)
+                if compile_decode and offset == start_offset_sequence:
+                    self._init_decode_slots(gen_sequence_len)
                 # ensure the tokens that should be masked are properly set to special_token_id
                 # as the model never output special_token_id
                 valid_mask = mask[..., offset:offset+1].expand(B, -1, -1)
-                next_token[~valid_mask] = self.special_token_id
                 # ensure we don't overwrite prompt tokens, we only write over unknown tokens
                 # (then mask tokens should be left as is as well, which is correct)
+                to_fill = gen_sequence[..., offset:offset+1] == unknown_token
+                if seen is not None:
+                    seen.scatter_(-1, next_token, seen.gather(-1, next_token) | (valid_mask & to_fill))
+                next_token[~valid_mask] = self.special_token_id
                 gen_sequence[..., offset:offset+1] = torch.where(
-                    gen_sequence[..., offset:offset+1] == unknown_token,
-                    next_token, gen_sequence[..., offset:offset+1]
-                )
+                    to_fill, next_token, gen_sequence[..., offset:offset+1])
+                # the first step also processes the prompt, if any.
+                metrics.STAGE_SECONDS.observe(time.perf_counter() - step_begin,
+                                              stage='lm_prefill' if offset == start_offset_sequence else 'lm_step')
                 prev_offset = offset
-                if callback is not None:
-                    callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
-        unconditional_state.clear()
-
-        # ensure sequence has been entirely filled
-        assert not (gen_sequence == unknown_token).any()
-        # ensure gen_sequence pattern and mask are matching
-        # which means the gen_sequence is valid according to the pattern
-        assert (
-            gen_sequence == torch.where(mask[None, ...].expand(B, -1, -1), gen_sequence, self.special_token_id)
-        ).all()
-        # get back the codes, trimming the prompt if needed and cutting potentially incomplete timesteps
-        out_codes, out_indexes, out_mask = pattern.revert_pattern_sequence(gen_sequence, special_token=unknown_token)
-
-        # sanity checks over the returned codes and corresponding masks
-        assert (out_codes[..., :max_gen_len] != unknown_token).all()
-        assert (out_mask[..., :max_gen_len] == 1).all()
-
-        out_start_offset = start_offset if remove_prompts else 0
-        out_codes = out_codes[..., out_start_offset:max_gen_len]
-
-        # ensure the returned codes are all valid
-        assert (out_codes >= 0).all() and (out_codes <= self.card).all()
-        return out_codes
+                yield offset
+            unconditional_state.clear()
+
+    def _init_decode_slots(self, capacity: int):
+        # Move the keys and values of the streaming state to slots of `capacity` steps.
+        state = self.transformer.get_streaming_state()
+        rows = torch.arange(len(state['offsets']), device=state['offsets'].device)
+        self.transformer.init_slots(len(rows), capacity)
+        self.transformer.fill_slots(rows, state)
+
+    def _rollback_streaming(self, steps: int):
+        # Forget the last `steps` sequence steps fed to the model in streaming mode.
+        self.transformer.rollback(steps)
+        if 'offsets' in self.fuser._streaming_state:
+            self.fuser._streaming_state['offsets'] = self.fuser._streaming_state['offsets'] - steps
+
+    def _decode_speculative(self, draft: 'LMModel', gen_sequence: torch.Tensor, start_offset_sequence: int,
+                            cfg_conditions: CFGConditions, draft_cfg_conditions: CFGConditions,
+                            static_kv_cache: bool, num_draft_steps: int, use_sampling: bool = True,
+                            temp: PerRow = 1.0, top_k: tp.Union[int, torch.Tensor] = 0, top_p: PerRow = 0.0,
+                            cfg_coef: tp.Optional[PerRow] = None, min_p: float = 0.0) -> tp.Generator[int, None, None]:
+        """Same as `_decode`, with speculative decoding (https://arxiv.org/abs/2211.17192).
+
+        At each round, the draft model proposes `num_draft_steps` sequence steps one after the other,
+        and this model computes the logits for all of them in a single forward. Within a step, the
+        codebooks are sampled independently given the past, so each proposed token is accepted or
+        replaced using `utils.sampling.speculative_sample`, both models applying CFG and the sampling
+        filters, and the generated tokens follow the same distribution as without a draft.
+        The steps are kept up to the first one with a replaced token, included, for all the items
+        of the batch, or all of them plus one sampled from the last logits of this model otherwise.
+        Both models then forget the steps they processed with the rejected tokens, see
+        `StreamingTransformer.rollback`.
+
+        The fraction of the proposed steps that are accepted is available after the generation
+        in `last_acceptance_rate`, and reported by the `audiocraft_speculative_*` metrics.
+        """
+        B, K, gen_sequence_len = gen_sequence.shape
+        unknown_token = -1
+        probs_params: tp.Dict[str, tp.Any] = dict(use_sampling=use_sampling, temp=temp,
+                                                  top_k=resolve_top_k(top_k, top_p), top_p=top_p, min_p=min_p)
+        num_drafted = num_accepted = 0
+        kv_cache_capacity = gen_sequence_len if static_kv_cache else None
+        with self.streaming(), self.transformer.static_kv_cache(kv_cache_capacity), \
+                draft.streaming(), draft.transformer.static_kv_cache(kv_cache_capacity):
+            # number of sequence steps fed to each model so far.
+            target_steps = draft_steps = 0
+            offset = start_offset_sequence
+            while offset < gen_sequence_len:
+                round_begin = time.perf_counter()
+                num_steps = min(num_draft_steps, gen_sequence_len - offset)
+                end = offset + num_steps
+                original = gen_sequence[..., offset:end].clone()
+                # special tokens and prompt tokens are already known and never sampled.
+                to_sample = original == unknown_token
+                draft_probs = []
+                for position in range(offset, end):
+                    logits = draft._get_cfg_logits(
+                        gen_sequence[..., draft_steps:position], draft_cfg_conditions, {}, cfg_coef)
+                    draft_steps = position
+                    probs = get_sampling_probs(logits[:, :, -1], **probs_params)
+                    draft_probs.append(probs)
+                    step = gen_sequence[..., position:position + 1]
+                    step.copy_(torch.where(step == unknown_token, sample_from_probs(probs), step))
+
+                # predictions of this model for the steps `offset` to `end`, included.
+                logits = self._get_cfg_logits(gen_sequence[..., target_steps:end], cfg_conditions, {}, cfg_coef)
+                assert logits.shape[2] > num_steps
+                target_steps = end
+                target_probs = get_sampling_probs(logits[:, :, -num_steps - 1:], **probs_params)
+                # the special tokens are out of the cardinality, they are replaced as they are ignored anyway.
+                drafted = torch.where(to_sample, gen_sequence[..., offset:end], 0)
+                tokens, accepted = speculative_sample(
+                    target_probs[:, :, :num_steps], torch.stack(draft_probs, dim=2), drafted[..., None])
+                tokens, accepted = tokens[..., 0], accepted[..., 0] | ~to_sample
+                # number of leading steps accepted for each item, then for the whole batch.
+                item_accepted = accepted.all(dim=1).long().cumprod(dim=1).sum(dim=1)
+                num_drafted += B * num_steps
+                num_accepted += int(item_accepted.sum())
+                batch_accepted = int(item_accepted.min())
+                if batch_accepted < num_steps:
+                    position = offset + batch_accepted
+                    gen_sequence[..., position] = torch.where(
+                        to_sample[..., batch_accepted], tokens[..., batch_accepted], gen_sequence[..., position])
+                    gen_sequence[..., position + 1:end] = original[..., batch_accepted + 1:]
+                    new_offset = position + 1
+                elif end < gen_sequence_len:
+                    step = gen_sequence[..., end:end + 1]
+                    step.copy_(torch.where(step == unknown_token, sample_from_probs(target_probs[:, :, -1]), step))
+                    new_offset = end + 1
+                else:
+                    new_offset = end
+                # both models must process again the last filled step, and all the following ones.
+                self._rollback_streaming(target_steps - (new_offset - 1))
+                target_steps = new_offset - 1
+                if draft_steps > new_offset - 1:
+                    draft._rollback_streaming(draft_steps - (new_offset - 1))
+                    draft_steps = new_offset - 1
+                metrics.STAGE_SECONDS.observe(time.perf_counter() - round_begin, stage='lm_speculative_round')
+                for position in range(offset, new_offset):
+                    yield position
+                offset = new_offset
+
+        SPECULATIVE_DRAFT_STEPS.inc(num_drafted)
+        SPECULATIVE_ACCEPTED_STEPS.inc(num_accepted)
+        self.last_acceptance_rate = num_accepted / max(1, num_drafted)
+        logger.debug("Speculative decoding accepted %.1f%% of %d draft steps",
+                     100 * self.last_acceptance_rate, num_drafted)
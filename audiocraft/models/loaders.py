@@ -17,6 +17,9 @@ Each checkpoint is a torch.saved dict with the following keys:
 Those functions also support loading from a remote location with the Torch Hub API.
 They also support overriding some parameters, in particular the device and dtype
 of the returned model.
+
+LM checkpoints can also hold int8 weights, with the extra key 'quantized' set to True,
+see `audiocraft.utils.export.export_quantized_lm`.
 """
 
 from pathlib import Path
@@ -79,7 +82,11 @@ def load_compression_model(file_or_url_or_id: tp.Union[Path, str], device='cpu',
     return model
 
 
-def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_dir: tp.Optional[str] = None):
+def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_dir: tp.Optional[str] = None,
+                  quantize: bool = False):
+    """Load a LM, with its linear layers quantized to int8 if `quantize` is True or if the
+    checkpoint is already quantized, which is only supported on CPU, see `LMModel.quantize_`.
+    """
     pkg = _get_state_dict(file_or_url_or_id, filename="state_dict.bin", cache_dir=cache_dir)
     cfg = OmegaConf.create(pkg['xp.cfg'])
     cfg.device = str(device)
@@ -87,8 +94,15 @@ def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_di
         cfg.dtype = 'float32'
     else:
         cfg.dtype = 'float16'
+    quantized = pkg.get('quantized', False)
+    if quantize or quantized:
+        assert cfg.device == 'cpu', "Quantized LMs are only supported on CPU."
     model = builders.get_lm_model(cfg)
-    model.load_state_dict(pkg['best_state'])
     model.eval()
+    if quantized:
+        model.quantize_()
+    model.load_state_dict(pkg['best_state'])
+    if quantize and not quantized:
+        model.quantize_()
     model.cfg = cfg
     return model
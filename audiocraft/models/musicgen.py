@@ -15,16 +15,21 @@ import typing as tp
 import torch
 
 from .encodec import CompressionModel
-from .lm import LMModel
+from .lm import CFGConditions, LMModel
 from .builders import get_debug_compression_model, get_debug_lm_model
 from .loaders import load_compression_model, load_lm_model, HF_MODEL_CHECKPOINTS_MAP
 from ..data.audio_utils import convert_audio
-from ..modules.conditioners import ConditioningAttributes, WavCondition
+from ..modules.conditioners import (
+    ChromaStemConditioner, ClassifierFreeGuidanceDropout, ConditioningAttributes, WavCondition)
+from ..utils import metrics
 from ..utils.autocast import TorchAutocast
 
 
 MelodyList = tp.List[tp.Optional[torch.Tensor]]
 MelodyType = tp.Union[torch.Tensor, MelodyList]
+PromptType = tp.Union[torch.Tensor, tp.List[torch.Tensor]]
+# generation parameters that can be given with one value per sample, see `MusicGen.generate`.
+PER_SAMPLE_PARAMS = ('temperature', 'top_k', 'top_p', 'cfg_coef', 'seed')
 
 
 class MusicGen:
@@ -45,7 +50,10 @@ class MusicGen:
         self.device = next(iter(lm.parameters())).device
         self.generation_params: dict = {}
         self.set_generation_params(duration=15)  # 15 seconds by default
+        self.draft_lm: tp.Optional[LMModel] = None
+        self.num_draft_steps = 4
         self._progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None
+        self.set_decoding_params()
         if self.device.type == 'cpu':
             self.autocast = TorchAutocast(enabled=False)
         else:
@@ -68,12 +76,14 @@ class MusicGen:
         return self.compression_model.channels
 
     @staticmethod
-    def get_pretrained(name: str = 'melody', device=None):
+    def get_pretrained(name: str = 'melody', device=None, quantize: bool = False):
         """Return pretrained model, we provide four models:
         - small (300M), text to music, # see: https://huggingface.co/facebook/musicgen-small
         - medium (1.5B), text to music, # see: https://huggingface.co/facebook/musicgen-medium
         - melody (1.5B) text to music and text+melody to music, # see: https://huggingface.co/facebook/musicgen-melody
         - large (3.3B), text to music, # see: https://huggingface.co/facebook/musicgen-large
+        With `quantize`, the linear layers of the LM are quantized to int8, which is only supported on CPU,
+        see `LMModel.quantize_`.
         """
 
         if device is None:
@@ -86,6 +96,8 @@ class MusicGen:
             # used only for unit tests
             compression_model = get_debug_compression_model(device)
             lm = get_debug_lm_model(device)
+            if quantize:
+                lm.quantize_()
             return MusicGen(name, compression_model, lm)
 
         if name not in HF_MODEL_CHECKPOINTS_MAP:
@@ -97,7 +109,7 @@ class MusicGen:
 
         cache_dir = os.environ.get('MUSICGEN_ROOT', None)
         compression_model = load_compression_model(name, device=device, cache_dir=cache_dir)
-        lm = load_lm_model(name, device=device, cache_dir=cache_dir)
+        lm = load_lm_model(name, device=device, cache_dir=cache_dir, quantize=quantize)
         if name == 'melody':
             lm.condition_provider.conditioners['self_wav'].match_len_on_eval = True
 
@@ -106,7 +118,11 @@ class MusicGen:
     def set_generation_params(self, use_sampling: bool = True, top_k: int = 250,
                               top_p: float = 0.0, temperature: float = 1.0,
                               duration: float = 30.0, cfg_coef: float = 3.0,
-                              two_step_cfg: bool = False, extend_stride: float = 18):
+                              two_step_cfg: bool = False, extend_stride: float = 18,
+                              static_kv_cache: bool = False, min_p: float = 0.0,
+                              repetition_penalty: float = 1.0, compile_decode: bool = False,
+                              sliding_window: bool = False, seed: tp.Optional[int] = None,
+                              mask_condition_padding: bool = False):
         """Set the generation parameters for MusicGen.
 
         Args:
@@ -122,6 +138,27 @@ class MusicGen:
             extend_stride: when doing extended generation (i.e. more than 30 seconds), by how much
                 should we extend the audio each time. Larger values will mean less context is
                 preserved, and shorter value will require extra computations.
+            static_kv_cache (bool, optional): Preallocate the attention keys and values for the whole
+                generation instead of growing them at every step. Defaults to False.
+            min_p (float, optional): When positive, tokens less likely than min_p times the most likely one
+                are never sampled. Defaults to 0.0.
+            repetition_penalty (float, optional): Penalty for sampling tokens already present
+                in the same codebook, 1.0 meaning no penalty. Defaults to 1.0.
+            compile_decode (bool, optional): Run the decoding steps compiled with `torch.compile`,
+                the first generation then includes the compilation. Defaults to False.
+            sliding_window (bool, optional): When doing extended generation, generate in a single streaming
+                session where each step attends to the previous `max_duration` seconds, instead of generating
+                a new window from a prompt every `extend_stride` seconds. Only the new tokens are computed,
+                but the positions go beyond the ones seen in training. Generating with a melody past
+                `max_duration` raises a ValueError. Defaults to False.
+            seed (int, optional): When given, each sample is drawn with its own random number generator,
+                seeded with `seed` for the first sample, `seed + 1` for the second and so on, so that a sample
+                does not depend on the other samples of the batch. Not supported with a draft model.
+                Defaults to None, using the global random number generator.
+            mask_condition_padding (bool, optional): Ignore the padding of the shorter descriptions of a batch
+                in the cross attention, see `LMModel.mask_condition_padding`. With a seed, a sample then does
+                not depend at all on the other samples of the batch, but this differs from the training
+                of the models. Not supported with a draft model. Defaults to False.
         """
         assert extend_stride < self.max_duration, "Cannot stride by more than max generation duration."
         self.extend_stride = extend_stride
@@ -133,36 +170,111 @@ class MusicGen:
             'top_p': top_p,
             'cfg_coef': cfg_coef,
             'two_step_cfg': two_step_cfg,
+            'static_kv_cache': static_kv_cache,
+            'min_p': min_p,
+            'repetition_penalty': repetition_penalty,
+            'compile_decode': compile_decode,
+            'sliding_window': sliding_window,
+            'seed': seed,
+            'mask_condition_padding': mask_condition_padding,
         }
 
+    def _get_generation_params(self, num_samples: int, **params) -> tp.Tuple[dict, float, float]:
+        """Return the LM generation parameters, duration and extend stride for a single call:
+        the ones set with `set_generation_params`, overridden by `params`, which use the same names.
+        The parameters in `PER_SAMPLE_PARAMS` can also be sequences with one value per sample.
+        """
+        generation_params = dict(self.generation_params)
+        duration = params.pop('duration', self.duration)
+        extend_stride = params.pop('extend_stride', self.extend_stride)
+        assert extend_stride < self.max_duration, "Cannot stride by more than max generation duration."
+        for name, value in params.items():
+            key = 'temp' if name == 'temperature' else name
+            if key not in generation_params:
+                raise TypeError(f"Unknown generation parameter {name}.")
+            if isinstance(value, (list, tuple, torch.Tensor)):
+                if name not in PER_SAMPLE_PARAMS:
+                    raise ValueError(f"Generation parameter {name} cannot have one value per sample.")
+                if len(value) != num_samples:
+                    raise ValueError(f"Expected {num_samples} values for {name}, got {len(value)}.")
+                if name == 'seed':
+                    value = [int(seed) for seed in value]
+                else:
+                    dtype = torch.long if name == 'top_k' else torch.float
+                    value = torch.as_tensor(value, dtype=dtype, device=self.device)
+            generation_params[key] = value
+        seed = generation_params.pop('seed')
+        generators = None
+        if seed is not None:
+            seeds = seed if isinstance(seed, list) else [seed + idx for idx in range(num_samples)]
+            generators = [torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]
+        generation_params['generators'] = generators
+        return generation_params, duration, extend_stride
+
+    def set_draft_model(self, draft: tp.Optional['MusicGen'] = None, num_draft_steps: int = 4):
+        """Use speculative decoding, with the language model of `draft` proposing `num_draft_steps`
+        steps at a time, which this model then verifies in a single forward. The generated tokens follow
+        the same distribution as without a draft. `draft` should be a smaller model sharing the same
+        compression model, e.g. `small` for `large`. Pass None to disable.
+        """
+        if draft is not None:
+            assert draft.frame_rate == self.frame_rate and draft.sample_rate == self.sample_rate, \
+                "The draft model should use the same compression model."
+            assert num_draft_steps > 0
+        self.draft_lm = None if draft is None else draft.lm
+        self.num_draft_steps = num_draft_steps
+
+    def set_decoding_params(self, chunk_duration: tp.Optional[float] = None, overlap_duration: float = 1.,
+                            num_workers: int = 0):
+        """Decode the generated tokens into audio by chunks, so that the memory used by the compression model
+        does not grow with the duration, see `CompressionModel.decode_chunked`. Not used by `generate_stream`.
+
+        Args:
+            chunk_duration (float, optional): Duration in seconds of the chunks. If None, the tokens
+                are decoded all at once.
+            overlap_duration (float): Duration in seconds over which consecutive chunks are crossfaded.
+            num_workers (int): Number of chunks decoded in parallel threads, only on CPU.
+        """
+        if chunk_duration is not None:
+            assert 0 <= overlap_duration < chunk_duration
+        self.decode_chunk_duration = chunk_duration
+        self.decode_overlap_duration = overlap_duration
+        self.decode_num_workers = num_workers
+
     def set_custom_progress_callback(self, progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None):
         """Override the default progress callback."""
         self._progress_callback = progress_callback
 
-    def generate_unconditional(self, num_samples: int, progress: bool = False) -> torch.Tensor:
+    def generate_unconditional(self, num_samples: int, progress: bool = False, **params) -> torch.Tensor:
         """Generate samples in an unconditional manner.
 
         Args:
             num_samples (int): Number of samples to be generated.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            **params: Generation parameters for this call only, overriding the ones set with
+                `set_generation_params` and using the same names. `temperature`, `top_k`, `top_p`,
+                `cfg_coef` and `seed` can also be given as lists with one value per sample.
         """
         descriptions: tp.List[tp.Optional[str]] = [None] * num_samples
         attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, None)
-        return self._generate_tokens(attributes, prompt_tokens, progress)
+        return self._generate_tokens(attributes, prompt_tokens, progress, **params)
 
-    def generate(self, descriptions: tp.List[str], progress: bool = False) -> torch.Tensor:
+    def generate(self, descriptions: tp.List[str], progress: bool = False, **params) -> torch.Tensor:
         """Generate samples conditioned on text.
 
         Args:
             descriptions (tp.List[str]): A list of strings used as text conditioning.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            **params: Generation parameters for this call only, overriding the ones set with
+                `set_generation_params` and using the same names. `temperature`, `top_k`, `top_p`,
+                `cfg_coef` and `seed` can also be given as lists with one value per sample.
         """
         attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, None)
         assert prompt_tokens is None
-        return self._generate_tokens(attributes, prompt_tokens, progress)
+        return self._generate_tokens(attributes, prompt_tokens, progress, **params)
 
     def generate_with_chroma(self, descriptions: tp.List[str], melody_wavs: MelodyType,
-                             melody_sample_rate: int, progress: bool = False) -> torch.Tensor:
+                             melody_sample_rate: int, progress: bool = False, **params) -> torch.Tensor:
         """Generate samples conditioned on text and melody.
 
         Args:
@@ -173,6 +285,9 @@ class MusicGen:
                 a list of [C, T] tensors.
             melody_sample_rate: (int): Sample rate of the melody waveforms.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            **params: Generation parameters for this call only, overriding the ones set with
+                `set_generation_params` and using the same names. `temperature`, `top_k`, `top_p`,
+                `cfg_coef` and `seed` can also be given as lists with one value per sample.
         """
         if isinstance(melody_wavs, torch.Tensor):
             if melody_wavs.dim() == 2:
@@ -192,43 +307,65 @@ class MusicGen:
         attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions=descriptions, prompt=None,
                                                                         melody_wavs=melody_wavs)
         assert prompt_tokens is None
-        return self._generate_tokens(attributes, prompt_tokens, progress)
+        return self._generate_tokens(attributes, prompt_tokens, progress, **params)
 
-    def generate_continuation(self, prompt: torch.Tensor, prompt_sample_rate: int,
+    def generate_continuation(self, prompt: PromptType, prompt_sample_rate: int,
                               descriptions: tp.Optional[tp.List[tp.Optional[str]]] = None,
-                              progress: bool = False) -> torch.Tensor:
+                              progress: bool = False, prompt_lengths: tp.Optional[tp.Sequence[int]] = None,
+                              **params) -> torch.Tensor:
         """Generate samples conditioned on audio prompts.
 
+        Prompts of different lengths are encoded together, and each sample continues its own prompt,
+        the generation starting after the shortest one, see `CompressionModel.encode_batch`.
+
         Args:
-            prompt (torch.Tensor): A batch of waveforms used for continuation.
-                Prompt should be [B, C, T], or [C, T] if only one sample is generated.
+            prompt (torch.Tensor or list of Tensor): A batch of waveforms used for continuation.
+                Prompt should be [B, C, T], or [C, T] if only one sample is generated,
+                or a list of [C, T] waveforms of different lengths.
             prompt_sample_rate (int): Sampling rate of the given audio waveforms.
             descriptions (tp.List[str], optional): A list of strings used as text conditioning. Defaults to None.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            prompt_lengths (tp.Sequence[int], optional): Number of samples of each prompt of a [B, C, T] batch,
+                the rest being padding. Defaults to None, for prompts of length T.
+            **params: Generation parameters for this call only, overriding the ones set with
+                `set_generation_params` and using the same names. `temperature`, `top_k`, `top_p`,
+                `cfg_coef` and `seed` can also be given as lists with one value per sample.
         """
-        if prompt.dim() == 2:
-            prompt = prompt[None]
-        if prompt.dim() != 3:
-            raise ValueError("prompt should have 3 dimensions: [B, C, T] (C = 1).")
-        prompt = convert_audio(prompt, prompt_sample_rate, self.sample_rate, self.audio_channels)
+        if isinstance(prompt, torch.Tensor):
+            if prompt.dim() == 2:
+                prompt = prompt[None]
+            if prompt.dim() != 3:
+                raise ValueError("prompt should have 3 dimensions: [B, C, T] (C = 1).")
+            if prompt_lengths is not None:
+                if len(prompt_lengths) != len(prompt):
+                    raise ValueError("prompt_lengths should have one length per prompt.")
+                prompt = [wav[..., :length] for wav, length in zip(prompt, prompt_lengths)]
+        elif prompt_lengths is not None:
+            raise ValueError("prompt_lengths is only supported with a [B, C, T] prompt.")
+        if isinstance(prompt, torch.Tensor):
+            prompt = convert_audio(prompt, prompt_sample_rate, self.sample_rate, self.audio_channels)
+        else:
+            prompt = [convert_audio(wav, prompt_sample_rate, self.sample_rate, self.audio_channels) for wav in prompt]
         if descriptions is None:
             descriptions = [None] * len(prompt)
         attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, prompt)
         assert prompt_tokens is not None
-        return self._generate_tokens(attributes, prompt_tokens, progress)
+        return self._generate_tokens(attributes, prompt_tokens, progress, **params)
 
     @torch.no_grad()
     def _prepare_tokens_and_attributes(
             self,
             descriptions: tp.Sequence[tp.Optional[str]],
-            prompt: tp.Optional[torch.Tensor],
+            prompt: tp.Optional[PromptType],
             melody_wavs: tp.Optional[MelodyList] = None,
     ) -> tp.Tuple[tp.List[ConditioningAttributes], tp.Optional[torch.Tensor]]:
         """Prepare model inputs.
 
         Args:
             descriptions (tp.List[str]): A list of strings used as text conditioning.
-            prompt (torch.Tensor): A batch of waveforms used for continuation.
+            prompt (torch.Tensor or list of Tensor): A batch of waveforms used for continuation,
+                or a list of waveforms of different lengths, whose tokens are padded with -1,
+                see `LMModel.generate`.
             melody_wavs (tp.Optional[torch.Tensor], optional): A batch of waveforms
                 used as melody conditioning. Defaults to None.
         """
@@ -263,26 +400,201 @@ class MusicGen:
         if prompt is not None:
             if descriptions is not None:
                 assert len(descriptions) == len(prompt), "Prompt and nb. descriptions doesn't match"
-            prompt = prompt.to(self.device)
-            prompt_tokens, scale = self.compression_model.encode(prompt)
+            if isinstance(prompt, torch.Tensor):
+                prompt_tokens, scale = self.compression_model.encode(prompt.to(self.device))
+            else:
+                codes, scale = self.compression_model.encode_batch([wav.to(self.device) for wav in prompt])
+                prompt_tokens = torch.full((len(codes), codes[0].shape[0], max(c.shape[-1] for c in codes)),
+                                           -1, dtype=torch.long, device=self.device)
+                for item, item_codes in zip(prompt_tokens, codes):
+                    item[..., :item_codes.shape[-1]] = item_codes
             assert scale is None
         else:
             prompt_tokens = None
         return attributes, prompt_tokens
 
+    def generate_stream(self, descriptions: tp.List[str], progress: bool = False, chunk_duration: float = 1.,
+                        context_duration: float = 1., lookahead_duration: float = 0.2,
+                        **params) -> tp.Iterator[torch.Tensor]:
+        """Generate samples conditioned on text, yielding the audio by chunks while it is being generated.
+
+        Each chunk is decoded as soon as its tokens are available, along with some past tokens
+        as context and a few future tokens as lookahead, so that the concatenation of the chunks
+        stays close to decoding the whole sequence at once.
+
+        Args:
+            descriptions (tp.List[str]): A list of strings used as text conditioning.
+            progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            chunk_duration (float): Duration in seconds of the yielded chunks, except for the last one.
+            context_duration (float): Duration in seconds of the past tokens decoded with each chunk.
+            lookahead_duration (float): Duration in seconds of the future tokens decoded with each chunk.
+            **params: Generation parameters for this call only, overriding the ones set with
+                `set_generation_params` and using the same names. `temperature`, `top_k`, `top_p`,
+                `cfg_coef` and `seed` can also be given as lists with one value per sample.
+        Returns:
+            Iterator[torch.Tensor]: Generated audio chunks, of shape [B, C, T'].
+        """
+        attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, None)
+        assert prompt_tokens is None
+        yield from self._decode_stream(self._generate_tokens_stream(attributes, prompt_tokens, progress, **params),
+                                       chunk_duration, context_duration, lookahead_duration)
+
+    def _decode_stream(self, tokens_stream: tp.Iterator[torch.Tensor], chunk_duration: float,
+                       context_duration: float, lookahead_duration: float) -> tp.Iterator[torch.Tensor]:
+        """Decode a stream of tokens into a stream of audio chunks, see `generate_stream`."""
+        chunk_frames = max(1, int(chunk_duration * self.frame_rate))
+        context_frames = int(context_duration * self.frame_rate)
+        lookahead_frames = int(lookahead_duration * self.frame_rate)
+        hop_length = self.sample_rate // self.frame_rate
+        all_tokens: tp.List[torch.Tensor] = []
+        num_frames = 0
+        decoded_frames = 0
+
+        def _decode(end: int) -> torch.Tensor:
+            tokens = torch.cat(all_tokens, dim=-1)
+            all_tokens[:] = [tokens]
+            start = max(0, decoded_frames - context_frames)
+            with torch.no_grad(), metrics.stage('compression_decode'):
+                audio = self.compression_model.decode(tokens[..., start:end + lookahead_frames], None)
+            return audio[..., (decoded_frames - start) * hop_length:(end - start) * hop_length]
+
+        for tokens in tokens_stream:
+            all_tokens.append(tokens)
+            num_frames += tokens.shape[-1]
+            while num_frames - lookahead_frames - decoded_frames >= chunk_frames:
+                end = decoded_frames + chunk_frames
+                yield _decode(end)
+                decoded_frames = end
+        if decoded_frames < num_frames:
+            yield _decode(num_frames)
+
     def _generate_tokens(self, attributes: tp.List[ConditioningAttributes],
-                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False) -> torch.Tensor:
+                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False,
+                         **params) -> torch.Tensor:
         """Generate discrete audio tokens given audio prompt and/or conditions.
 
         Args:
             attributes (tp.List[ConditioningAttributes]): Conditions used for generation (text/melody).
             prompt_tokens (tp.Optional[torch.Tensor]): Audio prompt used for continuation.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            **params: Generation parameters overriding the ones of the model, see `generate`.
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
-        total_gen_len = int(self.duration * self.frame_rate)
-        max_prompt_len = int(min(self.duration, self.max_duration) * self.frame_rate)
+        gen_tokens = torch.cat(list(self._generate_tokens_stream(attributes, prompt_tokens, progress, **params)),
+                               dim=-1)
+
+        # generate audio
+        assert gen_tokens.dim() == 3
+        with torch.no_grad(), metrics.stage('compression_decode'):
+            if self.decode_chunk_duration is None:
+                gen_audio = self.compression_model.decode(gen_tokens, None)
+            else:
+                gen_audio = self.compression_model.decode_chunked(
+                    gen_tokens, None, chunk_length=int(self.decode_chunk_duration * self.frame_rate),
+                    overlap=int(self.decode_overlap_duration * self.frame_rate),
+                    num_workers=self.decode_num_workers)
+        return gen_audio
+
+    @torch.no_grad()
+    def _prepare_window_conditions(self, attributes: tp.List[ConditioningAttributes], duration: float,
+                                   two_step_cfg: bool) -> tp.Callable[[float], CFGConditions]:
+        """Compute once the conditions of all the windows of a generation longer than `max_duration`.
+        The text conditions do not depend on the window and are reused as is. The melody is extended
+        periodically if it is not long enough, and each window conditions on the `max_duration` seconds
+        starting at its offset: the stems are separated and the chroma extracted once over the whole melody,
+        each window only slicing its frames, see `ChromaStemConditioner.get_chroma_sequence`.
+
+        Args:
+            attributes (tp.List[ConditioningAttributes]): Conditions used for generation (text/melody).
+            duration (float): Duration of the whole generation, in seconds.
+            two_step_cfg (bool): Whether the conditional and unconditional conditions are kept separate.
+        Returns:
+            Callable: Function returning the conditions of the window starting at the given time
+                in seconds, as expected by `LMModel.generate_stream`.
+        """
+        provider = self.lm.condition_provider
+        conditioner = provider.conditioners['self_wav'] if 'self_wav' in provider.conditioners else None
+        ref_wavs = [attr.wav['self_wav'] for attr in attributes]
+        if not isinstance(conditioner, ChromaStemConditioner) or all(ref.length.item() == 0 for ref in ref_wavs):
+            cfg_conditions = self.lm._get_cfg_conditions(attributes, two_step_cfg)
+            return lambda time_offset: cfg_conditions
+
+        null_attributes = ClassifierFreeGuidanceDropout(p=1.0)(attributes)
+        wav_target_length = int(self.max_duration * self.sample_rate)
+        hop = conditioner.chroma.winhop
+        window_frames = wav_target_length // hop + 1
+        # covers the last window, whatever the rounding of its first frame.
+        sequence_length = int(duration * self.sample_rate) + wav_target_length + hop
+        with metrics.stage('conditioning'):
+            chromas = [
+                None if ref.length.item() == 0 else
+                conditioner.get_chroma_sequence(ref.wav[None, :, :ref.length.item()], sequence_length)[0]
+                for ref in ref_wavs]
+            if two_step_cfg:
+                tokenized = provider.tokenize(attributes)
+                null_conditions = provider(provider.tokenize(null_attributes))
+            else:
+                tokenized = provider.tokenize(attributes + null_attributes)
+            # the melody is the only condition changing with the window.
+            tokenized.pop('self_wav')
+            conditions = provider(tokenized)
+
+        def _get_window_conditions(time_offset: float) -> CFGConditions:
+            start = round(time_offset * self.sample_rate / hop)
+            # the unconditional rows and the ones without melody are entirely masked.
+            num_rows = len(attributes) if two_step_cfg else 2 * len(attributes)
+            chroma = torch.zeros(num_rows, window_frames, conditioner.chroma.n_chroma, device=self.device)
+            lengths = torch.zeros(num_rows, dtype=torch.long, device=self.device)
+            for row, sequence in enumerate(chromas):
+                if sequence is not None:
+                    chroma[row] = sequence[start:start + window_frames]
+                    lengths[row] = wav_target_length
+            window_conditions = {**conditions, 'self_wav': conditioner.forward_chroma(chroma, lengths)}
+            if two_step_cfg:
+                return window_conditions, null_conditions
+            return window_conditions
+
+        return _get_window_conditions
+
+    def _has_melody(self, attributes: tp.List[ConditioningAttributes]) -> bool:
+        # Whether the model uses melody conditioning and any of the attributes has a non null melody.
+        if 'self_wav' not in self.lm.condition_provider.conditioners:
+            return False
+        return any('self_wav' in attr.wav and bool((attr.wav['self_wav'].length > 0).any()) for attr in attributes)
+
+    def _autocast_stream(self, stream: tp.Iterator[torch.Tensor]) -> tp.Iterator[torch.Tensor]:
+        """Run each step of the stream under autocast, but not the consumer code in between."""
+        while True:
+            with self.autocast:
+                tokens = next(stream, None)
+            if tokens is None:
+                return
+            yield tokens
+
+    def _generate_tokens_stream(self, attributes: tp.List[ConditioningAttributes],
+                                prompt_tokens: tp.Optional[torch.Tensor],
+                                progress: bool = False, **params) -> tp.Iterator[torch.Tensor]:
+        """Generate discrete audio tokens given audio prompt and/or conditions, yielding them as soon
+        as all the codebooks of a timestep are generated. The prompt tokens are yielded first.
+
+        Args:
+            attributes (tp.List[ConditioningAttributes]): Conditions used for generation (text/melody).
+            prompt_tokens (tp.Optional[torch.Tensor]): Audio prompt used for continuation.
+            progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            **params: Generation parameters overriding the ones of the model, see `generate`.
+        Returns:
+            Iterator[torch.Tensor]: Generated tokens, of shape [B, K, T'], concatenating them along
+                the last dimension gives the tokens for the whole duration.
+        """
+        generation_params, duration, extend_stride = self._get_generation_params(len(attributes), **params)
+        sliding_window = generation_params.pop('sliding_window')
+        if sliding_window and duration > self.max_duration and self._has_melody(attributes):
+            # the chroma is computed once, and cut to the duration seen in training.
+            raise ValueError("Sliding windows are not supported with melody conditioning, "
+                             "the melody would only condition the first `max_duration` seconds.")
+        total_gen_len = int(duration * self.frame_rate)
+        max_prompt_len = int(min(duration, self.max_duration) * self.frame_rate)
         current_gen_offset: int = 0
 
         def _progress_callback(generated_tokens: int, tokens_to_generate: int):
@@ -302,61 +614,49 @@ class MusicGen:
         if progress:
             callback = _progress_callback
 
-        if self.duration <= self.max_duration:
-            # generate by sampling from LM, simple case.
-            with self.autocast:
-                gen_tokens = self.lm.generate(
-                    prompt_tokens, attributes,
-                    callback=callback, max_gen_len=total_gen_len, **self.generation_params)
+        if duration <= self.max_duration or sliding_window:
+            # generate by sampling from LM, simple case. Past the maximum duration,
+            # each step only attends to the steps of the previous `max_duration` seconds.
+            past_context = None
+            if duration > self.max_duration:
+                past_context = int(self.max_duration * self.frame_rate)
+            yield from self._autocast_stream(self.lm.generate_stream(
+                prompt_tokens, attributes,
+                callback=callback, max_gen_len=total_gen_len, draft=self.draft_lm,
+                num_draft_steps=self.num_draft_steps, past_context=past_context, **generation_params))
 
         else:
             # now this gets a bit messier, we need to handle prompts,
             # melody conditioning etc.
-            ref_wavs = [attr.wav['self_wav'] for attr in attributes]
-            all_tokens = []
+            with self.autocast:
+                get_window_conditions = self._prepare_window_conditions(
+                    attributes, duration, generation_params['two_step_cfg'])
             if prompt_tokens is None:
                 prompt_length = 0
             else:
-                all_tokens.append(prompt_tokens)
+                # the tokens past the shortest prompt are yielded with the first window.
+                yield prompt_tokens[..., :self.lm.get_prompt_length(prompt_tokens)]
                 prompt_length = prompt_tokens.shape[-1]
 
-            stride_tokens = int(self.frame_rate * self.extend_stride)
+            stride_tokens = int(self.frame_rate * extend_stride)
 
             while current_gen_offset + prompt_length < total_gen_len:
                 time_offset = current_gen_offset / self.frame_rate
-                chunk_duration = min(self.duration - time_offset, self.max_duration)
+                chunk_duration = min(duration - time_offset, self.max_duration)
                 max_gen_len = int(chunk_duration * self.frame_rate)
-                for attr, ref_wav in zip(attributes, ref_wavs):
-                    wav_length = ref_wav.length.item()
-                    if wav_length == 0:
-                        continue
-                    # We will extend the wav periodically if it not long enough.
-                    # we have to do it here rather than in conditioners.py as otherwise
-                    # we wouldn't have the full wav.
-                    initial_position = int(time_offset * self.sample_rate)
-                    wav_target_length = int(self.max_duration * self.sample_rate)
-                    print(initial_position / self.sample_rate, wav_target_length / self.sample_rate)
-                    positions = torch.arange(initial_position,
-                                             initial_position + wav_target_length, device=self.device)
-                    attr.wav['self_wav'] = WavCondition(
-                        ref_wav[0][:, positions % wav_length],
-                        torch.full_like(ref_wav[1], wav_target_length))
                 with self.autocast:
-                    gen_tokens = self.lm.generate(
-                        prompt_tokens, attributes,
-                        callback=callback, max_gen_len=max_gen_len, **self.generation_params)
-                if prompt_tokens is None:
-                    all_tokens.append(gen_tokens)
-                else:
-                    all_tokens.append(gen_tokens[:, :, prompt_tokens.shape[-1]:])
+                    cfg_conditions = get_window_conditions(time_offset)
+                window_tokens = []
+                for tokens in self._autocast_stream(self.lm.generate_stream(
+                        prompt_tokens, attributes, remove_prompts=True,
+                        callback=callback, max_gen_len=max_gen_len, draft=self.draft_lm,
+                        num_draft_steps=self.num_draft_steps, cfg_conditions=cfg_conditions,
+                        **generation_params)):
+                    window_tokens.append(tokens)
+                    yield tokens
+                if prompt_tokens is not None:
+                    window_tokens.insert(0, prompt_tokens[..., :self.lm.get_prompt_length(prompt_tokens)])
+                gen_tokens = torch.cat(window_tokens, dim=-1)
                 prompt_tokens = gen_tokens[:, :, stride_tokens:]
                 prompt_length = prompt_tokens.shape[-1]
                 current_gen_offset += stride_tokens
-
-            gen_tokens = torch.cat(all_tokens, dim=-1)
-
-        # generate audio
-        assert gen_tokens.dim() == 3
-        with torch.no_grad():
-            gen_audio = self.compression_model.decode(gen_tokens, None)
-        return gen_audio
@@ -0,0 +1,136 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Process-resident registry of pretrained MusicGen models.
+
+Loading a pretrained MusicGen means deserializing the LM checkpoint, rebuilding
+the LM from its config, loading T5 and the EnCodec model. This is far too slow
+to be done per request, so serving code should go through a `ModelRegistry`
+that loads each variant once and keeps it around, evicting the least recently
+used models when a memory budget is exceeded.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+import typing as tp
+
+import torch
+from torch import nn
+
+from .musicgen import MusicGen
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_memory(model: MusicGen) -> int:
+    """Return the number of bytes held by the parameters and buffers of a MusicGen model,
+    including the models used by the conditioners, such as T5 or Demucs, which are kept out
+    of the parameters of the LM so that they are not saved with its checkpoints.
+    """
+    modules: tp.List[nn.Module] = [model.lm, model.compression_model]
+    for conditioner in model.lm.condition_provider.conditioners.values():
+        # registered submodules live in `_modules`, only the hidden ones are attributes.
+        modules += [value for value in vars(conditioner).values() if isinstance(value, nn.Module)]
+    total = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelRegistry:
+    """Registry loading MusicGen models once and handing out shared instances.
+
+    Models are kept resident until the total memory they hold exceeds `memory_budget`,
+    in which case the least recently used ones are evicted. A model that was handed out
+    stays valid for its current users after being evicted, it is only dropped from the registry.
+    Note that the instances are shared, so generation parameters set on them are visible to
+    all users of the same model.
+
+    Args:
+        memory_budget (int, optional): Maximum number of bytes the resident models can hold.
+            No eviction happens if None. The most recently requested model is always kept,
+            even if it is larger than the budget on its own.
+        device (torch.device or str, optional): Device on which to load the models.
+        loader (callable): Function mapping a model name and device to a MusicGen instance.
+    """
+    def __init__(self, memory_budget: tp.Optional[int] = None,
+                 device: tp.Optional[tp.Union[torch.device, str]] = None,
+                 loader: tp.Callable[..., MusicGen] = MusicGen.get_pretrained):
+        self.memory_budget = memory_budget
+        self.device = device
+        self.loader = loader
+        self._models: tp.OrderedDict[str, MusicGen] = OrderedDict()
+        self._sizes: tp.Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._load_locks: tp.Dict[str, threading.Lock] = {}
+
+    def get(self, name: str) -> MusicGen:
+        """Return the model with the given name, loading it if it is not resident yet."""
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Only one thread loads a given model, others wait for it and reuse it.
+        with load_lock:
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name]
+                # If we already know how big this model is, make room before loading it
+                # to avoid holding both the evicted models and the new one in memory.
+                if name in self._sizes:
+                    self._evict(reserve=self._sizes[name])
+            logger.info("Loading model %s", name)
+            model = self.loader(name, device=self.device)
+            with self._lock:
+                self._models[name] = model
+                self._sizes[name] = get_model_memory(model)
+                self._evict()
+            return model
+
+    def _evict(self, reserve: int = 0):
+        # Should be called with `self._lock` held.
+        if self.memory_budget is None:
+            return
+        evicted = False
+        while self._models and self.memory_usage + reserve > self.memory_budget:
+            if not reserve and len(self._models) == 1:
+                # never evict the model we just loaded.
+                break
+            name, _ = self._models.popitem(last=False)
+            logger.info("Evicting model %s to fit in memory budget", name)
+            evicted = True
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, name: str):
+        """Drop the given model from the registry, if resident."""
+        with self._lock:
+            self._models.pop(name, None)
+
+    def clear(self):
+        """Drop all resident models."""
+        with self._lock:
+            self._models.clear()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._models
+
+    @property
+    def loaded_models(self) -> tp.List[str]:
+        """Names of the resident models, from least to most recently used."""
+        return list(self._models.keys())
+
+    @property
+    def memory_usage(self) -> int:
+        """Number of bytes held by the resident models."""
+        return sum(self._sizes[name] for name in self._models)
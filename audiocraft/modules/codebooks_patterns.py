@@ -4,17 +4,21 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import bisect
 from collections import namedtuple
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import lru_cache
 import logging
 import typing as tp
 
 from abc import ABC, abstractmethod
+import numpy as np
 import torch
 
 LayoutCoord = namedtuple('LayoutCoord', ['t', 'q'])  # (timestep, codebook index)
 PatternLayout = tp.List[tp.List[LayoutCoord]]  # Sequence of coordinates
+# All the coordinates of a layout as arrays of sequence steps, timesteps and codebooks, sorted by sequence step.
+PatternCoords = tp.Tuple[np.ndarray, np.ndarray, np.ndarray]
 logger = logging.getLogger(__name__)
 
 
@@ -38,6 +42,11 @@ class Pattern:
         of codebooks across timesteps to an output tensor of shape [B, K, T], using again a special token and a mask
         to fill and specify invalid positions if needed.
     See the dedicated methods for more details.
+
+    The scatter indexes and masks are built with vectorized operations over the coordinates
+    of the layout, and memoized per number of timesteps, validity restriction and device.
+    The coordinates are extracted from the layout once, unless the pattern provider gives them
+    in closed form as ``coords``, which must then match the layout.
     """
     # Pattern layout, for each sequence step, we have a list of coordinates
     # corresponding to the original codebook timestep and position.
@@ -46,6 +55,7 @@ class Pattern:
     layout: PatternLayout
     timesteps: int
     n_q: int
+    coords: tp.Optional[PatternCoords] = field(default=None, repr=False, compare=False)
 
     def __post_init__(self):
         assert len(self.layout) > 0
@@ -53,8 +63,19 @@ class Pattern:
         self._validate_layout()
         self._build_reverted_sequence_scatter_indexes = lru_cache(100)(self._build_reverted_sequence_scatter_indexes)
         self._build_pattern_sequence_scatter_indexes = lru_cache(100)(self._build_pattern_sequence_scatter_indexes)
+        self._build_timesteps_completion_steps = lru_cache(1)(self._build_timesteps_completion_steps)
+        self._build_coords = lru_cache(1)(self._build_coords)
+        self._build_first_steps = lru_cache(1)(self._build_first_steps)
         logger.info("New pattern, time steps: %d, sequence steps: %d", self.timesteps, len(self.layout))
 
+    def _build_coords(self) -> PatternCoords:
+        """Coordinates of the layout as arrays of sequence steps, timesteps and codebooks."""
+        if self.coords is not None:
+            return self.coords
+        coords = [(s, coord.t, coord.q) for s, sequence_coords in enumerate(self.layout) for coord in sequence_coords]
+        steps, timesteps, codebooks = np.array(coords, dtype=np.int64).reshape(-1, 3).T
+        return steps, timesteps, codebooks
+
     def _validate_layout(self):
         """Runs checks on the layout to ensure a valid pattern is defined.
         A pattern is considered invalid if:
@@ -82,10 +103,8 @@ class Pattern:
 
     @property
     def max_delay(self):
-        max_t_in_seq_coords = 0
-        for seq_coords in self.layout[1:]:
-            for coords in seq_coords:
-                max_t_in_seq_coords = max(max_t_in_seq_coords, coords.t + 1)
+        _, timesteps, _ = self._build_coords()
+        max_t_in_seq_coords = int(timesteps.max()) + 1 if len(timesteps) else 0
         return max_t_in_seq_coords - self.timesteps
 
     @property
@@ -111,9 +130,45 @@ class Pattern:
     def get_steps_with_timestep(self, t: int, q: tp.Optional[int] = None) -> tp.List[int]:
         return [step for step, coords in self.get_sequence_coords_with_timestep(t, q)]
 
+    def _build_first_steps(self) -> np.ndarray:
+        """Lookup table of shape [n_q + 1, T'] of the first sequence step with each timestep, for each
+        codebook then for any codebook in the last row, -1 if there is none. T' covers all the timesteps
+        of the layout, which can go beyond `timesteps` with delays.
+        """
+        steps, timesteps, codebooks = self._build_coords()
+        num_timesteps = max(self.timesteps, int(timesteps.max()) if len(timesteps) else 0) + 1
+        no_step = len(self.layout)
+        first_steps = np.full((self.n_q + 1, num_timesteps), no_step, dtype=np.int64)
+        np.minimum.at(first_steps, (codebooks, timesteps), steps)
+        first_steps[-1] = first_steps[:-1].min(axis=0)
+        first_steps[first_steps == no_step] = -1
+        return first_steps
+
     def get_first_step_with_timesteps(self, t: int, q: tp.Optional[int] = None) -> tp.Optional[int]:
-        steps_with_timesteps = self.get_steps_with_timestep(t, q)
-        return steps_with_timesteps[0] if len(steps_with_timesteps) > 0 else None
+        assert t <= self.timesteps, "provided timesteps is greater than the pattern's number of timesteps"
+        if q is not None:
+            assert q <= self.n_q, "provided number of codebooks is greater than the pattern's number of codebooks"
+        if q == self.n_q:
+            return None
+        step = int(self._build_first_steps()[-1 if q is None else q, t])
+        return step if step >= 0 else None
+
+    def _build_timesteps_completion_steps(self) -> tp.List[int]:
+        """For each timestep t, the first sequence step at which all the timesteps up to t
+        are fully defined, i.e. all their codebooks have been laid out in the sequence.
+        """
+        steps, timesteps, _ = self._build_coords()
+        last_steps = np.zeros(self.timesteps, dtype=np.int64)
+        valid = timesteps < self.timesteps
+        np.maximum.at(last_steps, timesteps[valid], steps[valid])
+        return np.maximum.accumulate(last_steps).tolist()
+
+    def get_num_complete_timesteps(self, step: int) -> int:
+        """Number of leading timesteps for which all codebooks are defined once the sequence
+        has been filled up to the sequence step `step` included. This is what allows streaming
+        the codes while the sequence is being generated.
+        """
+        return bisect.bisect_right(self._build_timesteps_completion_steps(), step)
 
     def _build_pattern_sequence_scatter_indexes(self, timesteps: int, n_q: int, keep_only_valid_steps: bool,
                                                 device: tp.Union[torch.device, str] = 'cpu'):
@@ -131,23 +186,21 @@ class Pattern:
         assert timesteps <= self.timesteps, "invalid number of timesteps used to build the sequence from the pattern"
         # use the proper layout based on whether we limit ourselves to valid steps only or not,
         # note that using the valid_layout will result in a truncated sequence up to the valid steps
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, len(ref_layout), dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, len(ref_layout), dtype=torch.bool).numpy()
+        sequence_steps = len(self.layout) - self.max_delay if keep_only_valid_steps else len(self.layout)
         # fill indexes with last sequence step value that will correspond to our special token
         # the last value is n_q * timesteps as we have flattened z and append special token as the last token
         # which will correspond to the index: n_q * timesteps
-        indexes[:] = n_q * timesteps
-        # iterate over the pattern and fill scattered indexes and mask
-        for s, sequence_coords in enumerate(ref_layout):
-            for coords in sequence_coords:
-                if coords.t < timesteps:
-                    indexes[coords.q, s] = coords.t + coords.q * timesteps
-                    mask[coords.q, s] = 1
-        indexes = torch.from_numpy(indexes).to(device)
-        mask = torch.from_numpy(mask).to(device)
-        return indexes, mask
+        indexes = np.full((n_q, sequence_steps), n_q * timesteps, dtype=np.int64)
+        mask = np.zeros((n_q, sequence_steps), dtype=bool)
+        # scatter all the coordinates of the pattern at once
+        steps, coords_t, coords_q = self._build_coords()
+        keep = (steps < sequence_steps) & (coords_t < timesteps)
+        steps, coords_t, coords_q = steps[keep], coords_t[keep], coords_q[keep]
+        indexes[coords_q, steps] = coords_t + coords_q * timesteps
+        mask[coords_q, steps] = True
+        indexes_tensor = torch.from_numpy(indexes).to(device)
+        mask_tensor = torch.from_numpy(mask).to(device)
+        return indexes_tensor, mask_tensor
 
     def build_pattern_sequence(self, z: torch.Tensor, special_token: int, keep_only_valid_steps: bool = False):
         """Build sequence corresponding to the pattern from the input tensor z.
@@ -194,33 +247,33 @@ class Pattern:
             torch.Tensor: Indexes for reconstructing the output, of shape [K, T].
             mask (torch.Tensor): Mask corresponding to indexes that matches valid indexes of shape [K, T].
         """
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
+        layout_steps = len(self.layout) - self.max_delay if keep_only_valid_steps else len(self.layout)
         # TODO(jade): Do we want to further truncate to only valid timesteps here as well?
         timesteps = self.timesteps
         assert n_q == self.n_q, f"invalid number of codebooks for the sequence and the pattern: {n_q} != {self.n_q}"
-        assert sequence_steps <= len(ref_layout), \
-            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {len(ref_layout)}"
+        assert sequence_steps <= layout_steps, \
+            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {layout_steps}"
 
+        # fill indexes with last sequence step value that will correspond to our special token
+        indexes = np.full((n_q, timesteps), n_q * sequence_steps, dtype=np.int64)
+        mask = np.zeros((n_q, timesteps), dtype=bool)
+        steps, coords_t, coords_q = self._build_coords()
+        keep = (steps < layout_steps) & (coords_t < timesteps)
+        steps, coords_t, coords_q = steps[keep], coords_t[keep], coords_q[keep]
         # ensure we take the appropriate indexes to keep the model output from the first special token as well
         if is_model_output:
-            ref_layout = ref_layout[1:]
-
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, timesteps, dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, timesteps, dtype=torch.bool).numpy()
-        # fill indexes with last sequence step value that will correspond to our special token
-        indexes[:] = n_q * sequence_steps
-        for s, sequence_codes in enumerate(ref_layout):
-            if s < sequence_steps:
-                for code in sequence_codes:
-                    if code.t < timesteps:
-                        indexes[code.q, code.t] = s + code.q * sequence_steps
-                        mask[code.q, code.t] = 1
-        indexes = torch.from_numpy(indexes).to(device)
-        mask = torch.from_numpy(mask).to(device)
-        return indexes, mask
-
-    def revert_pattern_sequence(self, s: torch.Tensor, special_token: int, keep_only_valid_steps: bool = False):
+            steps = steps - 1
+        keep = steps < sequence_steps
+        steps, coords_t, coords_q = steps[keep], coords_t[keep], coords_q[keep]
+        # scatter all the coordinates of the pattern at once, the later steps win for duplicated coordinates
+        indexes[coords_q, coords_t] = steps + coords_q * sequence_steps
+        mask[coords_q, coords_t] = True
+        indexes_tensor = torch.from_numpy(indexes).to(device)
+        mask_tensor = torch.from_numpy(mask).to(device)
+        return indexes_tensor, mask_tensor
+
+    def revert_pattern_sequence(self, s: torch.Tensor, special_token: int, keep_only_valid_steps: bool = False,
+                                timesteps: tp.Optional[slice] = None):
         """Revert a sequence built from the pattern back to the original multi-codebook sequence without interleaving.
         The sequence is reverted using up to timesteps if specified, and non-pattern coordinates
         are filled with the special token.
@@ -228,6 +281,8 @@ class Pattern:
         Args:
             s (torch.Tensor): Interleaved sequence tensor obtained from the pattern, of shape [B, K, S].
             special_token (int or float): Special token used to fill non-pattern coordinates in the new sequence.
+            timesteps (slice, optional): Only revert these timesteps, so that reverting a few timesteps
+                does not cost as much as reverting the whole sequence.
         Returns:
             values (torch.Tensor): Interleaved sequence matching the pattern, of shape [B, K, T] with T
                 corresponding either to the timesteps if provided, or the total timesteps in pattern otherwise.
@@ -238,11 +293,12 @@ class Pattern:
         indexes, mask = self._build_reverted_sequence_scatter_indexes(
             S, K, keep_only_valid_steps, is_model_output=False, device=str(s.device)
         )
-        s = s.view(B, -1)
-        # we append the special token as the last index of our flattened z tensor
-        s = torch.cat([s, torch.zeros_like(s[:, :1]) + special_token], dim=1)
-        values = s[:, indexes.view(-1)]
-        values = values.view(B, K, indexes.shape[-1])
+        if timesteps is not None:
+            indexes, mask = indexes[:, timesteps], mask[:, timesteps]
+        # the last index of the flattened sequence, past its end, stands for the special token
+        special = indexes == K * S
+        values = s.reshape(B, -1)[:, indexes.clamp(max=K * S - 1).view(-1)]
+        values = values.view(B, K, indexes.shape[-1]).masked_fill(special, special_token)
         return values, indexes, mask
 
     def revert_pattern_logits(self, logits: torch.Tensor, special_token: float, keep_only_valid_steps: bool = False):
@@ -257,7 +313,7 @@ class Pattern:
         """
         B, card, K, S = logits.shape
         indexes, mask = self._build_reverted_sequence_scatter_indexes(
-            S, K, keep_only_valid_steps, is_model_output=True, device=logits.device
+            S, K, keep_only_valid_steps, is_model_output=True, device=str(logits.device)
         )
         logits = logits.reshape(B, card, -1)
         # we append the special token as the last index of our flattened z tensor
@@ -350,7 +406,26 @@ class DelayedPatternProvider(CodebooksPatternProvider):
                 if t_for_q >= self.flatten_first:
                     v.append(LayoutCoord(t_for_q, q))
             out.append(v)
-        return Pattern(out, n_q=self.n_q, timesteps=timesteps)
+        return Pattern(out, n_q=self.n_q, timesteps=timesteps, coords=self._get_coords(timesteps))
+
+    def _get_coords(self, timesteps: int) -> PatternCoords:
+        """Coordinates of the pattern in closed form, see `Pattern.coords`."""
+        delays = np.array(self.delays, dtype=np.int64)
+        flatten_first = min(timesteps, self.flatten_first)
+        # flattened timesteps, one codebook per step, after the initial steps.
+        flat_t, flat_q = np.divmod(np.arange(flatten_first * self.n_q, dtype=np.int64), self.n_q)
+        flat_s = 1 + self.empty_initial + flat_t * self.n_q + flat_q
+        # then the delayed timesteps, each codebook going up to timesteps + max_delay - delay.
+        first_step = 1 + self.empty_initial + flatten_first * self.n_q - self.flatten_first
+        lengths = np.maximum(timesteps + delays.max() - delays - self.flatten_first, 0)
+        delayed_q = np.repeat(np.arange(self.n_q, dtype=np.int64), lengths)
+        delayed_t = np.arange(len(delayed_q), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        delayed_t += self.flatten_first
+        delayed_s = first_step + delayed_t + delays[delayed_q]
+        steps, coords_t, coords_q = [np.concatenate(values) for values in [
+            (flat_s, delayed_s), (flat_t, delayed_t), (flat_q, delayed_q)]]
+        order = np.lexsort((coords_q, steps))
+        return steps[order], coords_t[order], coords_q[order]
 
 
 class ParallelPatternProvider(DelayedPatternProvider):
@@ -450,6 +450,10 @@ class WaveformConditioner(BaseConditioner):
         wav, lengths, path = inputs
         with torch.no_grad():
             embeds = self._get_wav_embedding(wav)
+        return self._project(embeds, lengths)
+
+    def _project(self, embeds: Tensor, lengths: tp.Optional[Tensor]) -> ConditionType:
+        """Project the dense vector of conditions and mask it according to the lengths of the waveforms."""
         embeds = embeds.to(self.output_proj.weight)
         embeds = self.output_proj(embeds)
 
@@ -529,7 +533,9 @@ class ChromaStemConditioner(WaveformConditioner):
             return self.chroma(wav)
         stems = self._get_filtered_wav(wav)
         chroma = self.chroma(stems)
+        return self._match_chroma_len(chroma)
 
+    def _match_chroma_len(self, chroma: Tensor) -> Tensor:
         if self.match_len_on_eval:
             b, t, c = chroma.shape
             if t > self.chroma_len:
@@ -543,6 +549,33 @@ class ChromaStemConditioner(WaveformConditioner):
                 logger.debug(f'chroma was zero-padded! ({t} -> {chroma.shape[1]})')
         return chroma
 
+    @torch.no_grad()
+    def get_chroma_sequence(self, wav: Tensor, length: int) -> Tensor:
+        """Chroma of the melody stems of `wav`, repeated periodically over `length` samples.
+        The stems are only separated once over the whole `wav`, so that the windows of a long generation
+        can slice their chroma from the output, see `forward_chroma`, instead of running Demucs on each.
+
+        Args:
+            wav (Tensor): Waveforms of shape [B, C, T].
+            length (int): Number of samples to cover.
+        Returns:
+            Tensor: Chroma of shape [B, T', n_chroma], with one frame every `self.chroma.winhop` samples.
+        """
+        stems = self._get_filtered_wav(wav)
+        positions = torch.arange(length, device=stems.device)
+        return self.chroma(stems[..., positions % stems.shape[-1]])
+
+    def forward_chroma(self, chroma: Tensor, lengths: Tensor) -> ConditionType:
+        """Same as `forward`, but from chroma already computed, e.g. sliced from `get_chroma_sequence`.
+
+        Args:
+            chroma (Tensor): Chroma of shape [B, T', n_chroma].
+            lengths (Tensor): Lengths in samples of the waveforms covered by the chroma.
+        Returns:
+            ConditionType: Dense vector representing the conditioning along with its' mask.
+        """
+        return self._project(self._match_chroma_len(chroma), lengths)
+
 
 class ChromaExtractor(nn.Module):
     """Chroma extraction class, handles chroma extraction and quantization.
@@ -988,3 +1021,17 @@ class ConditionFuser(StreamingModule):
             self._streaming_state['offsets'] = offsets + T
 
         return input, cross_attention_output
+
+    def get_cross_attention_mask(self, conditions: tp.Dict[str, ConditionType]) -> tp.Optional[Tensor]:
+        """Return the mask of the cross attention source built by `forward`, of shape [B, T],
+        True for the positions to attend to, or None if no cross attention inputs exist.
+        The padding of the conditions is left out, so that the output for each item does not depend
+        on the other items of the batch. The items without any valid position, e.g. null conditions,
+        only attend to their first position.
+        """
+        masks = [mask for cond_type, (_, mask) in conditions.items() if self.cond2fuse[cond_type] == "cross"]
+        if not masks:
+            return None
+        mask = torch.cat(masks, dim=1).bool()
+        mask[:, 0] |= ~mask.any(dim=1)
+        return mask
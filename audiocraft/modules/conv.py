@@ -13,6 +13,8 @@ from torch import nn
 from torch.nn import functional as F
 from torch.nn.utils import spectral_norm, weight_norm
 
+from .streaming import StreamingModule
+
 
 CONV_NORMALIZATIONS = frozenset(['none', 'weight_norm', 'spectral_norm',
                                  'time_group_norm'])
@@ -48,7 +50,10 @@ def get_extra_padding_for_conv1d(x: torch.Tensor, kernel_size: int, stride: int,
                                  padding_total: int = 0) -> int:
     """See `pad_for_conv1d`.
     """
-    length = x.shape[-1]
+    return _get_extra_padding(x.shape[-1], kernel_size, stride, padding_total)
+
+
+def _get_extra_padding(length: int, kernel_size: int, stride: int, padding_total: int = 0) -> int:
     n_frames = (length - kernel_size + padding_total) / stride + 1
     ideal_length = (math.ceil(n_frames) - 1) * stride + (kernel_size - padding_total)
     return ideal_length - length
@@ -164,9 +169,14 @@ class NormConvTranspose2d(nn.Module):
         return x
 
 
-class StreamableConv1d(nn.Module):
+class StreamableConv1d(StreamingModule):
     """Conv1d with some builtin handling of asymmetric or causal padding
     and normalization.
+
+    In streaming mode, the input is given by chunks, and the output frames are returned as soon as
+    their whole window is available. The samples that are still needed by the next frames are kept,
+    and the right padding is only added with `flush`, once the whole input has been given,
+    so that the concatenated outputs match the output on the whole input.
     """
     def __init__(self, in_channels: int, out_channels: int,
                  kernel_size: int, stride: int = 1, dilation: int = 1,
@@ -184,28 +194,103 @@ class StreamableConv1d(nn.Module):
         self.causal = causal
         self.pad_mode = pad_mode
 
-    def forward(self, x):
-        B, C, T = x.shape
+    def _get_padding(self) -> tp.Tuple[int, int, int, int]:
+        """Return the effective kernel size, stride, and the left and right padding."""
         kernel_size = self.conv.conv.kernel_size[0]
         stride = self.conv.conv.stride[0]
         dilation = self.conv.conv.dilation[0]
         kernel_size = (kernel_size - 1) * dilation + 1  # effective kernel size with dilations
         padding_total = kernel_size - stride
-        extra_padding = get_extra_padding_for_conv1d(x, kernel_size, stride, padding_total)
         if self.causal:
             # Left padding for causal
-            x = pad1d(x, (padding_total, extra_padding), mode=self.pad_mode)
-        else:
-            # Asymmetric padding required for odd strides
-            padding_right = padding_total // 2
-            padding_left = padding_total - padding_right
-            x = pad1d(x, (padding_left, padding_right + extra_padding), mode=self.pad_mode)
-        return self.conv(x)
+            return kernel_size, stride, padding_total, 0
+        # Asymmetric padding required for odd strides
+        padding_right = padding_total // 2
+        return kernel_size, stride, padding_total - padding_right, padding_right
 
+    def get_output_length(self, lengths: torch.Tensor) -> torch.Tensor:
+        """Return the number of output frames for inputs of the given lengths, outside of streaming mode."""
+        stride = self.conv.conv.stride[0]
+        # the extra padding completes the last window.
+        return -(-lengths // stride)
 
-class StreamableConvTranspose1d(nn.Module):
+    def forward(self, x):
+        if self._is_streaming:
+            return self._streaming_forward(x)
+        return self._forward(x)
+
+    def _forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, C, T = x.shape
+        kernel_size, stride, padding_left, padding_right = self._get_padding()
+        extra_padding = get_extra_padding_for_conv1d(x, kernel_size, stride, padding_left + padding_right)
+        x = pad1d(x, (padding_left, padding_right + extra_padding), mode=self.pad_mode)
+        return self.conv(x)
+
+    def _conv_frames(self, x: torch.Tensor) -> torch.Tensor:
+        # convolves all the full windows of `x`, and keeps the samples still needed by the next ones.
+        kernel_size, stride, _, _ = self._get_padding()
+        num_frames = max(0, (x.shape[-1] - kernel_size) // stride + 1)
+        self._streaming_state['previous'] = x[..., num_frames * stride:]
+        if num_frames == 0:
+            return x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0)
+        return self.conv(x[..., :(num_frames - 1) * stride + kernel_size])
+
+    def _streaming_forward(self, x: torch.Tensor) -> torch.Tensor:
+        assert self.conv.norm_type != 'time_group_norm', "GroupNorm doesn't support streaming."
+        assert self.pad_mode in ['constant', 'reflect', 'replicate'], \
+            f"Padding mode {self.pad_mode} doesn't support streaming."
+        state = self._streaming_state
+        kernel_size, stride, padding_left, padding_right = self._get_padding()
+        state['length'] = state.get('length', 0) + x.shape[-1]
+        if self.pad_mode != 'constant':
+            # the right padding depends on the last samples of the whole input.
+            history = x if 'history' not in state else torch.cat([state['history'], x], dim=-1)
+            state['history'] = history[..., -(padding_right + stride):]
+        if 'previous' in state:
+            x = torch.cat([state['previous'], x], dim=-1)
+        if not state.get('started', False):
+            if self.pad_mode != 'constant' and x.shape[-1] <= padding_left:
+                # the left padding depends on the first samples, wait until there are enough.
+                state['previous'] = x
+                return x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0)
+            x = pad1d(x, (padding_left, 0), mode=self.pad_mode)
+            state['started'] = True
+        return self._conv_frames(x)
+
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        """Return the last frames in streaming mode, once the whole input has been given,
+        with the right padding added. `x` is first processed if given.
+        """
+        outputs = [] if x is None else [self(x)]
+        state = self._streaming_state
+        if 'length' not in state:
+            return outputs[0] if outputs else None
+        kernel_size, stride, padding_left, padding_right = self._get_padding()
+        previous = state.pop('previous')
+        if not state.pop('started', False):
+            # the whole input was too short to start, which is the same as not streaming.
+            outputs.append(self._forward(previous))
+        else:
+            extra_padding = _get_extra_padding(state['length'], kernel_size, stride, padding_left + padding_right)
+            right = padding_right + extra_padding
+            if self.pad_mode == 'constant':
+                padding = previous.new_zeros(*previous.shape[:-1], right)
+            else:
+                history = state['history']
+                padding = pad1d(history, (0, right), mode=self.pad_mode)[..., history.shape[-1]:]
+            outputs.append(self._conv_frames(torch.cat([previous, padding], dim=-1)))
+        state.clear()
+        return torch.cat(outputs, dim=-1)
+
+
+class StreamableConvTranspose1d(StreamingModule):
     """ConvTranspose1d with some builtin handling of asymmetric or causal padding
     and normalization.
+
+    In streaming mode, the input is given by chunks, and the output samples are returned as soon as
+    no further input frame can contribute to them. The tail of the output of each chunk, which overlaps
+    with the output of the next frames, is kept to be added to it, and is only returned with `flush`,
+    so that the concatenated outputs match the output on the whole input.
     """
     def __init__(self, in_channels: int, out_channels: int,
                  kernel_size: int, stride: int = 1, causal: bool = False,
@@ -220,26 +305,66 @@ class StreamableConvTranspose1d(nn.Module):
             "`trim_right_ratio` != 1.0 only makes sense for causal convolutions"
         assert self.trim_right_ratio >= 0. and self.trim_right_ratio <= 1.
 
-    def forward(self, x):
+    def _get_padding(self) -> tp.Tuple[int, int]:
+        """Return the padding to trim on the left and on the right."""
         kernel_size = self.convtr.convtr.kernel_size[0]
         stride = self.convtr.convtr.stride[0]
         padding_total = kernel_size - stride
-
-        y = self.convtr(x)
-
-        # We will only trim fixed padding. Extra padding from `pad_for_conv1d` would be
-        # removed at the very end, when keeping only the right length for the output,
-        # as removing it here would require also passing the length at the matching layer
-        # in the encoder.
         if self.causal:
             # Trim the padding on the right according to the specified ratio
             # if trim_right_ratio = 1.0, trim everything from right
             padding_right = math.ceil(padding_total * self.trim_right_ratio)
-            padding_left = padding_total - padding_right
-            y = unpad1d(y, (padding_left, padding_right))
         else:
             # Asymmetric padding required for odd strides
             padding_right = padding_total // 2
-            padding_left = padding_total - padding_right
-            y = unpad1d(y, (padding_left, padding_right))
-        return y
+        return padding_total - padding_right, padding_right
+
+    def forward(self, x):
+        if self._is_streaming:
+            return self._streaming_forward(x)
+        y = self.convtr(x)
+
+        # We will only trim fixed padding. Extra padding from `pad_for_conv1d` would be
+        # removed at the very end, when keeping only the right length for the output,
+        # as removing it here would require also passing the length at the matching layer
+        # in the encoder.
+        return unpad1d(y, self._get_padding())
+
+    def _trim_left(self, y: torch.Tensor) -> torch.Tensor:
+        # the left padding is trimmed from the first samples of the stream.
+        state = self._streaming_state
+        remaining = state.get('trim', self._get_padding()[0])
+        trim = min(remaining, y.shape[-1])
+        state['trim'] = remaining - trim
+        return y[..., trim:]
+
+    def _streaming_forward(self, x: torch.Tensor) -> torch.Tensor:
+        assert self.convtr.norm_type != 'time_group_norm', "GroupNorm doesn't support streaming."
+        state = self._streaming_state
+        if x.shape[-1] == 0:
+            return x.new_zeros(x.shape[0], self.convtr.convtr.out_channels, 0)
+        y = self.convtr(x)
+        if 'partial' in state:
+            partial = state['partial']
+            bias = self.convtr.convtr.bias
+            if bias is not None:
+                # the bias was already added to the tail.
+                partial = partial - bias[:, None]
+            y[..., :partial.shape[-1]] += partial
+        stride = self.convtr.convtr.stride[0]
+        end = stride * x.shape[-1]
+        state['partial'] = y[..., end:]
+        return self._trim_left(y[..., :end])
+
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        """Return the tail of the output in streaming mode, once the whole input has been given,
+        with the right padding trimmed. `x` is first processed if given.
+        """
+        outputs = [] if x is None else [self(x)]
+        state = self._streaming_state
+        if 'partial' in state:
+            partial = state['partial']
+            _, padding_right = self._get_padding()
+            outputs.append(self._trim_left(partial[..., :partial.shape[-1] - padding_right]))
+        state.clear()
+        return torch.cat(outputs, dim=-1) if outputs else None
@@ -6,10 +6,13 @@
 
 from torch import nn
 
+from .streaming import StreamingModule
 
-class StreamableLSTM(nn.Module):
+
+class StreamableLSTM(StreamingModule):
     """LSTM without worrying about the hidden state, nor the layout of the data.
-    Expects input as convolutional layout.
+    Expects input as convolutional layout. In streaming mode, the hidden state
+    is kept from one chunk to the next.
     """
     def __init__(self, dimension: int, num_layers: int = 2, skip: bool = True):
         super().__init__()
@@ -17,9 +20,24 @@ class StreamableLSTM(nn.Module):
         self.lstm = nn.LSTM(dimension, dimension, num_layers)
 
     def forward(self, x):
+        if x.shape[-1] == 0:
+            return x
         x = x.permute(2, 0, 1)
-        y, _ = self.lstm(x)
+        state = self._streaming_state
+        hidden = None
+        if self._is_streaming and 'hidden' in state:
+            hidden = (state['hidden'].transpose(0, 1).contiguous(), state['cell'].transpose(0, 1).contiguous())
+        y, (h, c) = self.lstm(x, hidden)
+        if self._is_streaming:
+            # the first dimension of the streaming state is the batch.
+            state['hidden'] = h.transpose(0, 1)
+            state['cell'] = c.transpose(0, 1)
         if self.skip:
             y = y + x
         y = y.permute(1, 2, 0)
         return y
+
+    def flush(self, x=None):
+        y = None if x is None else self(x)
+        self._streaming_state.clear()
+        return y
@@ -7,13 +7,15 @@
 import typing as tp
 
 import numpy as np
+import torch
 import torch.nn as nn
 
 from .conv import StreamableConv1d, StreamableConvTranspose1d
 from .lstm import StreamableLSTM
+from .streaming import StreamingModule, StreamingSequential
 
 
-class SEANetResnetBlock(nn.Module):
+class SEANetResnetBlock(StreamingModule):
     """Residual block from SEANet model.
 
     Args:
@@ -48,7 +50,7 @@ class SEANetResnetBlock(nn.Module):
                                  norm=norm, norm_kwargs=norm_params,
                                  causal=causal, pad_mode=pad_mode),
             ]
-        self.block = nn.Sequential(*block)
+        self.block = StreamingSequential(*block)
         self.shortcut: nn.Module
         if true_skip:
             self.shortcut = nn.Identity()
@@ -57,10 +59,37 @@ class SEANetResnetBlock(nn.Module):
                                              causal=causal, pad_mode=pad_mode)
 
     def forward(self, x):
+        if self._is_streaming:
+            return self._add(self.shortcut(x), self.block(x))
         return self.shortcut(x) + self.block(x)
 
+    def _add(self, skip: tp.Optional[torch.Tensor], y: tp.Optional[torch.Tensor]) -> tp.Optional[torch.Tensor]:
+        # in streaming mode, the convolutions of the block hold back the last samples until the next
+        # ones are known, the samples of one branch ahead of the other are kept for the next call.
+        state = self._streaming_state
+        if 'skip' in state:
+            skip = state['skip'] if skip is None else torch.cat([state['skip'], skip], dim=-1)
+            y = state['block'] if y is None else torch.cat([state['block'], y], dim=-1)
+        if skip is None or y is None:
+            return None
+        length = min(skip.shape[-1], y.shape[-1])
+        state['skip'] = skip[..., length:]
+        state['block'] = y[..., length:]
+        return skip[..., :length] + y[..., :length]
 
-class SEANetEncoder(nn.Module):
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        if isinstance(self.shortcut, StreamingModule):
+            skip = self.shortcut.flush(x)
+        else:
+            skip = None if x is None else self.shortcut(x)
+        out = self._add(skip, self.block.flush(x))
+        remaining = self._streaming_state.pop('skip', None)
+        assert remaining is None or remaining.shape[-1] == 0, "Both branches should have the same length."
+        self._streaming_state.clear()
+        return out
+
+
+class SEANetEncoder(StreamingModule):
     """SEANet encoder.
 
     Args:
@@ -147,13 +176,31 @@ class SEANetEncoder(nn.Module):
                              norm_kwargs=norm_params, causal=causal, pad_mode=pad_mode)
         ]
 
-        self.model = nn.Sequential(*model)
+        self.model = StreamingSequential(*model)
 
-    def forward(self, x):
-        return self.model(x)
+    def forward(self, x: torch.Tensor, lengths: tp.Optional[torch.Tensor] = None):
+        """Encode the waveforms `x` of shape [B, C, T].
 
+        If `lengths` is given, of shape [B], the items are padded at the end past their length, and the outputs
+        past the length of each item are set to zero after each layer. With a constant padding mode,
+        each item is then encoded exactly as if it was alone, otherwise only its last frames differ.
+        """
+        if lengths is None:
+            return self.model(x)
+        assert not self._is_streaming, "Lengths are not supported in streaming mode."
+        for layer in self.model:
+            x = layer(x)
+            if isinstance(layer, StreamableConv1d):
+                lengths = layer.get_output_length(lengths)
+            mask = torch.arange(x.shape[-1], device=x.device) < lengths[:, None, None]
+            x = x.masked_fill(~mask, 0)
+        return x
 
-class SEANetDecoder(nn.Module):
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        return self.model.flush(x)
+
+
+class SEANetDecoder(StreamingModule):
     """SEANet decoder.
 
     Args:
@@ -251,8 +298,11 @@ class SEANetDecoder(nn.Module):
             model += [
                 final_act(**final_activation_params)
             ]
-        self.model = nn.Sequential(*model)
+        self.model = StreamingSequential(*model)
 
     def forward(self, z):
         y = self.model(z)
         return y
+
+    def flush(self, z: tp.Optional[torch.Tensor] = None):
+        return self.model.flush(z)
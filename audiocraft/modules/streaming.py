@@ -14,7 +14,8 @@ from torch import nn
 import torch
 
 
-State = tp.Dict[str, torch.Tensor]
+# Mostly tensors, but small counters are kept as Python numbers to avoid device syncs.
+State = tp.Dict[str, tp.Any]
 
 
 class StreamingModule(nn.Module):
@@ -40,8 +41,8 @@ class StreamingModule(nn.Module):
     this one is trickier, as all parents module must be StreamingModule and implement
     it as well for it to work properly. See `StreamingSequential` after.
     """
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
         self._streaming_state: State = {}
         self._is_streaming = False
 
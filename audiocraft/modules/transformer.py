@@ -13,6 +13,8 @@ See `StreamingTransformer` for more information.
 Unlike regular PyTorch Transformer, we make the hard choice that batches are first.
 """
 
+from contextlib import contextmanager
+from functools import lru_cache
 import typing as tp
 
 from einops import rearrange
@@ -22,8 +24,9 @@ from torch.nn import functional as F
 from torch.utils.checkpoint import checkpoint as torch_checkpoint
 #from xformers import ops
 
+from .int8 import Int8Linear, quantize_linears_
 from .rope import RotaryEmbedding
-from .streaming import StreamingModule
+from .streaming import StreamingModule, State
 
 _efficient_attention_backend: str = 'torch'
 
@@ -135,6 +138,50 @@ class LayerScale(nn.Module):
             return self.scale[:, None] * x
 
 
+@lru_cache(maxsize=16)
+def _get_causal_mask(current_steps: int, past_steps: int, past_context: tp.Optional[int],
+                     device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    # Shared by all the layers, the returned mask should never be modified in place.
+    queries_pos = torch.arange(
+        past_steps, current_steps + past_steps, device=device).view(-1, 1)
+    keys_pos = torch.arange(past_steps + current_steps, device=device).view(1, -1)
+    delta = queries_pos - keys_pos
+    valid = delta >= 0
+    if past_context is not None:
+        valid &= (delta <= past_context)
+    return torch.where(
+        valid,
+        torch.zeros([], device=device, dtype=dtype),
+        torch.full([], float('-inf'), device=device, dtype=dtype))
+
+
+@lru_cache(maxsize=16)
+def _get_ring_mask(current_steps: int, past_steps: int, past_context: int,
+                   device: torch.device, dtype: torch.dtype) -> tp.Optional[torch.Tensor]:
+    # Mask over the keys of a ring buffer of `past_context + 1` steps after `past_steps` steps,
+    # followed by the `current_steps` new keys when there are several, see `_complete_kv_ring`.
+    capacity = past_context + 1
+    queries_pos = torch.arange(past_steps, past_steps + current_steps, device=device).view(-1, 1)
+    if current_steps == 1:
+        if past_steps + 1 >= capacity:
+            # the ring is full and only holds the keys within the past context.
+            return None
+        # the new key is written first, slot i holding the step i until the ring wraps.
+        keys_pos = torch.arange(capacity, device=device)
+        keys_pos = torch.where(keys_pos <= past_steps, keys_pos, -1)
+    else:
+        slots = torch.arange(capacity, device=device)
+        # last step written in each slot, negative if none yet.
+        ring_pos = past_steps - 1 - (past_steps - 1 - slots) % capacity
+        keys_pos = torch.cat([ring_pos, queries_pos.view(-1)])
+    delta = queries_pos - keys_pos.view(1, -1)
+    valid = (keys_pos.view(1, -1) >= 0) & (delta >= 0) & (delta <= past_context)
+    return torch.where(
+        valid,
+        torch.zeros([], device=device, dtype=dtype),
+        torch.full([], float('-inf'), device=device, dtype=dtype))
+
+
 class StreamingMultiheadAttention(StreamingModule):
     """Similar to `nn.MultiheadAttention` but with support for streaming, causal evaluation.
 
@@ -183,6 +230,14 @@ class StreamingMultiheadAttention(StreamingModule):
         self.num_heads = num_heads
         self.dropout = dropout
         self.kv_repeat = kv_repeat
+        # When set, streaming keys and values are written in place into buffers of that many steps,
+        # see `StreamingTransformer.static_kv_cache`.
+        self.kv_cache_capacity: tp.Optional[int] = None
+        # When set, streaming keys and values of the last `past_context` steps are kept in a ring buffer,
+        # see `StreamingTransformer.sliding_window`.
+        self.ring_kv_cache = False
+        # int8 input projections replacing `in_proj_weight`, see `quantize_`.
+        self.in_projs: tp.Optional[nn.ModuleList] = None
         if cross_attention:
             assert not causal, "Causal cannot work with cross attention."
             assert rope is None, "Rope cannot work with cross attention."
@@ -230,11 +285,43 @@ class StreamingMultiheadAttention(StreamingModule):
                     state_dict[prefix + "mha." + key] = state_dict.pop(prefix + key)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def quantize_(self):
+        """Quantize in place the input and output projections to int8, see `audiocraft.modules.int8`.
+        With cross attention, the input projection is split into the queries, keys and values ones.
+        """
+        assert self.custom, "Quantization requires the custom attention."
+        assert self.in_projs is None, "Already quantized."
+        weight, bias = self.in_proj_weight, self.in_proj_bias
+        parts = 3 if self.cross_attention else 1
+        dim = weight.shape[0] // parts
+        self.in_projs = nn.ModuleList([
+            Int8Linear.from_float(weight[part * dim: (part + 1) * dim],
+                                  None if bias is None else bias[part * dim: (part + 1) * dim])
+            for part in range(parts)])
+        del self.in_proj_weight, self.in_proj_bias
+        self.out_proj = quantize_linears_(self.out_proj)
+
+    def _in_proj(self, x: torch.Tensor, part: tp.Optional[int] = None) -> torch.Tensor:
+        # Input projection, restricted to the queries, keys or values (part 0, 1 or 2) if `part` is given.
+        if self.in_projs is not None:
+            return self.in_projs[part or 0](x)
+        if part is None:
+            return nn.functional.linear(x, self.in_proj_weight, self.in_proj_bias)
+        dim = self.in_proj_weight.shape[0] // 3
+        bias = None if self.in_proj_bias is None else self.in_proj_bias[part * dim: (part + 1) * dim]
+        return nn.functional.linear(x, self.in_proj_weight[part * dim: (part + 1) * dim], bias)
+
     def _get_mask(self, current_steps: int, device: torch.device, dtype: torch.dtype):
         # Return a causal mask, accounting for potentially stored past keys/values
         # We actually return a bias for the attention score, as this has the same
         # convention both in the builtin MHA in Pytorch, and Xformers functions.
         time_dim = _get_attention_time_dimension()
+        if 'slot_lengths' in self._streaming_state:
+            return self._get_slots_mask(current_steps, device, dtype)
+        if self._uses_ring():
+            assert self.past_context is not None
+            return _get_ring_mask(current_steps, self._streaming_state.get('ring_steps', 0),
+                                  self.past_context, device, dtype)
         if self.memory_efficient:
             from xformers.ops import LowerTriangularMask
             if current_steps == 1:
@@ -250,10 +337,18 @@ class StreamingMultiheadAttention(StreamingModule):
             past_steps = past_keys.shape[time_dim]
         else:
             past_steps = 0
+        if current_steps == 1 and (self.past_context is None or past_steps <= self.past_context):
+            # A single query attends to all the keys, which is the case of every decoding step.
+            return None
+        return _get_causal_mask(current_steps, past_steps, self.past_context, device, dtype)
 
-        queries_pos = torch.arange(
-            past_steps, current_steps + past_steps, device=device).view(-1, 1)
-        keys_pos = torch.arange(past_steps + current_steps, device=device).view(1, -1)
+    def _get_slots_mask(self, current_steps: int, device: torch.device, dtype: torch.dtype):
+        # Mask of shape [B, 1, T, capacity] for the slots, each row being at its own position.
+        time_dim = _get_attention_time_dimension()
+        capacity = self._streaming_state['key_cache'].shape[time_dim]
+        queries_pos = self._streaming_state['slot_lengths'].view(-1, 1, 1) + torch.arange(
+            current_steps, device=device).view(1, -1, 1)
+        keys_pos = torch.arange(capacity, device=device).view(1, 1, -1)
         delta = queries_pos - keys_pos
         valid = delta >= 0
         if self.past_context is not None:
@@ -261,7 +356,40 @@ class StreamingMultiheadAttention(StreamingModule):
         return torch.where(
             valid,
             torch.zeros([], device=device, dtype=dtype),
-            torch.full([], float('-inf'), device=device, dtype=dtype))
+            torch.full([], float('-inf'), device=device, dtype=dtype))[:, None]
+
+    def _init_slots(self, batch_size: int, capacity: int):
+        # Allocate the keys and values of `batch_size` independent rows, see `StreamingTransformer.init_slots`.
+        time_dim = _get_attention_time_dimension()
+        kv_heads = self.num_heads // self.kv_repeat
+        head_dim = self.embed_dim // self.num_heads
+        if time_dim == 2:
+            shape = [batch_size, kv_heads, capacity, head_dim]
+        else:
+            shape = [batch_size, capacity, kv_heads, head_dim]
+        # the scale of quantized projections gives the float dtype of the keys and values.
+        weight = self.in_proj_weight if self.in_projs is None else self.in_projs[0].scale
+        assert isinstance(weight, torch.Tensor)
+        device, dtype = weight.device, weight.dtype
+        self._streaming_state.clear()
+        self._streaming_state['key_cache'] = torch.zeros(shape, device=device, dtype=dtype)
+        self._streaming_state['value_cache'] = torch.zeros(shape, device=device, dtype=dtype)
+        self._streaming_state['slot_lengths'] = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def _complete_kv_slots(self, k, v):
+        # Write the keys and values of each row at its own position in the slots.
+        time_dim = _get_attention_time_dimension()
+        state = self._streaming_state
+        lengths = state['slot_lengths']
+        steps = k.shape[time_dim]
+        positions = lengths.view(-1, 1) + torch.arange(steps, device=k.device).view(1, -1)
+        shape = [-1, 1, 1, 1]
+        shape[time_dim] = steps
+        index = positions.view(shape).expand_as(k)
+        state['key_cache'].scatter_(time_dim, index, k)
+        state['value_cache'].scatter_(time_dim, index, v)
+        state['slot_lengths'] = lengths + steps
+        return state['key_cache'], state['value_cache']
 
     def _complete_kv(self, k, v):
         time_dim = _get_attention_time_dimension()
@@ -270,6 +398,12 @@ class StreamingMultiheadAttention(StreamingModule):
             # are already available, and streaming is with respect
             # to the queries only.
             return k, v
+        if 'slot_lengths' in self._streaming_state:
+            return self._complete_kv_slots(k, v)
+        if self._uses_ring():
+            return self._complete_kv_ring(k, v)
+        if self._is_streaming and self.kv_cache_capacity is not None and self.custom:
+            return self._complete_kv_static(k, v)
         # Complete the key/value pair using the streaming state.
         if self._streaming_state:
             pk = self._streaming_state['past_keys']
@@ -288,15 +422,92 @@ class StreamingMultiheadAttention(StreamingModule):
         if self.past_context is not None:
             offset = max(0, nk.shape[time_dim] - self.past_context)
         if self._is_streaming:
-            self._streaming_state['past_keys'] = nk[:, offset:]
+            self._streaming_state['past_keys'] = nk.narrow(time_dim, offset, nk.shape[time_dim] - offset)
             if v is not k:
-                self._streaming_state['past_values'] = nv[:, offset:]
-            if 'offset' in self._streaming_state:
-                self._streaming_state['offset'] += offset
-            else:
-                self._streaming_state['offset'] = torch.tensor(0)
+                self._streaming_state['past_values'] = nv.narrow(time_dim, offset, nv.shape[time_dim] - offset)
+            self._streaming_state['offset'] = self._streaming_state.get('offset', 0) + offset
+        return nk, nv
+
+    def _uses_ring(self) -> bool:
+        return self._is_streaming and self.ring_kv_cache and not self.cross_attention
+
+    def _complete_kv_ring(self, k, v):
+        # Same as `_complete_kv` with a finite `past_context`, but the keys and values of the last
+        # `past_context + 1` steps are written in place in a ring buffer, slot `i` holding the last step
+        # equal to `i` modulo its capacity. Attention does not depend on the order of the keys, so
+        # a single query attends to the ring directly, with the mask of `_get_ring_mask`, while
+        # several queries attend to the ring followed by the new keys.
+        time_dim = _get_attention_time_dimension()
+        assert self.custom and self.past_context is not None
+        state = self._streaming_state
+        capacity = self.past_context + 1
+        if 'ring_keys' not in state:
+            shape = list(k.shape)
+            shape[time_dim] = capacity
+            state['ring_keys'] = k.new_zeros(shape)
+            state['ring_values'] = v.new_zeros(shape)
+            state['ring_steps'] = 0
+        past_steps = state['ring_steps']
+        steps = k.shape[time_dim]
+        ring_keys, ring_values = state['ring_keys'], state['ring_values']
+        if steps > 1:
+            nk = torch.cat([ring_keys, k], dim=time_dim)
+            nv = torch.cat([ring_values, v], dim=time_dim)
+        else:
+            nk, nv = ring_keys, ring_values
+        # only the last `capacity` new steps can remain in the ring.
+        kept = min(steps, capacity)
+        index = torch.arange(past_steps + steps - kept, past_steps + steps, device=k.device) % capacity
+        ring_keys.index_copy_(time_dim, index, k.narrow(time_dim, steps - kept, kept))
+        ring_values.index_copy_(time_dim, index, v.narrow(time_dim, steps - kept, kept))
+        state['ring_steps'] = past_steps + steps
+        return nk, nv
+
+    def _complete_kv_static(self, k, v):
+        # Same as `_complete_kv`, but the keys and values are copied into preallocated buffers,
+        # `past_keys` and `past_values` being views over the filled part. As the buffers keep
+        # all the steps, a finite `past_context` is only enforced by the mask.
+        time_dim = _get_attention_time_dimension()
+        assert self.kv_cache_capacity is not None
+        state = self._streaming_state
+        if 'key_cache' in state:
+            past_steps = state['past_keys'].shape[time_dim]
+        else:
+            shape = list(k.shape)
+            shape[time_dim] = self.kv_cache_capacity
+            state['key_cache'] = k.new_empty(shape)
+            state['value_cache'] = state['key_cache'] if v is k else v.new_empty(shape)
+            past_steps = 0
+        steps = past_steps + k.shape[time_dim]
+        if steps > self.kv_cache_capacity:
+            raise RuntimeError(f"Static KV cache of {self.kv_cache_capacity} steps is too small for {steps} steps.")
+        state['key_cache'].narrow(time_dim, past_steps, k.shape[time_dim]).copy_(k)
+        nk = state['key_cache'].narrow(time_dim, 0, steps)
+        state['past_keys'] = nk
+        if v is k:
+            nv = nk
+        else:
+            state['value_cache'].narrow(time_dim, past_steps, v.shape[time_dim]).copy_(v)
+            nv = state['value_cache'].narrow(time_dim, 0, steps)
+            state['past_values'] = nv
         return nk, nv
 
+    def _rollback(self, steps: int):
+        # Forget the keys and values of the last `steps` streaming steps, see `StreamingTransformer.rollback`.
+        state = self._streaming_state
+        if 'ring_keys' in state:
+            raise RuntimeError("Cannot roll back with a ring buffer KV cache.")
+        if self.cross_attention or 'past_keys' not in state:
+            return
+        if state.get('offset', 0):
+            raise RuntimeError("Cannot roll back once keys have been dropped because of the past context.")
+        time_dim = _get_attention_time_dimension()
+        past_steps = state['past_keys'].shape[time_dim]
+        assert steps <= past_steps, f"Cannot roll back {steps} steps out of {past_steps}."
+        state['past_keys'] = state['past_keys'].narrow(time_dim, 0, past_steps - steps)
+        if 'past_values' in state:
+            state['past_values'] = state['past_values'].narrow(time_dim, 0, past_steps - steps)
+
     def _apply_rope(self, query: torch.Tensor, key: torch.Tensor):
         # TODO: fix and verify layout.
         assert _efficient_attention_backend == 'xformers', 'Rope not supported with torch attn.'
@@ -306,10 +517,7 @@ class StreamingMultiheadAttention(StreamingModule):
             past_keys_offset = self._streaming_state['past_keys'].shape[1]
         else:
             past_keys_offset = 0
-        if 'offset' in self._streaming_state:
-            past_context_offset = int(self._streaming_state['offset'].item())
-        else:
-            past_context_offset = 0
+        past_context_offset = self._streaming_state.get('offset', 0)
         streaming_offset = past_context_offset + past_keys_offset
         return self.rope.rotate_qk(query, key, start=streaming_offset)
 
@@ -339,31 +547,36 @@ class StreamingMultiheadAttention(StreamingModule):
         if self.custom:
             # custom implementation
             assert need_weights is False
-            assert key_padding_mask is None
+            assert key_padding_mask is None or self.cross_attention, "Key padding masks need cross attention."
             if self.cross_attention:
                 # Different queries, keys, values, we have to spit manually the weights
                 # before applying the linear.
-                dim = self.in_proj_weight.shape[0] // 3
-                if self.in_proj_bias is None:
-                    bias_q, bias_k, bias_v = None, None, None
-                else:
-                    bias_q = self.in_proj_bias[:dim]
-                    bias_k = self.in_proj_bias[dim: 2 * dim]
-                    bias_v = self.in_proj_bias[2 * dim:]
-                q = nn.functional.linear(query, self.in_proj_weight[:dim], bias_q)
-                # todo: when streaming, we could actually save k, v and check the shape actually match.
-                k = nn.functional.linear(key, self.in_proj_weight[dim: 2 * dim], bias_k)
-                v = nn.functional.linear(value, self.in_proj_weight[2 * dim:], bias_v)
+                q = self._in_proj(query, 0)
                 if self.qk_layer_norm is True:
                     q = self.q_layer_norm(q)
-                    k = self.k_layer_norm(k)
-                q, k, v = [rearrange(x, f"b t (h d) -> {layout}", h=self.num_heads) for x in [q, k, v]]
+                q = rearrange(q, f"b t (h d) -> {layout}", h=self.num_heads)
+                state = self._streaming_state
+                if (self._is_streaming and 'cross_keys' in state and
+                        state['cross_keys'].shape[0] == key.shape[0] and
+                        state['cross_keys'].shape[time_dim] == key.shape[1]):
+                    # The keys and values only depend on the conditioning, which is assumed
+                    # not to change while streaming, so we project them on the first step only.
+                    k, v = state['cross_keys'], state['cross_values']
+                else:
+                    k = self._in_proj(key, 1)
+                    v = self._in_proj(value, 2)
+                    if self.qk_layer_norm is True:
+                        k = self.k_layer_norm(k)
+                    k, v = [rearrange(x, f"b t (h d) -> {layout}", h=self.num_heads) for x in [k, v]]
+                    if self._is_streaming:
+                        state['cross_keys'], state['cross_values'] = k, v
             else:
-                if not _is_profiled():
+                # the profiler check is skipped when compiling, as the failed import would break the graph.
+                if not torch.compiler.is_compiling() and not _is_profiled():
                     # profiling breaks that propertysomehow.
                     assert query is key, "specialized implementation"
                     assert value is key, "specialized implementation"
-                projected = nn.functional.linear(query, self.in_proj_weight, self.in_proj_bias)
+                projected = self._in_proj(query)
                 if self.kv_repeat == 1:
                     if time_dim == 2:
                         bound_layout = "b h p t d"
@@ -398,9 +611,16 @@ class StreamingMultiheadAttention(StreamingModule):
                     v = expand_repeated_kv(v, self.kv_repeat)
             if self.attention_as_float32:
                 q, k, v = [x.float() for x in [q, k, v]]
+            if key_padding_mask is not None:
+                # additive mask over [B, H, T, K], the padded keys get no weight.
+                attn_mask = torch.zeros(key_padding_mask.shape, dtype=q.dtype, device=q.device)
+                attn_mask = attn_mask.masked_fill(key_padding_mask, float('-inf'))[:, None, None, :]
             if self.memory_efficient:
                 p = self.dropout if self.training else 0
-                if _efficient_attention_backend == 'torch':
+                if _efficient_attention_backend == 'torch' and isinstance(attn_mask, torch.Tensor):
+                    x = torch.nn.functional.scaled_dot_product_attention(
+                        q, k, v, attn_mask=attn_mask, dropout_p=p)
+                elif _efficient_attention_backend == 'torch':
                     x = torch.nn.functional.scaled_dot_product_attention(
                         q, k, v, is_causal=attn_mask is not None, dropout_p=p)
                 else:
@@ -530,17 +750,19 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
         self.norm1 = create_norm_fn(norm, d_model, **factory_kwargs)  # type: ignore
         self.norm2 = create_norm_fn(norm, d_model, **factory_kwargs)  # type: ignore
 
-    def _cross_attention_block(self, src: torch.Tensor,
-                               cross_attention_src: torch.Tensor) -> torch.Tensor:
+    def _cross_attention_block(self, src: torch.Tensor, cross_attention_src: torch.Tensor,
+                               cross_attention_mask: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
         assert self.cross_attention is not None
         # queries are from src, keys and values from cross_attention_src.
+        key_padding_mask = None if cross_attention_mask is None else ~cross_attention_mask
         x = self.cross_attention(
-            src, cross_attention_src, cross_attention_src, need_weights=False)[0]
+            src, cross_attention_src, cross_attention_src, key_padding_mask=key_padding_mask, need_weights=False)[0]
         return self.dropout_cross(x)  # type: ignore
 
     def forward(self, src: torch.Tensor, src_mask: tp.Optional[torch.Tensor] = None,  # type: ignore
                 src_key_padding_mask: tp.Optional[torch.Tensor] = None,
-                cross_attention_src: tp.Optional[torch.Tensor] = None):
+                cross_attention_src: tp.Optional[torch.Tensor] = None,
+                cross_attention_mask: tp.Optional[torch.Tensor] = None):
         if self.cross_attention is None:
             assert cross_attention_src is None
         else:
@@ -552,7 +774,7 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
             if cross_attention_src is not None:
                 x = x + self.layer_scale_cross(
                     self._cross_attention_block(
-                        self.norm_cross(x), cross_attention_src))
+                        self.norm_cross(x), cross_attention_src, cross_attention_mask))
             x = x + self.layer_scale_2(self._ff_block(self.norm2(x)))
         else:
             x = self.norm1(x + self.layer_scale_1(
@@ -560,7 +782,7 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
             if cross_attention_src is not None:
                 x = self.norm_cross(
                     x + self.layer_scale_cross(
-                        self._cross_attention_block(src, cross_attention_src)))
+                        self._cross_attention_block(src, cross_attention_src, cross_attention_mask)))
             x = self.norm2(x + self.layer_scale_2(self._ff_block(x)))
         return x
 
@@ -682,6 +904,116 @@ class StreamingTransformer(StreamingModule):
         else:
             raise ValueError(f"Checkpointing method {method} is unknown.")
 
+    @contextmanager
+    def static_kv_cache(self, capacity: tp.Optional[int]):
+        """Within this context, the self attention layers store the streaming keys and values
+        in buffers of `capacity` steps, allocated on the first streaming step and written in place,
+        instead of concatenating them with the past ones at every step. The capacity should cover
+        all the steps fed to the model in streaming mode. Does nothing if `capacity` is None.
+        """
+        layers = [layer for _, layer in self._self_attention_layers()]
+        previous = [layer.kv_cache_capacity for layer in layers]
+        for layer in layers:
+            layer.kv_cache_capacity = capacity
+        try:
+            yield
+        finally:
+            for layer, value in zip(layers, previous):
+                layer.kv_cache_capacity = value
+
+    @contextmanager
+    def sliding_window(self, past_context: tp.Optional[int]):
+        """Within this context, each step only attends to the `past_context` previous steps in streaming
+        mode, with the keys and values of the self attention layers kept in ring buffers written in place,
+        so that the memory and time per step stay bounded however long the model is streamed.
+        Note that the positions keep increasing, so that the sinusoidal embeddings go beyond the range
+        seen during training. Only supported with the custom attention. Does nothing if `past_context` is None.
+        """
+        if past_context is None:
+            yield
+            return
+        layers = [layer for _, layer in self._self_attention_layers()]
+        previous = [(layer.past_context, layer.ring_kv_cache) for layer in layers]
+        for layer in layers:
+            assert layer.custom and layer.causal, "Sliding windows require the custom causal attention."
+            layer.past_context = past_context
+            layer.ring_kv_cache = True
+        try:
+            yield
+        finally:
+            for layer, (context, ring) in zip(layers, previous):
+                layer.past_context = context
+                layer.ring_kv_cache = ring
+
+    def _self_attention_layers(self) -> tp.List[tp.Tuple[str, StreamingMultiheadAttention]]:
+        return [(name, module) for name, module in self.named_modules()
+                if isinstance(module, StreamingMultiheadAttention) and not module.cross_attention]
+
+    def init_slots(self, batch_size: int, capacity: int):
+        """In streaming mode, switch to independent slots: each row of the batch has its own
+        position and keys and values for up to `capacity` steps, so that rows can be started
+        and stopped independently, see `fill_slots` and `reset_slots`. The slots last until
+        the streaming state is reset. Only supported with the custom attention.
+        """
+        assert self._is_streaming, "Slots are only available in streaming mode."
+        for _, layer in self._self_attention_layers():
+            assert layer.custom, "Slots require the custom attention."
+            layer._init_slots(batch_size, capacity)
+        self._streaming_state['offsets'] = torch.zeros(batch_size, dtype=torch.long,
+                                                       device=next(iter(self.parameters())).device)
+
+    def fill_slots(self, rows: torch.Tensor, state: State):
+        """Start the given rows of the slots from a streaming state obtained with `get_streaming_state`
+        after feeding a prefix to `len(rows)` rows in the regular streaming mode.
+        """
+        time_dim = _get_attention_time_dimension()
+        for name, layer in self._self_attention_layers():
+            past_keys = state[name + '.past_keys']
+            past_values = state.get(name + '.past_values', past_keys)
+            assert past_values is not None
+            steps = past_keys.shape[time_dim]
+            layer._streaming_state['key_cache'].index_copy_(0, rows, _pad_time(
+                past_keys, layer._streaming_state['key_cache'].shape[time_dim], time_dim))
+            layer._streaming_state['value_cache'].index_copy_(0, rows, _pad_time(
+                past_values, layer._streaming_state['value_cache'].shape[time_dim], time_dim))
+            layer._streaming_state['slot_lengths'][rows] = steps
+        self._streaming_state['offsets'][rows] = state['offsets']
+
+    def reset_slots(self, rows: torch.Tensor):
+        """Restart the given rows of the slots from an empty state."""
+        for _, layer in self._self_attention_layers():
+            layer._streaming_state['slot_lengths'][rows] = 0
+        self._streaming_state['offsets'][rows] = 0
+
+    def quantize_(self):
+        """Quantize in place all the linear layers to int8 for inference on CPU,
+        see `audiocraft.modules.int8`. Only supported with the custom attention.
+        """
+        for module in self.modules():
+            if isinstance(module, StreamingMultiheadAttention):
+                module.quantize_()
+        quantize_linears_(self)
+
+    def clear_cross_attention_cache(self):
+        """Drop the cross attention keys and values computed in streaming mode,
+        to be called when the cross attention source changes while streaming.
+        """
+        for module in self.modules():
+            if isinstance(module, StreamingMultiheadAttention) and module.cross_attention:
+                module._streaming_state.pop('cross_keys', None)
+                module._streaming_state.pop('cross_values', None)
+
+    def rollback(self, steps: int):
+        """In streaming mode, forget the last `steps` time steps, as if they had never been fed
+        to the model. This is only possible while the self attention layers still hold
+        the keys and values of those steps, i.e. not beyond a finite `past_context`.
+        """
+        for module in self.modules():
+            if isinstance(module, StreamingMultiheadAttention):
+                module._rollback(steps)
+        if 'offsets' in self._streaming_state:
+            self._streaming_state['offsets'] = self._streaming_state['offsets'] - steps
+
     def forward(self, x: torch.Tensor, *args, **kwargs):
         B, T, C = x.shape
 
@@ -713,6 +1045,12 @@ class StreamingTransformer(StreamingModule):
         return group
 
 
+def _pad_time(x: torch.Tensor, length: int, time_dim: int) -> torch.Tensor:
+    # Zero pad the time dimension of keys or values up to `length`.
+    padding = [0, 0] * (x.dim() - time_dim - 1) + [0, length - x.shape[time_dim]]
+    return F.pad(x, padding)
+
+
 # special attention attention related function
 
 def _verify_xformers_memory_efficient_compat():
@@ -0,0 +1,126 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import typing as tp
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore:
+    """Content addressed file store with size-bounded LRU eviction.
+
+    Each entry is a single file named after the hash of the fields that fully describe
+    its content (see `ContentStore.key`). Files are first written to a temporary name
+    in the same folder and atomically renamed, so readers never see partial files.
+    When the total size goes over `max_size`, the least recently used entries are deleted.
+    Entries already present in `root` are picked up on creation, ordered by modification time.
+
+    Args:
+        root (Path or str): Folder holding the entries.
+        max_size (int, optional): Maximum total size in bytes, no eviction if None.
+        suffix (str): Suffix of the entry files, e.g. '.wav'.
+    """
+    _tmp_prefix = '.tmp-'
+
+    def __init__(self, root: tp.Union[Path, str], max_size: tp.Optional[int] = None, suffix: str = ''):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.suffix = suffix
+        self.root.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self._entries: tp.OrderedDict[str, int] = OrderedDict()
+        files = []
+        for path in self.root.iterdir():
+            if not path.name.endswith(suffix) or not path.is_file():
+                continue
+            if path.name.startswith(self._tmp_prefix):
+                # leftover of an interrupted write.
+                path.unlink()
+                continue
+            stat = path.stat()
+            files.append((stat.st_mtime, path.name[:len(path.name) - len(suffix)], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+        self._evict()
+
+    @staticmethod
+    def key(**fields: tp.Any) -> str:
+        """Return the key for an entry described by the given JSON serializable fields."""
+        desc = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root / (key + self.suffix)
+
+    def get(self, key: str) -> tp.Optional[Path]:
+        """Return the path of the entry if present, marking it as recently used."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+        return path
+
+    def put(self, key: str, write: tp.Callable[[Path], tp.Any]) -> Path:
+        """Create an entry by calling `write` with a temporary path to write to,
+        then atomically moving it to its final location.
+        """
+        tmp_path = self.root / f'{self._tmp_prefix}{uuid.uuid4().hex}{self.suffix}'
+        try:
+            write(tmp_path)
+            path = self.path(key)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        with self._lock:
+            self._entries[key] = path.stat().st_size
+            self._entries.move_to_end(key)
+            self._evict(keep=key)
+        return path
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """Total size in bytes of the entries."""
+        return sum(self._entries.values())
+
+    def _evict(self, keep: tp.Optional[str] = None):
+        # Should be called with `self._lock` held, or from the constructor.
+        if self.max_size is None:
+            return
+        total = self.size
+        for key in list(self._entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= self._entries.pop(key)
+            logger.debug("Evicting %s from %s", key, self.root)
+            try:
+                self.path(key).unlink()
+            except FileNotFoundError:
+                pass
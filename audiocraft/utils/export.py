@@ -54,3 +54,20 @@ def export_lm(checkpoint_path: tp.Union[Path, str], out_folder: tp.Union[Path, s
     out_file = Path(out_folder) / f'{sig}.th'
     torch.save(new_pkg, out_file)
     return out_file
+
+
+def export_quantized_lm(file_or_url_or_id: tp.Union[Path, str], out_file: tp.Union[Path, str],
+                        cache_dir: tp.Optional[str] = None):
+    """Export a release LM checkpoint with its linear layers quantized to int8, see `LMModel.quantize_`.
+    Saved as `state_dict.bin` in a folder next to the `compression_state_dict.bin` of the
+    original model, it can be loaded with `MusicGen.get_pretrained` given that folder.
+    """
+    from ..models.loaders import load_lm_model
+    lm = load_lm_model(file_or_url_or_id, device='cpu', cache_dir=cache_dir, quantize=True)
+    new_pkg = {
+        'best_state': lm.state_dict(),
+        'xp.cfg': OmegaConf.to_yaml(lm.cfg),
+        'quantized': True,
+    }
+    torch.save(new_pkg, out_file)
+    return out_file
@@ -0,0 +1,238 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Lightweight process metrics exposed in the Prometheus text format.
+
+Recording a value only updates a few numbers under a lock, the text exposition
+is only built when `MetricsRegistry.render` is called, typically by a `/metrics`
+endpoint, so instrumenting hot paths costs almost nothing when nobody scrapes.
+Gauges can also be given a function, evaluated at scrape time only.
+
+The generation code reports the duration of its main stages (conditioning,
+LM prefill and decoding steps, compression model decoding, audio normalization and writing)
+to the `audiocraft_stage_seconds` histogram of the default registry, through `stage`.
+Note that on GPU, the stage durations measure the time until the host gets control
+back, which only matches the device time when the stage ends with a synchronization.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import bisect
+import math
+import threading
+import time
+import typing as tp
+
+
+LabelValues = tp.Tuple[str, ...]
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1., 2.5, 5., 10., 30., 60., 120.)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: tp.Sequence[str], values: tp.Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """Base class for a metric family, with one value per combination of label values.
+
+    Args:
+        name (str): Name of the metric.
+        documentation (str): Help text of the metric.
+        labelnames (tuple of str): Names of the labels, which must all be given when recording.
+    """
+    type_name: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: tp.Dict[str, tp.Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Expected labels {self.labelnames} for {self.name}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> tp.Iterator[tp.Tuple[str, str, float]]:
+        """Yield the (suffix, formatted labels, value) of each sample."""
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """Monotonically increasing counter."""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: tp.Dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1., **labels):
+        assert amount >= 0, "Counters can only be incremented."
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0.)
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '_total', _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """Value that can go up and down. If `function` is given, the gauge has no labels and
+    its value is obtained by calling `function` at scrape time.
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (),
+                 function: tp.Optional[tp.Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        assert function is None or not labelnames, "Gauges with a function cannot have labels."
+        self.function = function
+        self._values: tp.Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels) -> float:
+        if self.function is not None:
+            return float(self.function())
+        return self._values.get(self._label_values(labels), 0.)
+
+    def _samples(self):
+        if self.function is not None:
+            yield '', '', float(self.function())
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '', _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets, given by their upper bounds."""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (),
+                 buckets: tp.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        assert 'le' not in self.labelnames, "'le' is reserved for the histogram buckets."
+        self.buckets = tuple(sorted(buckets))
+        # per label values: count in each bucket (the last one is +Inf), then sum.
+        self._counts: tp.Dict[LabelValues, tp.List[int]] = {}
+        self._sums: tp.Dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration in seconds of the enclosed block."""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - begin, **labels)
+
+    def get_count(self, **labels) -> int:
+        return sum(self._counts.get(self._label_values(labels), []))
+
+    def get_sum(self, **labels) -> float:
+        return self._sums.get(self._label_values(labels), 0.)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                yield '_bucket', labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+M = tp.TypeVar('M', bound=Metric)
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together. Getting a metric that already exists
+    returns the existing one, so that modules can declare the metrics they use independently.
+    """
+    def __init__(self):
+        self._metrics: tp.Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls: tp.Type[M], name: str, *args, **kwargs) -> M:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is already registered as a {metric.type_name}.")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (),
+              function: tp.Optional[tp.Callable[[], float]] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames, function)
+
+    def histogram(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (),
+                  buckets: tp.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        """Return all the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+STAGE_SECONDS = REGISTRY.histogram(
+    'audiocraft_stage_seconds', "Duration of the generation stages in seconds.", ['stage'])
+
+
+def stage(name: str) -> tp.ContextManager[None]:
+    """Time the enclosed block as the given stage, see `STAGE_SECONDS`."""
+    return STAGE_SECONDS.time(stage=name)
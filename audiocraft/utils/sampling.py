@@ -0,0 +1,288 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Token sampling from logits, for all the codebooks of a decoding step at once.
+
+Unlike `utils.sample_top_k` and `utils.sample_top_p`, which take the softmax over the whole
+cardinality, mask the probabilities and call `torch.multinomial`, `sample_next_token` only
+works on the top candidates: the softmax, the top-p cumulative sum and the sampling itself
+run over `top_k` values per row instead of the full cardinality. Sampling is done with the
+Gumbel-max trick by default, i.e. taking the argmax of the logits perturbed with Gumbel noise,
+which follows the same distribution as `torch.multinomial` on the softmax.
+
+The temperature, top-k and top-p can also be given per row, as tensors of shape [B] for
+logits of shape [B, ..., card], so that items with different settings share a batch. Each row can also
+have its own random number generator, so that its samples do not depend on the other rows of the batch.
+"""
+
+import math
+import typing as tp
+
+import torch
+
+
+PerRow = tp.Union[float, torch.Tensor]
+
+
+def apply_repetition_penalty(logits: torch.Tensor, seen: torch.Tensor, penalty: float) -> torch.Tensor:
+    """Penalize the tokens already generated, as in CTRL (https://arxiv.org/abs/1909.05858):
+    positive logits are divided by `penalty` and negative ones multiplied by it.
+
+    Args:
+        logits (torch.Tensor): Logits with the token candidates on the last dimension.
+        seen (torch.Tensor): Boolean tensor of the same shape as `logits`, True for the tokens to penalize.
+        penalty (float): Penalty, 1 meaning no penalty.
+    Returns:
+        torch.Tensor: Penalized logits.
+    """
+    penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+    return torch.where(seen, penalized, logits)
+
+
+def resolve_top_k(top_k: tp.Union[int, torch.Tensor], top_p: PerRow) -> tp.Union[int, torch.Tensor]:
+    """Return the top-k to use along with `top_p`, top-p taking precedence over top-k
+    in MusicGen: top-k is disabled wherever top-p is positive.
+    """
+    if isinstance(top_k, torch.Tensor) or isinstance(top_p, torch.Tensor):
+        device = top_k.device if isinstance(top_k, torch.Tensor) else tp.cast(torch.Tensor, top_p).device
+        top_k = torch.as_tensor(top_k, device=device)
+        return torch.where(torch.as_tensor(top_p, device=device) > 0, torch.zeros_like(top_k), top_k)
+    return 0 if top_p > 0.0 else top_k
+
+
+def _is_per_row(*params: tp.Any) -> bool:
+    return any(isinstance(param, torch.Tensor) for param in params)
+
+
+def _per_row(value: tp.Any, logits: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    # Broadcast a parameter given as a number or per row, with shape [B], to logits of shape [B, ..., card].
+    value = torch.as_tensor(value, dtype=dtype, device=logits.device)
+    if value.dim() == 1:
+        assert len(value) == len(logits), "Per row parameters should have one value per row."
+        value = value.view(-1, *[1] * (logits.dim() - 1))
+    return value
+
+
+def _filter_logits_per_row(logits: torch.Tensor, temp: PerRow, top_k: tp.Union[int, torch.Tensor],
+                           top_p: PerRow, min_p: float) -> tp.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Apply the temperature, top-k, top-p and min-p filters with different values per row.
+    # Returns the filtered logits of the candidates sorted in decreasing order, their indices,
+    # and True for the rows with greedy decoding, i.e. a temperature of 0, whose token is the first candidate.
+    card = logits.shape[-1]
+    temp = _per_row(temp, logits, torch.float32)
+    top_k = _per_row(top_k, logits, torch.long)
+    top_p = _per_row(top_p, logits, torch.float32)
+    greedy = temp <= 0
+    logits = logits / torch.where(greedy, torch.ones_like(temp), temp)
+    # rows without top-k keep all the tokens, the candidates cover the largest top-k.
+    top_k = torch.where((top_k > 0) & (top_k < card), top_k, torch.full_like(top_k, card))
+    logits, indices = torch.topk(logits, int(top_k.max()), dim=-1)
+    ranks = torch.arange(logits.shape[-1], device=logits.device)
+    logits = logits.masked_fill(ranks >= top_k, float('-inf'))
+    logits = logits.masked_fill(_top_p_mask(logits, top_p) & (top_p > 0), float('-inf'))
+    if min_p > 0:
+        max_logit = logits[..., :1]
+        logits = logits.masked_fill(logits < max_logit + math.log(min_p), float('-inf'))
+    return logits, indices, greedy
+
+
+def _gumbel_noise(logits: torch.Tensor, generator: tp.Optional[torch.Generator] = None) -> torch.Tensor:
+    # -log(E) with E ~ Exp(1) follows a Gumbel distribution, E is clamped to avoid log(0).
+    noise = torch.empty_like(logits, dtype=torch.float32).exponential_(generator=generator)
+    return -noise.clamp_(min=torch.finfo(torch.float32).tiny).log_()
+
+
+def _sample_from_logits(logits: torch.Tensor, gumbel: bool,
+                        generator: tp.Optional[torch.Generator] = None,
+                        noise: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+    # Sample one index per row according to softmax(logits), masked entries being -inf.
+    # If given, `noise` is the Gumbel noise to use, of the same shape as `logits`.
+    if noise is not None:
+        return torch.argmax(logits.float() + noise, dim=-1, keepdim=True)
+    if gumbel:
+        return torch.argmax(logits.float() + _gumbel_noise(logits, generator), dim=-1, keepdim=True)
+    probs = torch.softmax(logits.float(), dim=-1)
+    flat = torch.multinomial(probs.reshape(-1, probs.shape[-1]), num_samples=1, generator=generator)
+    return flat.reshape(*probs.shape[:-1], 1)
+
+
+def _top_p_mask(sorted_logits: torch.Tensor, p: PerRow, total_logsumexp: tp.Optional[torch.Tensor] = None):
+    # Return True for the candidates outside of the nucleus, the logits being sorted in decreasing order.
+    # If given, `total_logsumexp` is the normalization over all the tokens, not only the candidates.
+    if total_logsumexp is None:
+        total_logsumexp = torch.logsumexp(sorted_logits, dim=-1, keepdim=True)
+    probs = torch.exp(sorted_logits - total_logsumexp)
+    return torch.cumsum(probs, dim=-1) - probs > p
+
+
+def sample_next_token(logits: torch.Tensor, temp: PerRow = 1.0, top_k: tp.Union[int, torch.Tensor] = 0,
+                      top_p: PerRow = 0.0,
+                      min_p: float = 0.0, repetition_penalty: float = 1.0,
+                      seen: tp.Optional[torch.Tensor] = None, gumbel: bool = True,
+                      top_p_candidates: int = 256,
+                      generator: tp.Optional[torch.Generator] = None,
+                      generators: tp.Optional[tp.Sequence[torch.Generator]] = None) -> torch.Tensor:
+    """Sample the next token from the logits, over the last dimension.
+
+    The filters are applied in this order: repetition penalty, temperature, top-k, top-p
+    among the top-k candidates, then min-p. Without top-k, top-p is computed over the
+    `top_p_candidates` most likely tokens when they cover a probability of at least `p`,
+    and over all the tokens otherwise, so that the result does not depend on `top_p_candidates`.
+
+    The temperature, top-k and top-p can be tensors of shape [B] giving their value for each row
+    of logits of shape [B, ..., card]. Rows with a temperature of 0 then use greedy decoding.
+
+    Args:
+        logits (torch.Tensor): Logits of shape [..., card].
+        temp (float or torch.Tensor): Sampling temperature, must be positive if given as a number.
+        top_k (int or torch.Tensor): If positive, only sample among the `top_k` most likely tokens.
+        top_p (float or torch.Tensor): If positive, only sample among the smallest set of most likely tokens
+            with a cumulative probability of at least `top_p`.
+        min_p (float): If positive, drop the tokens with a probability lower than `min_p`
+            times the probability of the most likely token.
+        repetition_penalty (float): Penalty applied to the logits of the `seen` tokens,
+            see `apply_repetition_penalty`.
+        seen (torch.Tensor, optional): Boolean tensor of the same shape as `logits`,
+            required if `repetition_penalty` is not 1.
+        gumbel (bool): Sample with the Gumbel-max trick if True, else with `torch.multinomial`.
+        top_p_candidates (int): Number of candidates first considered for top-p without top-k.
+        generator (torch.Generator, optional): Random number generator to use.
+        generators (list of torch.Generator, optional): Random number generator of each row of logits
+            of shape [B, ..., card], instead of `generator`. The Gumbel noise of a row is then drawn over
+            all its tokens before filtering, so that its sample only depends on its own logits and generator,
+            not on the other rows of the batch or their parameters.
+    Returns:
+        torch.Tensor: Sampled tokens of shape [..., 1].
+    """
+    per_row = _is_per_row(temp, top_k, top_p)
+    assert per_row or temp > 0, "Use argmax for greedy decoding."
+    if repetition_penalty != 1.0:
+        assert seen is not None, "The seen tokens are required for the repetition penalty."
+        logits = apply_repetition_penalty(logits, seen, repetition_penalty)
+    logits = logits.float()
+    noise: tp.Optional[torch.Tensor] = None
+    if generators is not None:
+        assert gumbel and generator is None, "Generators per row are only supported with the Gumbel-max trick."
+        assert len(generators) == len(logits), "Expected one generator per row."
+        noise = torch.stack([_gumbel_noise(row, row_generator) for row, row_generator in zip(logits, generators)])
+    if per_row:
+        logits, row_indices, greedy = _filter_logits_per_row(logits, temp, top_k, top_p, min_p)
+        next_token = _sample_from_logits(logits, gumbel, generator, _gather_noise(noise, row_indices))
+        next_token = next_token.masked_fill(greedy, 0)
+        return torch.gather(row_indices, -1, next_token)
+    if temp != 1.0:
+        logits = logits / temp
+    card = logits.shape[-1]
+
+    indices: tp.Optional[torch.Tensor] = None
+    if 0 < top_k < card:
+        # topk returns the candidates sorted, as needed for top-p.
+        logits, indices = torch.topk(logits, int(top_k), dim=-1)
+        if top_p > 0:
+            logits = logits.masked_fill(_top_p_mask(logits, top_p), float('-inf'))
+    elif top_p > 0:
+        total_logsumexp = torch.logsumexp(logits, dim=-1, keepdim=True)
+        candidates, candidate_indices = torch.topk(logits, min(top_p_candidates, card), dim=-1)
+        covered = torch.exp(torch.logsumexp(candidates, dim=-1) - total_logsumexp[..., 0])
+        if bool((covered > top_p).all()):
+            logits, indices = candidates, candidate_indices
+        else:
+            logits, indices = torch.sort(logits, dim=-1, descending=True)
+        logits = logits.masked_fill(_top_p_mask(logits, top_p, total_logsumexp), float('-inf'))
+    if min_p > 0:
+        max_logit = logits.max(dim=-1, keepdim=True).values
+        logits = logits.masked_fill(logits < max_logit + math.log(min_p), float('-inf'))
+
+    next_token = _sample_from_logits(logits, gumbel, generator, _gather_noise(noise, indices))
+    if indices is not None:
+        next_token = torch.gather(indices, -1, next_token)
+    return next_token
+
+
+def _gather_noise(noise: tp.Optional[torch.Tensor], indices: tp.Optional[torch.Tensor]) -> tp.Optional[torch.Tensor]:
+    # Noise drawn over all the tokens, for the candidates given by `indices` if any.
+    if noise is None or indices is None:
+        return noise
+    return torch.gather(noise, -1, indices)
+
+
+def get_sampling_probs(logits: torch.Tensor, use_sampling: bool = True, temp: PerRow = 1.0,
+                       top_k: tp.Union[int, torch.Tensor] = 0, top_p: PerRow = 0.0,
+                       min_p: float = 0.0) -> torch.Tensor:
+    """Return the probabilities over the last dimension that `sample_next_token` samples from,
+    with the same filters, or a one-hot distribution on the argmax for greedy decoding.
+
+    Args:
+        logits (torch.Tensor): Logits of shape [..., card].
+        use_sampling (bool): If False, or if `temp` is 0, greedy decoding is used.
+        temp, top_k, top_p, min_p: See `sample_next_token`.
+    Returns:
+        torch.Tensor: Probabilities of shape [..., card].
+    """
+    logits = logits.float()
+    card = logits.shape[-1]
+    if use_sampling and _is_per_row(temp, top_k, top_p):
+        logits, row_indices, greedy = _filter_logits_per_row(logits, temp, top_k, top_p, min_p)
+        probs = torch.softmax(logits, dim=-1)
+        one_hot = torch.zeros_like(probs)
+        one_hot[..., 0] = 1.
+        probs = torch.where(greedy, one_hot, probs)
+        return torch.zeros(*probs.shape[:-1], card, device=probs.device).scatter_(-1, row_indices, probs)
+    if not use_sampling or temp <= 0:
+        probs = torch.zeros_like(logits)
+        return probs.scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.)
+    logits = logits / temp
+    indices: tp.Optional[torch.Tensor] = None
+    if 0 < top_k < card:
+        logits, indices = torch.topk(logits, int(top_k), dim=-1)
+        if top_p > 0:
+            logits = logits.masked_fill(_top_p_mask(logits, top_p), float('-inf'))
+    elif top_p > 0:
+        logits, indices = torch.sort(logits, dim=-1, descending=True)
+        logits = logits.masked_fill(_top_p_mask(logits, top_p), float('-inf'))
+    if min_p > 0:
+        max_logit = logits.max(dim=-1, keepdim=True).values
+        logits = logits.masked_fill(logits < max_logit + math.log(min_p), float('-inf'))
+    probs = torch.softmax(logits, dim=-1)
+    if indices is not None:
+        probs = torch.zeros(*probs.shape[:-1], card, device=probs.device).scatter_(-1, indices, probs)
+    return probs
+
+
+def sample_from_probs(probs: torch.Tensor, gumbel: bool = True,
+                      generator: tp.Optional[torch.Generator] = None) -> torch.Tensor:
+    """Sample from possibly unnormalized probabilities over the last dimension,
+    returning indices of shape [..., 1].
+    """
+    return _sample_from_logits(probs.float().log(), gumbel, generator)
+
+
+def speculative_sample(target_probs: torch.Tensor, draft_probs: torch.Tensor, draft_tokens: torch.Tensor,
+                       generator: tp.Optional[torch.Generator] = None) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    """Rejection sampling step of speculative decoding (https://arxiv.org/abs/2211.17192).
+    Each draft token `x` is accepted with probability min(1, p(x) / q(x)), and otherwise
+    replaced by a sample from the normalized max(0, p - q), so that the returned tokens
+    follow the target distribution p whatever the draft distribution q.
+
+    Args:
+        target_probs (torch.Tensor): Target probabilities p of shape [..., card].
+        draft_probs (torch.Tensor): Draft probabilities q of shape [..., card].
+        draft_tokens (torch.Tensor): Tokens sampled from the draft probabilities, of shape [..., 1].
+        generator (torch.Generator, optional): Random number generator to use.
+    Returns:
+        tuple of torch.Tensor: Tokens of shape [..., 1], and boolean tensor of the same shape,
+            True where the draft token was accepted.
+    """
+    target = target_probs.gather(-1, draft_tokens)
+    draft = draft_probs.gather(-1, draft_tokens)
+    uniform = torch.rand(target.shape, device=target.device, generator=generator)
+    accepted = uniform * draft < target
+    residual = (target_probs - draft_probs).clamp_(min=0)
+    # the residual is only null where p = q, in which case the draft token is always accepted.
+    residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, target_probs)
+    resampled = sample_from_probs(residual, generator=generator)
+    return torch.where(accepted, draft_tokens, resampled), accepted
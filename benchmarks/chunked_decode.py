@@ -0,0 +1,167 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the peak memory and the throughput of decoding long token sequences with the compression model:
+all at once with `decode`, by overlapping chunks with `decode_chunked`, sequentially or with parallel
+threads, and frame by frame in streaming mode. The difference with the output of `decode` is also reported.
+
+On CPU, the peak memory is the increase of the maximum resident set size of a fresh process
+for each measure, on GPU the maximum of the memory allocated by PyTorch. The compression model
+is randomly initialized with the architecture of the 32 kHz EnCodec of MusicGen, unless a released
+one is given with `--checkpoint` (e.g. small).
+
+    python -m benchmarks.chunked_decode --durations 30 120 300
+    python -m benchmarks.chunked_decode --durations 300 --chunk-duration 10 --num-workers 4
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import typing as tp
+
+import torch
+
+from audiocraft import quantization as qt
+from audiocraft.models.encodec import CompressionModel, EncodecModel
+from audiocraft.models.loaders import load_compression_model
+from audiocraft.modules import SEANetDecoder, SEANetEncoder
+from .common import print_table, synchronize
+
+
+METHODS = ['full', 'chunked', 'chunked_parallel', 'streaming']
+
+
+def get_compression_model(args) -> CompressionModel:
+    if args.checkpoint is not None:
+        return load_compression_model(args.checkpoint, device=args.device)
+    seanet_kwargs = {
+        'n_filters': 64,
+        'n_residual_layers': 1,
+        'dimension': 128,
+        'ratios': [8, 5, 4, 4],  # 50 Hz at 32kHz
+        'lstm': 2,
+        'norm': 'weight_norm',
+        'pad_mode': 'constant',
+    }
+    encoder = SEANetEncoder(**seanet_kwargs)
+    decoder = SEANetDecoder(**seanet_kwargs)
+    quantizer = qt.ResidualVectorQuantizer(dimension=128, bins=2048, n_q=4)
+    model = EncodecModel(encoder, decoder, quantizer, frame_rate=50, sample_rate=32000, channels=1)
+    return model.to(args.device).eval()
+
+
+def decode_streaming(model: CompressionModel, codes: torch.Tensor, chunk_length: int) -> torch.Tensor:
+    out = None
+    offset = 0
+    with model.streaming():
+        for start in range(0, codes.shape[-1] + chunk_length, chunk_length):
+            if start < codes.shape[-1]:
+                chunk = model.decode(codes[..., start:start + chunk_length])
+            else:
+                chunk = model.flush_decoder()
+            if out is None:
+                hop_length = model.sample_rate // model.frame_rate
+                out = chunk.new_empty(*chunk.shape[:-1], codes.shape[-1] * hop_length)
+            out[..., offset:offset + chunk.shape[-1]] = chunk
+            offset += chunk.shape[-1]
+    assert out is not None
+    return out
+
+
+def decode(model: CompressionModel, codes: torch.Tensor, method: str, args) -> torch.Tensor:
+    chunk_length = int(args.chunk_duration * model.frame_rate)
+    overlap = int(args.overlap_duration * model.frame_rate)
+    if method == 'full':
+        return model.decode(codes)
+    elif method == 'chunked':
+        return model.decode_chunked(codes, chunk_length=chunk_length, overlap=overlap)
+    elif method == 'chunked_parallel':
+        return model.decode_chunked(codes, chunk_length=chunk_length, overlap=overlap, num_workers=args.num_workers)
+    elif method == 'streaming':
+        return decode_streaming(model, codes, chunk_length)
+    raise ValueError(method)
+
+
+def get_peak_memory(device: str) -> int:
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated()
+    # in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@torch.no_grad()
+def measure(args) -> tp.Dict[str, tp.Any]:
+    torch.manual_seed(0)
+    model = get_compression_model(args)
+    codes = torch.randint(model.cardinality, (args.batch_size, model.num_codebooks,
+                                              int(args.duration * model.frame_rate)), device=args.device)
+    # warmup
+    decode(model, codes[..., :model.frame_rate], args.method, args)
+    if torch.device(args.device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    else:
+        base_memory = get_peak_memory(args.device)
+    synchronize(args.device)
+    begin = time.perf_counter()
+    out = decode(model, codes, args.method, args)
+    synchronize(args.device)
+    elapsed = time.perf_counter() - begin
+    row = {
+        'duration_s': args.duration,
+        'method': args.method,
+        'peak_mem_mb': max(0, get_peak_memory(args.device) - base_memory) / 2 ** 20,
+        'wall_time_s': elapsed,
+        'realtime_factor': args.batch_size * args.duration / elapsed,
+        'max_abs_err': '-',
+    }
+    if args.method != 'full':
+        # measured after the peak memory, as the reference is decoded all at once. Its last second
+        # is left out, as it depends on the padding at the end of the truncated codes.
+        reference = model.decode(codes[..., :int(args.reference_duration * model.frame_rate)])
+        reference = reference[..., :-model.sample_rate]
+        row['max_abs_err'] = (out[..., :reference.shape[-1]] - reference).abs().max().item()
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', help="Use the compression model of a released model.")
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--durations', type=float, nargs='+', default=[30., 120., 300.])
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--chunk-duration', type=float, default=10.)
+    parser.add_argument('--overlap-duration', type=float, default=1.)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--reference-duration', type=float, default=30.,
+                        help="Duration over which the output is compared with the one of `decode`.")
+    # used internally to measure each method in a fresh process.
+    parser.add_argument('--duration', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--method', choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method is not None:
+        print(json.dumps(measure(args)))
+        return
+    rows = []
+    for duration in args.durations:
+        for method in args.methods:
+            if method == 'chunked_parallel' and torch.device(args.device).type != 'cpu':
+                continue
+            command = [sys.executable, '-m', 'benchmarks.chunked_decode', *sys.argv[1:],
+                       '--duration', str(duration), '--method', method]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+            rows.append(json.loads(output.strip().splitlines()[-1]))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
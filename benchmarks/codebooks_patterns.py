@@ -0,0 +1,153 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the codebooks pattern overhead with the vectorized scatter indexes and timestep lookup
+of `Pattern`, and with the previous implementation walking the layout in Python loops,
+reproduced below. Two uses are measured, each with a new pattern provider per call (cold,
+as for a new sequence length) and with a cached one (warm):
+- training: the pattern part of `LMModel.compute_predictions`, building the pattern sequence
+  of the codes and reverting the pattern of the logits,
+- generation setup: what `LMModel.generate` does before decoding, getting the pattern,
+  building the sequence and looking up the first step to generate.
+
+    python -m benchmarks.codebooks_patterns --timesteps 1500 --batch-size 4
+"""
+
+import argparse
+from contextlib import contextmanager
+import gc
+import time
+import typing as tp
+
+import numpy as np
+import torch
+
+from audiocraft.modules.codebooks_patterns import DelayedPatternProvider, Pattern
+from .common import print_table, synchronize
+
+
+def loop_pattern_sequence_scatter_indexes(self: Pattern, timesteps: int, n_q: int, keep_only_valid_steps: bool,
+                                          device: tp.Union[torch.device, str] = 'cpu'):
+    ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
+    indexes = np.full((n_q, len(ref_layout)), n_q * timesteps, dtype=np.int64)
+    mask = np.zeros((n_q, len(ref_layout)), dtype=bool)
+    for s, sequence_coords in enumerate(ref_layout):
+        for coords in sequence_coords:
+            if coords.t < timesteps:
+                indexes[coords.q, s] = coords.t + coords.q * timesteps
+                mask[coords.q, s] = 1
+    return torch.from_numpy(indexes).to(device), torch.from_numpy(mask).to(device)
+
+
+def loop_reverted_sequence_scatter_indexes(self: Pattern, sequence_steps: int, n_q: int,
+                                           keep_only_valid_steps: bool = False, is_model_output: bool = False,
+                                           device: tp.Union[torch.device, str] = 'cpu'):
+    ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
+    if is_model_output:
+        ref_layout = ref_layout[1:]
+    indexes = np.full((n_q, self.timesteps), n_q * sequence_steps, dtype=np.int64)
+    mask = np.zeros((n_q, self.timesteps), dtype=bool)
+    for s, sequence_codes in enumerate(ref_layout):
+        if s < sequence_steps:
+            for code in sequence_codes:
+                if code.t < self.timesteps:
+                    indexes[code.q, code.t] = s + code.q * sequence_steps
+                    mask[code.q, code.t] = 1
+    return torch.from_numpy(indexes).to(device), torch.from_numpy(mask).to(device)
+
+
+def loop_first_step_with_timesteps(self: Pattern, t: int, q: tp.Optional[int] = None) -> tp.Optional[int]:
+    steps = self.get_steps_with_timestep(t, q)
+    return steps[0] if steps else None
+
+
+def loop_max_delay(self: Pattern) -> int:
+    max_t = 0
+    for sequence_coords in self.layout[1:]:
+        for coords in sequence_coords:
+            max_t = max(max_t, coords.t + 1)
+    return max_t - self.timesteps
+
+
+@contextmanager
+def loops():
+    """Use the loop based implementation for the patterns created within the context."""
+    names = ['_build_pattern_sequence_scatter_indexes', '_build_reverted_sequence_scatter_indexes',
+             'get_first_step_with_timesteps', 'max_delay']
+    previous = {name: Pattern.__dict__[name] for name in names}
+    Pattern._build_pattern_sequence_scatter_indexes = loop_pattern_sequence_scatter_indexes  # type: ignore
+    Pattern._build_reverted_sequence_scatter_indexes = loop_reverted_sequence_scatter_indexes  # type: ignore
+    Pattern.get_first_step_with_timesteps = loop_first_step_with_timesteps  # type: ignore
+    Pattern.max_delay = property(loop_max_delay)  # type: ignore
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(Pattern, name, value)
+
+
+def training(provider: DelayedPatternProvider, codes: torch.Tensor, logits: torch.Tensor):
+    pattern = provider.get_pattern(codes.shape[-1])
+    pattern.build_pattern_sequence(codes, special_token=2048, keep_only_valid_steps=True)
+    pattern.revert_pattern_logits(logits, float('nan'), keep_only_valid_steps=True)
+
+
+def generation_setup(provider: DelayedPatternProvider, codes: torch.Tensor, logits: torch.Tensor):
+    timesteps = codes.shape[-1]
+    pattern = provider.get_pattern(timesteps)
+    gen_codes = torch.full_like(codes, -1)
+    pattern.build_pattern_sequence(gen_codes, special_token=2048)
+    pattern.get_first_step_with_timesteps(timesteps // 2)
+
+
+def measure(fn, n_q: int, codes: torch.Tensor, logits: torch.Tensor, repeats: int, cold: bool, device: str) -> float:
+    provider = DelayedPatternProvider(n_q)
+    fn(provider, codes, logits)
+    # the layouts create many small objects, garbage collections would dominate the timings otherwise.
+    gc.collect()
+    gc.disable()
+    try:
+        synchronize(device)
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            if cold:
+                provider = DelayedPatternProvider(n_q)
+            fn(provider, codes, logits)
+        synchronize(device)
+    finally:
+        gc.enable()
+    return 1000 * (time.perf_counter() - begin) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--num-codebooks', type=int, default=4)
+    parser.add_argument('--timesteps', type=int, default=1500)
+    parser.add_argument('--card', type=int, default=64, help="Cardinality of the fake logits.")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    K, T = args.num_codebooks, args.timesteps
+    codes = torch.randint(args.card, (args.batch_size, K, T), device=args.device)
+    # logits over the valid steps of the delayed pattern: T + 1 steps, the last K - 1 ones being invalid.
+    logits = torch.randn(args.batch_size, args.card, K, T + 1, device=args.device)
+    rows = []
+    for name, fn in [('training', training), ('generation_setup', generation_setup)]:
+        for cold in [True, False]:
+            row: tp.Dict[str, tp.Any] = {'use': name, 'cache': 'cold' if cold else 'warm'}
+            with loops():
+                row['loops_ms'] = measure(fn, K, codes, logits, args.repeats, cold, args.device)
+            row['vectorized_ms'] = measure(fn, K, codes, logits, args.repeats, cold, args.device)
+            row['speedup'] = row['loops_ms'] / row['vectorized_ms']
+            rows.append(row)
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Shared helpers for the benchmarks: randomly initialized LMs of configurable size,
+so that benchmarks can run without downloading checkpoints, and timing utilities.
+"""
+
+import argparse
+import statistics
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models.lm import LMModel
+from audiocraft.modules.codebooks_patterns import DelayedPatternProvider
+from audiocraft.modules.conditioners import ConditioningProvider, ConditionFuser, LUTConditioner
+
+
+# dim, num_heads, num_layers of the pretrained MusicGen models.
+LM_SIZES = {
+    'debug': (16, 4, 2),
+    'small': (1024, 16, 24),
+    'medium': (1536, 24, 48),
+    'large': (2048, 32, 48),
+}
+
+
+def add_lm_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--size', choices=list(LM_SIZES), default='small', help="Size of the random LM.")
+    parser.add_argument('--num-layers', type=int, help="Override the number of layers of the LM.")
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'bfloat16'], default='float32')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=250, help="Number of timesteps to generate.")
+
+
+def get_lm_model(size: str = 'small', num_layers: tp.Optional[int] = None, device: str = 'cpu',
+                 dtype: torch.dtype = torch.float32, n_q: int = 4, card: int = 2048) -> LMModel:
+    """Return a randomly initialized LM with the architecture of the given MusicGen size."""
+    dim, num_heads, default_layers = LM_SIZES[size]
+    pattern = DelayedPatternProvider(n_q=n_q)
+    providers = {
+        'description': LUTConditioner(n_bins=128, dim=dim, output_dim=dim, tokenizer="whitespace"),
+    }
+    condition_provider = ConditioningProvider(providers)
+    fuser = ConditionFuser(
+        {'cross': ['description'], 'prepend': [],
+         'sum': [], 'input_interpolate': []})
+    lm = LMModel(
+        pattern, condition_provider, fuser, n_q=n_q, card=card, dim=dim, num_heads=num_heads,
+        hidden_scale=4, custom=True, num_layers=num_layers or default_layers,
+        cross_attention=True, causal=True)
+    return lm.to(device=device, dtype=dtype).eval()
+
+
+def get_lm_model_from_args(args: argparse.Namespace) -> LMModel:
+    return get_lm_model(args.size, args.num_layers, args.device, getattr(torch, args.dtype))
+
+
+def synchronize(device: tp.Union[str, torch.device]):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+class StepTimer:
+    """Progress callback recording the time of each generation step. The device is
+    synchronized at each step, so that the durations match the device time.
+    """
+    def __init__(self, device: tp.Union[str, torch.device]):
+        self.device = device
+        self.times: tp.List[float] = []
+
+    def __call__(self, generated_tokens: int, tokens_to_generate: int):
+        synchronize(self.device)
+        self.times.append(time.perf_counter())
+
+    @property
+    def step_durations(self) -> tp.List[float]:
+        # the first step includes the prefill, we only keep the following ones.
+        return [end - begin for begin, end in zip(self.times[:-1], self.times[1:])]
+
+    def summary(self) -> tp.Dict[str, float]:
+        durations = sorted(self.step_durations)
+        return {
+            'step_mean_ms': 1000 * statistics.mean(durations),
+            'step_p50_ms': 1000 * durations[len(durations) // 2],
+            'step_p99_ms': 1000 * durations[min(len(durations) - 1, int(0.99 * len(durations)))],
+            'last_steps_mean_ms': 1000 * statistics.mean(self.step_durations[-max(1, len(durations) // 10):]),
+        }
+
+
+def print_table(rows: tp.List[tp.Dict[str, tp.Any]]):
+    keys = list(rows[0].keys())
+    widths = [max(len(key), *(len(_format(row[key])) for row in rows)) for key in keys]
+    print('  '.join(key.ljust(width) for key, width in zip(keys, widths)))
+    for row in rows:
+        print('  '.join(_format(row[key]).ljust(width) for key, width in zip(keys, widths)))
+
+
+def _format(value: tp.Any) -> str:
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
@@ -0,0 +1,65 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the decoding throughput of `LMModel.generate` in eager mode and with the decoding
+steps compiled with `torch.compile`, see `compile_decode`. The compilation happens during
+a first warmup generation, which is reported separately.
+
+    python -m benchmarks.compile_decode --size debug --device cpu --steps 250
+    python -m benchmarks.compile_decode --size small --device cpu --steps 100
+"""
+
+import argparse
+import time
+
+import torch
+
+from audiocraft.modules.conditioners import ConditioningAttributes
+from .common import add_lm_args, get_lm_model_from_args, print_table, synchronize, StepTimer
+
+
+def run(lm, args, compile_decode: bool):
+    conditions = [ConditioningAttributes(text={'description': 'a b c'}) for _ in range(args.batch_size)]
+    timer = StepTimer(args.device)
+    synchronize(args.device)
+    begin = time.perf_counter()
+    lm.generate(conditions=conditions, max_gen_len=args.steps, cfg_coef=3.,
+                callback=timer, compile_decode=compile_decode)
+    synchronize(args.device)
+    total = time.perf_counter() - begin
+    summary = timer.summary()
+    return {
+        'decode': 'compiled' if compile_decode else 'eager',
+        'tokens_per_s': args.batch_size * args.steps / total,
+        'decode_tokens_per_s': 1000 * args.batch_size / summary['step_mean_ms'],
+        **summary,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_lm_args(parser)
+    parser.add_argument('--repeats', type=int, default=2,
+                        help="Runs per variant, the first one is a warmup, only reported with a single run.")
+    parser.set_defaults(device='cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    lm = get_lm_model_from_args(args)
+    rows = []
+    for compile_decode in [False, True]:
+        begin = time.perf_counter()
+        row = run(lm, args, compile_decode)
+        warmup = time.perf_counter() - begin
+        for _ in range(args.repeats - 1):
+            row = run(lm, args, compile_decode)
+        rows.append({**row, 'warmup_s': warmup})
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare static batching, where each batch of requests runs `LMModel.generate` until its
+longest request is done, with the `ContinuousBatchingEngine`, on a synthetic trace of requests
+arriving as a Poisson process with random durations. Reports the throughput, in generated
+timesteps per second, and the latency of the requests from their arrival to their completion.
+
+    python -m benchmarks.continuous_batching --size debug --num-requests 64 --rate 20
+"""
+
+import argparse
+from dataclasses import dataclass
+import random
+import statistics
+import time
+import typing as tp
+
+from audiocraft.models.continuous_batching import ContinuousBatchingEngine
+from audiocraft.models.lm import LMModel
+from audiocraft.modules.conditioners import ConditioningAttributes
+from .common import add_lm_args, get_lm_model_from_args, print_table, synchronize
+
+
+@dataclass
+class Request:
+    arrival: float
+    max_gen_len: int
+    finished: tp.Optional[float] = None
+
+
+def make_trace(num_requests: int, rate: float, min_steps: int, max_steps: int, seed: int) -> tp.List[Request]:
+    rng = random.Random(seed)
+    arrival = 0.
+    trace = []
+    for _ in range(num_requests):
+        arrival += rng.expovariate(rate)
+        trace.append(Request(arrival, rng.randint(min_steps, max_steps)))
+    return trace
+
+
+def run_static(lm: LMModel, trace: tp.List[Request], batch_size: int, device: str) -> float:
+    conditions = ConditioningAttributes(text={'description': 'a b c'})
+    begin = time.perf_counter()
+    index = 0
+    while index < len(trace):
+        now = time.perf_counter() - begin
+        if trace[index].arrival > now:
+            time.sleep(trace[index].arrival - now)
+            now = trace[index].arrival
+        batch = [request for request in trace[index:index + batch_size] if request.arrival <= now]
+        index += len(batch)
+        lm.generate(None, [conditions] * len(batch), max_gen_len=max(request.max_gen_len for request in batch),
+                    use_sampling=True, top_k=250)
+        synchronize(device)
+        for request in batch:
+            request.finished = time.perf_counter() - begin
+    return time.perf_counter() - begin
+
+
+def run_continuous(lm: LMModel, trace: tp.List[Request], batch_size: int, device: str) -> float:
+    conditions = ConditioningAttributes(text={'description': 'a b c'})
+    max_gen_len = max(request.max_gen_len for request in trace)
+    with ContinuousBatchingEngine(lm, max_batch_size=batch_size, max_gen_len=max_gen_len, top_k=250) as engine:
+        rows: tp.Dict[int, Request] = {}
+        begin = time.perf_counter()
+        index = 0
+        while index < len(trace) or not engine.is_idle:
+            now = time.perf_counter() - begin
+            if engine.is_idle and trace[index].arrival > now:
+                time.sleep(trace[index].arrival - now)
+                now = trace[index].arrival
+            while index < len(trace) and trace[index].arrival <= now:
+                rows[id(engine.add(conditions, trace[index].max_gen_len))] = trace[index]
+                index += 1
+            finished = engine.step()
+            synchronize(device)
+            for row in finished:
+                rows.pop(id(row)).finished = time.perf_counter() - begin
+    return time.perf_counter() - begin
+
+
+def summarize(name: str, trace: tp.List[Request], total: float) -> tp.Dict[str, tp.Any]:
+    latencies = sorted(request.finished - request.arrival for request in trace if request.finished is not None)
+    return {
+        'batching': name,
+        'timesteps_per_s': sum(request.max_gen_len for request in trace) / total,
+        'latency_mean_s': statistics.mean(latencies),
+        'latency_p50_s': latencies[len(latencies) // 2],
+        'latency_p99_s': latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_lm_args(parser)
+    parser.add_argument('--num-requests', type=int, default=64)
+    parser.add_argument('--rate', type=float, default=20., help="Mean number of requests arriving per second.")
+    parser.add_argument('--min-steps', type=int, default=25, help="Minimum number of timesteps of a request.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.set_defaults(size='debug', batch_size=8)
+    args = parser.parse_args()
+
+    lm = get_lm_model_from_args(args)
+    rows = []
+    for name, run in [('static', run_static), ('continuous', run_continuous)]:
+        trace = make_trace(args.num_requests, args.rate, args.min_steps, args.steps, args.seed)
+        total = run(lm, trace, args.batch_size, args.device)
+        rows.append(summarize(name, trace, total))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
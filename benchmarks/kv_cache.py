@@ -0,0 +1,57 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the per-step latency and peak memory of the LM decoding loop with the
+default self attention KV cache, concatenated at every step, and with the
+preallocated static one, see `StreamingTransformer.static_kv_cache`.
+
+    python -m benchmarks.kv_cache --size small --steps 1500 --batch-size 4
+"""
+
+import argparse
+
+import torch
+
+from audiocraft.modules.conditioners import ConditioningAttributes
+from .common import add_lm_args, get_lm_model_from_args, print_table, synchronize, StepTimer
+
+
+def run(lm, args, static_kv_cache: bool):
+    conditions = [ConditioningAttributes(text={'description': 'a b c'}) for _ in range(args.batch_size)]
+    cuda = torch.device(args.device).type == 'cuda'
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    timer = StepTimer(args.device)
+    synchronize(args.device)
+    lm.generate(conditions=conditions, max_gen_len=args.steps, cfg_coef=3.,
+                callback=timer, static_kv_cache=static_kv_cache)
+    row = {'kv_cache': 'static' if static_kv_cache else 'concat', **timer.summary()}
+    if cuda:
+        row['peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_lm_args(parser)
+    parser.add_argument('--repeats', type=int, default=2, help="Runs per variant, the first one is a warmup.")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    lm = get_lm_model_from_args(args)
+    rows = []
+    with torch.no_grad():
+        for static_kv_cache in [False, True]:
+            for _ in range(args.repeats):
+                row = run(lm, args, static_kv_cache)
+            rows.append(row)
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the wall time of the token generation for durations past `max_duration`, between
+the default extension, which restarts the LM every `extend_stride` seconds from a prompt of the
+last `max_duration - extend_stride` seconds, and the sliding window one, which keeps a single
+streaming session where each step attends to the previous `max_duration` seconds,
+see `MusicGen.set_generation_params`. Only the LM runs, at the 50 Hz frame rate of MusicGen.
+
+The decoding is greedy, so that the tokens of both extensions can be compared: they are the same
+up to about `max_duration`, then the sliding window keeps attending to the whole previous `max_duration` seconds
+with positions past the ones seen in training, while each window restarts from position 0. `agreement`
+is the fraction of the timesteps past `max_duration` for which the sliding window generates the same
+tokens as the windows, as a measure of how far it drifts from the default extension.
+
+    python -m benchmarks.long_form --size small --durations 60 120 180
+    python -m benchmarks.long_form --size debug --durations 60 120 180
+"""
+
+import argparse
+from types import SimpleNamespace
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models import MusicGen
+from .common import add_lm_args, get_lm_model_from_args, print_table, synchronize
+
+
+def run(mg: MusicGen, args, duration: float, sliding_window: bool) -> tp.Tuple[dict, torch.Tensor]:
+    attributes, _ = mg._prepare_tokens_and_attributes(['a b c'] * args.batch_size, None)
+    synchronize(args.device)
+    begin = time.perf_counter()
+    tokens = torch.cat(list(mg._generate_tokens_stream(
+        attributes, None, duration=duration, sliding_window=sliding_window)), dim=-1)
+    synchronize(args.device)
+    elapsed = time.perf_counter() - begin
+    assert tokens.shape[-1] == int(duration * mg.frame_rate)
+    row = {
+        'duration_s': duration,
+        'extension': 'sliding' if sliding_window else 'windows',
+        'wall_time_s': elapsed,
+        'tokens_per_s': args.batch_size * tokens.shape[-1] / elapsed,
+    }
+    return row, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_lm_args(parser)
+    parser.add_argument('--durations', type=float, nargs='+', default=[60., 120., 180.])
+    parser.add_argument('--max-duration', type=float, default=30.)
+    parser.add_argument('--extend-stride', type=float, default=18.)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    lm = get_lm_model_from_args(args)
+    # only the frame rate of the compression model is used to generate the tokens.
+    compression_model = SimpleNamespace(frame_rate=50, sample_rate=32000, channels=1)
+    mg = MusicGen('benchmark', compression_model, lm, max_duration=args.max_duration)  # type: ignore
+    mg.set_generation_params(extend_stride=args.extend_stride, cfg_coef=3., use_sampling=False)
+    mg.set_custom_progress_callback(lambda generated, total: None)
+    # warmup
+    run(mg, args, args.max_duration / 10, sliding_window=False)
+    rows = []
+    max_frames = int(args.max_duration * mg.frame_rate)
+    for duration in args.durations:
+        windows_row, windows_tokens = run(mg, args, duration, sliding_window=False)
+        sliding_row, sliding_tokens = run(mg, args, duration, sliding_window=True)
+        # the last frames of the first window are completed without the following frames of the first codebooks.
+        prefix = max_frames - lm.num_codebooks
+        assert torch.equal(sliding_tokens[..., :prefix], windows_tokens[..., :prefix])
+        same = (sliding_tokens == windows_tokens).all(dim=1)[:, max_frames:]
+        windows_row['agreement'] = '-'
+        sliding_row['agreement'] = same.float().mean().item()
+        rows += [windows_row, sliding_row]
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
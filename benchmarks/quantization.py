@@ -0,0 +1,121 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the int8 quantized LM (see `LMModel.quantize_`) with the float32 one on CPU:
+memory of the weights, decoding throughput, and accuracy. The accuracy is measured
+on the same random codes fed to both models, with the error of the logits relative to their norm,
+the maximum absolute error and the agreement of the top-1 tokens, then on greedy generations,
+with the fraction of identical tokens and the first timestep where they differ.
+
+Randomly initialized LMs have rather flat distributions, on which the top-1 agreement is pessimistic,
+a released checkpoint can be given instead with `--checkpoint` (e.g. small, or a path).
+
+    python -m benchmarks.quantization --sizes debug small --steps 100
+    python -m benchmarks.quantization --checkpoint small --steps 100
+"""
+
+import argparse
+import copy
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models.lm import LMModel
+from audiocraft.models.loaders import load_lm_model
+from audiocraft.modules.conditioners import ConditioningAttributes
+from .common import LM_SIZES, get_lm_model, print_table, StepTimer
+
+
+def get_memory(lm: LMModel) -> int:
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(lm.parameters()) + list(lm.buffers()))
+
+
+def get_conditions(batch_size: int):
+    return [ConditioningAttributes(text={'description': 'a b c'}) for _ in range(batch_size)]
+
+
+@torch.no_grad()
+def compare_logits(lm: LMModel, quantized: LMModel, batch_size: int, steps: int):
+    codes = torch.randint(lm.card, (batch_size, lm.num_codebooks, steps))
+    conditions = get_conditions(batch_size)
+    reference = lm.compute_predictions(codes, conditions)
+    output = quantized.compute_predictions(codes, conditions).logits
+    mask = reference.mask
+    logits = reference.logits[mask]
+    output = output[mask]
+    return {
+        'logits_rel_err': ((output - logits).norm() / logits.norm()).item(),
+        'logits_max_err': (output - logits).abs().max().item(),
+        'top1_agreement': (output.argmax(-1) == logits.argmax(-1)).float().mean().item(),
+    }
+
+
+def compare_greedy(lm: LMModel, quantized: LMModel, batch_size: int, steps: int):
+    conditions = get_conditions(batch_size)
+    reference = lm.generate(conditions=conditions, max_gen_len=steps, use_sampling=False, cfg_coef=3.)
+    output = quantized.generate(conditions=conditions, max_gen_len=steps, use_sampling=False, cfg_coef=3.)
+    # first timestep where any sample differs, or the number of steps if they never do.
+    differs = (output != reference).flatten(0, 1).any(dim=0).nonzero()
+    return {
+        'token_agreement': (output == reference).float().mean().item(),
+        'first_divergence': int(differs[0]) if len(differs) else steps,
+    }
+
+
+def measure_speed(lm: LMModel, batch_size: int, steps: int) -> float:
+    lm.generate(conditions=get_conditions(batch_size), max_gen_len=4, cfg_coef=3.)
+    timer = StepTimer('cpu')
+    lm.generate(conditions=get_conditions(batch_size), max_gen_len=steps, cfg_coef=3., callback=timer)
+    return 1000 * batch_size / timer.summary()['step_mean_ms']
+
+
+def benchmark(name: str, lm: LMModel, args) -> tp.List[tp.Dict[str, tp.Any]]:
+    begin = time.perf_counter()
+    quantized = copy.deepcopy(lm).quantize_()
+    quantize_time = time.perf_counter() - begin
+    accuracy = {
+        **compare_logits(lm, quantized, args.batch_size, args.steps),
+        **compare_greedy(lm, quantized, args.batch_size, args.steps),
+    }
+    rows = []
+    for dtype, model in [('float32', lm), ('int8', quantized)]:
+        row = {
+            'model': name,
+            'dtype': dtype,
+            'memory_mb': get_memory(model) / 2 ** 20,
+            'decode_tokens_per_s': measure_speed(model, args.batch_size, args.steps),
+        }
+        for key, value in accuracy.items():
+            row[key] = value if dtype == 'int8' else '-'
+        row['quantize_s'] = quantize_time if dtype == 'int8' else '-'
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=list(LM_SIZES), default=['debug', 'small'],
+                        help="Sizes of the random LMs to compare.")
+    parser.add_argument('--num-layers', type=int, help="Override the number of layers of the random LMs.")
+    parser.add_argument('--checkpoint', help="Compare a released LM instead of random ones.")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=100, help="Number of timesteps to evaluate and generate.")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    rows = []
+    if args.checkpoint is not None:
+        rows += benchmark(args.checkpoint, load_lm_model(args.checkpoint, device='cpu'), args)
+    else:
+        for size in args.sizes:
+            rows += benchmark(size, get_lm_model(size, args.num_layers), args)
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the time taken to sample the tokens of a decoding step with the full softmax
+and masking of `utils.sample_top_k` / `utils.sample_top_p`, and with the fused
+`utils.sampling.sample_next_token`, for the B x K rows of a MusicGen step.
+
+    python -m benchmarks.sampling --batch-size 8 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from audiocraft.utils import utils
+from audiocraft.utils.sampling import sample_next_token
+from .common import print_table, synchronize
+
+
+def reference(logits, temp, top_k, top_p):
+    probs = torch.softmax(logits / temp, dim=-1)
+    if top_p > 0:
+        return utils.sample_top_p(probs, p=top_p)
+    return utils.sample_top_k(probs, k=top_k)
+
+
+def measure(fn, repeats: int, device: str) -> float:
+    for _ in range(3):
+        fn()
+    synchronize(device)
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return 1000 * (time.perf_counter() - begin) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-codebooks', type=int, default=4)
+    parser.add_argument('--card', type=int, default=2048)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    logits = torch.randn(args.batch_size, args.num_codebooks, args.card, device=args.device) * 3
+    rows = []
+    for top_k, top_p in [(250, 0.), (0, 0.9), (50, 0.)]:
+        setting = f'top_k={top_k}' if top_p == 0 else f'top_p={top_p}'
+        row = {'setting': setting,
+               'reference_ms': measure(lambda: reference(logits, 1., top_k, top_p), args.repeats, args.device)}
+        for gumbel in [False, True]:
+            name = 'gumbel_ms' if gumbel else 'multinomial_ms'
+            row[name] = measure(lambda: sample_next_token(logits, 1., top_k, top_p, gumbel=gumbel),
+                                args.repeats, args.device)
+        rows.append(row)
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measure the overhead of the conditioning for each window of a generation longer than `max_duration`,
+between computing the conditions again for each window, as MusicGen used to, and computing them once
+for the whole generation, see `MusicGen._prepare_window_conditions`. With the melody model, computing them
+for each window runs T5, Demucs and the chroma extraction over the window of the melody, while computing
+them once runs Demucs over the melody only once, each window slicing its chroma. Only the conditioning runs.
+
+    python -m benchmarks.window_conditioning --model melody --duration 120 --melody-duration 20
+    python -m benchmarks.window_conditioning --model debug --duration 120
+"""
+
+import argparse
+import time
+
+import torch
+
+from audiocraft.models import MusicGen
+from audiocraft.modules.conditioners import WavCondition
+from .common import print_table, synchronize
+
+
+def get_window_offsets(mg: MusicGen, duration: float):
+    # time offsets of the windows, as in `MusicGen._generate_tokens_stream` without prompt.
+    stride_tokens = int(mg.frame_rate * mg.extend_stride)
+    total_gen_len = int(duration * mg.frame_rate)
+    prompt_length = int((mg.max_duration - mg.extend_stride) * mg.frame_rate)
+    offsets = [0.]
+    current_gen_offset = stride_tokens
+    while current_gen_offset + prompt_length < total_gen_len:
+        offsets.append(current_gen_offset / mg.frame_rate)
+        current_gen_offset += stride_tokens
+    return offsets
+
+
+def run_per_window(mg: MusicGen, attributes, offsets, device):
+    # previous behavior: the melody of each window is gathered, then all the conditions computed again.
+    ref_wavs = [attr.wav['self_wav'] for attr in attributes]
+    times = []
+    for time_offset in offsets:
+        synchronize(device)
+        begin = time.perf_counter()
+        for attr, ref_wav in zip(attributes, ref_wavs):
+            wav_length = ref_wav.length.item()
+            if wav_length == 0:
+                continue
+            initial_position = int(time_offset * mg.sample_rate)
+            wav_target_length = int(mg.max_duration * mg.sample_rate)
+            positions = torch.arange(initial_position, initial_position + wav_target_length, device=mg.device)
+            attr.wav['self_wav'] = WavCondition(
+                ref_wav[0][:, positions % wav_length], torch.full_like(ref_wav[1], wav_target_length))
+        with mg.autocast:
+            mg.lm._get_cfg_conditions(attributes, two_step_cfg=False)
+        synchronize(device)
+        times.append(time.perf_counter() - begin)
+    return 0., times
+
+
+def run_reused(mg: MusicGen, attributes, offsets, duration: float, device):
+    synchronize(device)
+    begin = time.perf_counter()
+    with mg.autocast:
+        get_window_conditions = mg._prepare_window_conditions(attributes, duration, two_step_cfg=False)
+    synchronize(device)
+    setup = time.perf_counter() - begin
+    times = []
+    for time_offset in offsets:
+        begin = time.perf_counter()
+        with mg.autocast:
+            get_window_conditions(time_offset)
+        synchronize(device)
+        times.append(time.perf_counter() - begin)
+    return setup, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='melody', help="Name of the pretrained MusicGen model.")
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=120.)
+    parser.add_argument('--extend-stride', type=float, default=18.)
+    parser.add_argument('--melody-duration', type=float, default=20.,
+                        help="Duration of the random melody, ignored for the models without melody conditioning.")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    mg = MusicGen.get_pretrained(args.model, device=args.device)
+    mg.set_generation_params(extend_stride=args.extend_stride)
+    offsets = get_window_offsets(mg, args.duration)
+    descriptions = ['happy rock with electric guitars'] * args.batch_size
+    melody_wavs = None
+    if 'self_wav' in mg.lm.condition_provider.conditioners:
+        melody_wavs = [torch.randn(1, int(args.melody_duration * mg.sample_rate))] * args.batch_size
+
+    def get_attributes():
+        return mg._prepare_tokens_and_attributes(descriptions, None, melody_wavs)[0]
+
+    # warmup
+    run_per_window(mg, get_attributes(), offsets[:1], args.device)
+    rows = []
+    for name in ['per window', 'reused']:
+        if name == 'reused':
+            setup, times = run_reused(mg, get_attributes(), offsets, args.duration, args.device)
+        else:
+            setup, times = run_per_window(mg, get_attributes(), offsets, args.device)
+        rows.append({
+            'model': args.model,
+            'conditioning': name,
+            'num_windows': len(offsets),
+            'setup_s': setup,
+            'per_window_ms': 1000 * sum(times) / len(times),
+            'total_s': setup + sum(times),
+        })
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,27 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, Form, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
+import hashlib
+import json
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional
 import torch
 from audiocraft.data.audio import audio_write
-from audiocraft.models import MusicGen
+from audiocraft.models import ModelRegistry, MusicGen
+from audiocraft.models.batching import BatchingScheduler
+from audiocraft.utils import metrics
+from audiocraft.utils.cache import ContentStore
 import asyncio
 from transformers import MarianMTModel, MarianTokenizer
 from transformers import CLIPProcessor, CLIPModel
@@ -15,14 +31,80 @@ import io
 from rapidfuzz import process
 
 
+# 모델 로딩: import 시점에 순서대로 로딩하지 않고, 서버가 뜬 뒤 백그라운드에서 병렬로 로딩
+# 로딩이 끝나기 전에 모델이 필요하면 그 모델의 로딩이 끝날 때까지 기다림
+class ModelLoader:
+    def __init__(self):
+        self.loaders: Dict[str, tuple] = {}
+        self.futures: Dict[str, Future] = {}
+        self.timings: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+
+    def register(self, name: str, load, deps: tuple = ()):
+        self.loaders[name] = (load, deps)
+
+    def start(self):
+        with self.lock:
+            if self.futures:
+                return
+            self.started_at = time.perf_counter()
+            # 의존하는 모델을 기다리는 동안 스레드를 점유하므로 모델 수만큼 스레드를 둠
+            executor = ThreadPoolExecutor(max_workers=len(self.loaders), thread_name_prefix='loader')
+            for name, (load, deps) in self.loaders.items():
+                self.futures[name] = executor.submit(self._load, name, load, deps)
+            executor.shutdown(wait=False)
+        for future in list(self.futures.values()):
+            future.add_done_callback(self._on_done)
+
+    def _load(self, name: str, load, deps: tuple):
+        for dep in deps:
+            self.get(dep)
+        start = time.perf_counter()
+        value = load()
+        self.timings[name] = time.perf_counter() - start
+        print(f"{name} 로딩 완료 : {self.timings[name]:.2f}s")
+        return value
+
+    def _on_done(self, future: Future):
+        with self.lock:
+            if self.ready_at is None and self.ready():
+                self.ready_at = time.perf_counter()
+                print(f"전체 모델 로딩 완료 : {self.ready_at - self.started_at:.2f}s")
+
+    def get(self, name: str):
+        self.start()
+        return self.futures[name].result()
+
+    def status(self) -> Dict[str, str]:
+        status = {}
+        for name in self.loaders:
+            future = self.futures.get(name)
+            if future is None or not future.done():
+                status[name] = "loading"
+            elif future.exception() is not None:
+                status[name] = f"failed: {future.exception()}"
+            else:
+                status[name] = "ready"
+        return status
+
+    def ready(self) -> bool:
+        return bool(self.futures) and all(
+            future.done() and future.exception() is None for future in self.futures.values())
+
+
+loader = ModelLoader()
+
 model_name = 'Helsinki-NLP/opus-mt-ko-en'
-model = MarianMTModel.from_pretrained(model_name)
-tokenizer = MarianTokenizer.from_pretrained(model_name)
+loader.register("marian_model", lambda: MarianMTModel.from_pretrained(model_name))
+loader.register("marian_tokenizer", lambda: MarianTokenizer.from_pretrained(model_name))
 
 
 # CLIP 모델과 프로세서 로딩
-clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+clip_model_name = "openai/clip-vit-base-patch32"
+loader.register("clip_processor", lambda: CLIPProcessor.from_pretrained(clip_model_name))
+loader.register("clip_model", lambda: CLIPModel.from_pretrained(clip_model_name))
 
 
 genre_map = {
@@ -279,7 +361,6 @@ genre_map = {
 }
 
 
-
 # 테마 매핑
 theme_map = {
     "Nature": [
@@ -406,7 +487,6 @@ theme_map = {
 }
 
 
-
 # 분위기 매핑
 mood_map = {
     "Relaxed": [
@@ -512,11 +592,6 @@ mood_map = {
 }
 
 
-
-
-
-
-
 app = FastAPI()
 
 
@@ -530,143 +605,575 @@ app.add_middleware(
 
 app.mount("/audio_files", StaticFiles(directory="audio_files"), name="audio_files")
 
+# 사용할 MusicGen 모델과 상주 모델들의 메모리 한도 (GB, 설정하지 않으면 제한 없음)
+musicgen_model_name = os.environ.get('MUSICGEN_MODEL', 'large')
+memory_budget_gb = os.environ.get('MUSICGEN_MEMORY_BUDGET_GB')
+# CPU 전용: LM의 선형 레이어를 int8로 양자화해서 메모리와 디코딩 시간을 줄임
+musicgen_quantize = os.environ.get('MUSICGEN_QUANTIZE', '0') == '1'
+# 긴 음악을 디코딩할 때 청크 단위(초)로 나눠서 메모리 사용량을 제한 (설정하지 않으면 한 번에 디코딩)
+decode_chunk_seconds = os.environ.get('DECODE_CHUNK_SECONDS')
+# CPU 전용: 청크들을 병렬로 디코딩할 스레드 수
+decode_num_workers = int(os.environ.get('DECODE_NUM_WORKERS', 0))
+
+
+def load_musicgen(name: str, device) -> MusicGen:
+    model = MusicGen.get_pretrained(name, device=device, quantize=musicgen_quantize)
+    model.set_decoding_params(chunk_duration=float(decode_chunk_seconds) if decode_chunk_seconds else None,
+                              num_workers=decode_num_workers)
+    return model
+
+
+model_registry = ModelRegistry(
+    memory_budget=int(float(memory_budget_gb) * 2**30) if memory_budget_gb else None,
+    loader=load_musicgen)
+
+# 동시에 들어온 요청들을 모아서 한 번에 생성 (대기 시간 창과 최대 배치 크기)
+batch_window_ms = float(os.environ.get('BATCH_WINDOW_MS', 50))
+max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', 8))
+scheduler = BatchingScheduler(model_registry.get, window=batch_window_ms / 1000, max_batch_size=max_batch_size)
+loader.register("musicgen", lambda: model_registry.get(musicgen_model_name))
+
+
+# 워밍업: debug 모델로 짧게 한 번 생성해서 CUDA 초기화, 커널 선택 등을 첫 요청 전에 끝내둠
+def warmup():
+    debug_model = MusicGen.get_pretrained('debug', device=model_registry.device)
+    debug_model.set_generation_params(duration=1)
+    debug_model.generate(["warmup"])
+
+
+if os.environ.get('WARMUP', '0') == '1':
+    loader.register("warmup", warmup, deps=("musicgen",))
+
+# 라벨 임베딩, 번역 결과 등의 디스크 캐시 위치
+cache_dir = os.environ.get('CACHE_DIR', 'cache')
+
+# 생성 이외의 블로킹 작업(언어 감지, 번역, CLIP, 파일 저장)을 이벤트 루프 밖에서 처리하는 전용 워커
+worker_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('NUM_WORKERS', 4)), thread_name_prefix='worker')
+
 duration: int = 15
 topk: int = 250
 topp: float = 0.0
 temperature: float = 1.0
 cfg_coef: float = 3.0
+# seed를 지정하지 않은 요청에 사용하는 seed (요청마다 자기 seed의 난수 생성기로 샘플링하므로 같은 배치의 다른 요청과 무관하게 결과가 같음)
+default_seed: int = int(os.environ.get('DEFAULT_SEED', 0))
+
+# 생성 결과 저장소: 번역된 텍스트, 모델, 생성 파라미터, seed의 해시를 파일 이름으로 사용
+result_cache_max_mb = float(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+result_store = ContentStore("audio_files/results", max_size=int(result_cache_max_mb * 2**20), suffix=".wav")
+
+# 스트리밍 응답에서 한 번에 보내는 오디오 길이 (초)
+stream_chunk_duration = float(os.environ.get('STREAM_CHUNK_SECONDS', 0.5))
+
+# 캐시 적중 / 실패 횟수 (/metrics 에서 확인)
+cache_lookups = metrics.REGISTRY.counter("cache_lookups", "Number of cache lookups.", ["cache", "result"])
+
+
+def count_lookup(cache: str, value) -> bool:
+    hit = value is not None
+    cache_lookups.inc(cache=cache, result="hit" if hit else "miss")
+    return hit
+
 
 class MusicRequest(BaseModel):
     text: str
+    seed: Optional[int] = None
+
+
+async def run_in_worker(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(worker_executor, fn, *args)
+
+
+# 번역 단계: 동시에 들어온 문장들을 모아서 MarianMT generate 한 번으로 번역하고,
+# 정규화된 문장을 키로 메모리 LRU 캐시와 디스크(sqlite) 캐시에 결과를 저장
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def contains_hangul(text: str) -> bool:
+    # 한글 음절, 자모, 호환용 자모
+    return any('\uac00' <= char <= '\ud7a3' or '\u1100' <= char <= '\u11ff' or '\u3130' <= char <= '\u318f'
+               for char in text)
+
+
+class TranslationStage:
+    def __init__(self, cache_path: str, cache_size: int = 4096, max_batch_size: int = 16, window: float = 0.02):
+        self.cache_size = cache_size
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.cache: OrderedDict = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS translations (source TEXT PRIMARY KEY, target TEXT)")
+        self.db.commit()
+
+    def _remember(self, key: str, value: str):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _lookup_disk(self, key: str) -> Optional[str]:
+        with self.db_lock:
+            row = self.db.execute("SELECT target FROM translations WHERE source = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _translate_batch(self, texts: list) -> list:
+        tokenizer = loader.get("marian_tokenizer")
+        model = loader.get("marian_model")
+        with metrics.stage("translation"):
+            inputs = tokenizer(
+                texts,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=77  # 모델의 최대 길이에 맞춤
+            )
+            with torch.no_grad():
+                translated = model.generate(**inputs)
+            results = tokenizer.batch_decode(translated, skip_special_tokens=True)
+        with self.db_lock:
+            self.db.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?)", list(zip(texts, results)))
+            self.db.commit()
+        return results
+
+    async def translate(self, text: str) -> str:
+        key = normalize_text(text)
+        if count_lookup("translation_memory", self.cache.get(key)):
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.pending:
+            # 같은 문장이 이미 번역 대기 중이면 그 결과를 함께 사용
+            return await asyncio.shield(self.pending[key])
+        cached = await run_in_worker(self._lookup_disk, key)
+        if count_lookup("translation_disk", cached):
+            self._remember(key, cached)
+            return cached
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        loop = asyncio.get_running_loop()
+        self.pending[key] = loop.create_future()
+        future = self.pending[key]
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: Dict[str, asyncio.Future]):
+        texts = list(batch.keys())
+        try:
+            results = await run_in_worker(self._translate_batch, texts)
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for text, result in zip(texts, results):
+            self._remember(text, result)
+            batch[text].set_result(result)
+
+
+translation_stage = TranslationStage(os.path.join(cache_dir, "translations.sqlite"))
 
 
 # 비동기 번역 함수
 async def translate_text(text: str) -> str:
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _translate_text, text)
+    return await translation_stage.translate(text)
+
+
+async def needs_translation(text: str) -> bool:
+    # 한글이 있으면 바로 번역, 없을 때만 langdetect로 언어 감지
+    if contains_hangul(text):
+        return True
+    return await run_in_worker(detect_language, text) != 'en'
+
+
+def detect_language(text: str) -> str:
+    with metrics.stage("language_detection"):
+        return langdetect.detect(text)
+
+
+# 생성 작업 (job) 상태: queued -> running -> done / failed
+@dataclass
+class GenerationJob:
+    id: str
+    status: str = "queued"
+    progress: float = 0.0
+    text: Optional[str] = None
+    file_path: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    task: Optional[asyncio.Task] = None
 
-def _translate_text(text: str) -> str:
-    inputs = tokenizer(
-        text,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=77  # 모델의 최대 길이에 맞춤
-    )
-    translated = model.generate(**inputs)
-    result = tokenizer.decode(translated[0], skip_special_tokens=True)
-    return result
 
+jobs: Dict[str, GenerationJob] = {}
+max_jobs: int = 1000
+
+
+def _save_audio(output: torch.Tensor, file_path: str, sample_rate: int):
+    audio_write(file_path, output.cpu().float(), sample_rate, strategy="loudness", loudness_headroom_db=16, loudness_compressor=True, add_suffix=False)
+
+
+# 같은 결과를 만드는 진행 중인 생성 작업 (키 -> 생성 task, 진행률을 받을 job 목록)
+inflight: Dict[str, asyncio.Task] = {}
+inflight_jobs: Dict[str, list] = {}
+
+
+async def _generate_and_store(key: str, translated_text: str, seed: int) -> str:
+    def _progress(generated_tokens: int, tokens_to_generate: int):
+        for job in inflight_jobs[key]:
+            job.progress = generated_tokens / tokens_to_generate
+
+    try:
+        # 스케줄러가 다른 요청들과 함께 배치로 생성하고, 이 요청에 해당하는 결과만 돌려줌
+        future = scheduler.submit(translated_text, musicgen_model_name, duration, progress_callback=_progress, seed=seed,
+                                  top_k=topk, top_p=topp, temperature=temperature, cfg_coef=cfg_coef)
+        output = await asyncio.wrap_future(future)
+
+        sample_rate = model_registry.get(musicgen_model_name).sample_rate
+        path = await run_in_worker(result_store.put, key, lambda tmp_path: _save_audio(output, tmp_path, sample_rate))
+        return str(path)
+    finally:
+        del inflight[key]
+        del inflight_jobs[key]
+
+
+def result_key(translated_text: str, seed: int) -> str:
+    return ContentStore.key(
+        text=translated_text, model=musicgen_model_name, seed=seed,
+        params={"duration": duration, "top_k": topk, "top_p": topp, "temperature": temperature, "cfg_coef": cfg_coef})
 
 
 # 비동기 음악 생성 함수
-async def generate_music_async(translated_text: str) -> list:
-    model_musicgen = MusicGen.get_pretrained('large')
-    model_musicgen.set_generation_params(duration=duration, top_k=topk, top_p=topp, temperature=temperature, cfg_coef=cfg_coef)
-    
-    outputs = model_musicgen.generate(translated_text, progress=False)
-    outputs = outputs.detach().cpu().float()
+async def generate_music_async(translated_text: str, job: GenerationJob, seed: Optional[int] = None) -> str:
+    seed = default_seed if seed is None else seed
+    key = result_key(translated_text, seed)
+    path = result_store.get(key)
+    if count_lookup("result", path):
+        return str(path)
+    # 같은 요청이 이미 생성 중이면 새로 생성하지 않고 그 결과를 기다림
+    if key not in inflight:
+        inflight_jobs[key] = []
+        inflight[key] = asyncio.ensure_future(_generate_and_store(key, translated_text, seed))
+    inflight_jobs[key].append(job)
+    return await asyncio.shield(inflight[key])
+
+
+async def _run_job(job: GenerationJob, seed: Optional[int], prepare_text, *args):
+    try:
+        job.status = "running"
+        job.text = await prepare_text(*args)
+        job.file_path = await generate_music_async(job.text, job, seed)
+        job.progress = 1.0
+        job.status = "done"
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
 
-    output_files = []
-    for idx, output in enumerate(outputs):
-        temp_file_path = f"audio_files/output_{idx}.wav"
-        audio_write(temp_file_path, output, model_musicgen.sample_rate, strategy="loudness", loudness_headroom_db=16, loudness_compressor=True, add_suffix=False)
-        output_files.append(temp_file_path)
-    
-    return output_files
 
+def submit_job(seed: Optional[int], prepare_text, *args) -> GenerationJob:
+    if not os.path.exists('audio_files'):
+        os.mkdir('audio_files')
+    # 오래된 완료 작업부터 정리
+    finished = [job for job in jobs.values() if job.status in ("done", "failed")]
+    for job in finished[:max(0, len(jobs) - max_jobs + 1)]:
+        del jobs[job.id]
+    job = GenerationJob(id=uuid.uuid4().hex)
+    jobs[job.id] = job
+    job.task = asyncio.create_task(_run_job(job, seed, prepare_text, *args))
+    return job
 
 
+async def wait_job(job: GenerationJob) -> dict:
+    await job.task
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return {"file_paths": job.file_path}
+
 
 # 이미지에서 설명 추출 (CLIP 사용)
 def generate_image_description(image_bytes: io.BytesIO):
     image = Image.open(image_bytes)
+    clip_processor, clip_model = loader.get("clip_processor"), loader.get("clip_model")
     inputs = clip_processor(images=image, return_tensors="pt", padding=True, truncation=True, max_length=77)
     with torch.no_grad():
         image_features = clip_model.get_image_features(**inputs)
     return image_features
 
-# 음악 장르 추천 (CLIP 모델을 이용해 설명과 장르 비교)
-def get_best_match(features, mapping):
-    similarities = []
-    for key, keywords in mapping.items():
-        # 키워드 리스트를 하나의 문장으로 결합
-        description = " ".join(keywords)
-        inputs = clip_processor(text=description, return_tensors="pt", padding=True, truncation=True, max_length=77)
+# 장르/테마/분위기 키워드 인덱스
+# 키워드를 한 문장으로 합치면 CLIP의 77 토큰 제한 때문에 대부분의 키워드가 잘려나가므로,
+# 키워드마다 임베딩을 하나씩 만들고 라벨별로 점수를 모음 (max-sim 또는 상위 m개 평균)
+label_aggregation = os.environ.get('LABEL_AGGREGATION', 'max')  # 'max' 또는 'mean'
+label_top_m = int(os.environ.get('LABEL_TOP_M', 3))
+
+
+def embed_keywords(keywords: list, batch_size: int = 256) -> torch.Tensor:
+    clip_processor, clip_model = loader.get("clip_processor"), loader.get("clip_model")
+    features = []
+    for start in range(0, len(keywords), batch_size):
+        inputs = clip_processor(text=keywords[start:start + batch_size], return_tensors="pt", padding=True, truncation=True, max_length=77)
         with torch.no_grad():
-            text_features = clip_model.get_text_features(**inputs)
-        similarity = torch.cosine_similarity(features, text_features)
-        similarities.append((key, similarity.item()))
+            features.append(clip_model.get_text_features(**inputs))
+    return torch.nn.functional.normalize(torch.cat(features), dim=-1)
+
+
+class KeywordIndex:
+    """모든 맵의 키워드 임베딩을 하나의 행렬 [N, D]에 모아두고,
+    맵마다 라벨 x 키워드 인덱스 [L, K_max]를 두어 라벨 점수를 벡터 연산으로 계산."""
+
+    def __init__(self, maps: dict, keywords: list, embeddings: torch.Tensor):
+        self.keyword_matrix = embeddings
+        self.labels = {}
+        self.label_keywords = {}
+        position = {keyword: idx for idx, keyword in enumerate(keywords)}
+        padding = len(keywords)  # 점수 끝에 붙이는 -inf 자리
+        for name, mapping in maps.items():
+            self.labels[name] = list(mapping.keys())
+            label_keywords = [sorted({position[keyword] for keyword in mapping[label]}) for label in mapping]
+            max_keywords = max(len(indexes) for indexes in label_keywords)
+            index = torch.full((len(label_keywords), max_keywords), padding, dtype=torch.long)
+            for label_idx, indexes in enumerate(label_keywords):
+                index[label_idx, :len(indexes)] = torch.tensor(indexes)
+            self.label_keywords[name] = index
+
+    def search(self, features: torch.Tensor, top_k: int = 3, aggregation: str = "max", top_m: int = 3) -> list:
+        """이미지 특징 [B, D]에 대해 모든 맵의 상위 top_k 라벨과 점수를 한 번에 계산.
+        반환값은 배치의 각 항목마다 {맵 이름: [(라벨, 점수), ...]}."""
+        features = torch.nn.functional.normalize(features, dim=-1)
+        # 모든 키워드와의 코사인 유사도를 한 번의 행렬 곱으로 계산: [B, N + 1]
+        similarities = features @ self.keyword_matrix.t()
+        similarities = torch.nn.functional.pad(similarities, (0, 1), value=float("-inf"))
+        results = [{} for _ in range(features.shape[0])]
+        for name, index in self.label_keywords.items():
+            per_keyword = similarities[:, index]  # [B, L, K_max]
+            if aggregation == "max":
+                scores = per_keyword.max(dim=-1).values
+            elif aggregation == "mean":
+                top = per_keyword.topk(min(top_m, index.shape[-1]), dim=-1).values
+                valid = torch.isfinite(top)
+                scores = top.where(valid, torch.zeros_like(top)).sum(-1) / valid.sum(-1)
+            else:
+                raise ValueError(f"Unknown aggregation {aggregation}")
+            values, indexes = scores.topk(min(top_k, scores.shape[-1]), dim=-1)
+            for result, label_values, label_indexes in zip(results, values.tolist(), indexes.tolist()):
+                result[name] = [(self.labels[name][idx], value) for idx, value in zip(label_indexes, label_values)]
+        return results
 
-    return max(similarities, key=lambda x: x[1])[0]  # 가장 높은 유사도를 가진 항목 반환
 
+def load_keyword_index(maps: dict) -> KeywordIndex:
+    # 맵 내용과 CLIP 모델 이름의 해시로 디스크 캐시를 찾아서, 재시작할 때 다시 계산하지 않음
+    key = json.dumps({"model": clip_model_name, "maps": maps}, sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"clip_keywords_{digest}.pt")
+    keywords = sorted({keyword for mapping in maps.values() for words in mapping.values() for keyword in words})
+    if os.path.exists(cache_path):
+        return KeywordIndex(maps, keywords, torch.load(cache_path))
+
+    embeddings = embed_keywords(keywords)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    torch.save(embeddings, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return KeywordIndex(maps, keywords, embeddings)
+
+
+loader.register("keyword_index", lambda: load_keyword_index({"genre": genre_map, "theme": theme_map, "mood": mood_map}),
+                deps=("clip_processor", "clip_model"))
+
+
+# 이미지에 맞는 장르, 테마, 분위기 추천 (CLIP 키워드 인덱스 검색), 점수 순으로 정렬된 (라벨, 점수) 목록도 함께 반환
 def recommend_music_details_from_image(image_bytes: io.BytesIO):
     image_features = generate_image_description(image_bytes)
 
-    # 장르, 테마, 분위기 각각의 매칭 결과 도출
-    genre = get_best_match(image_features, genre_map)
-    theme = get_best_match(image_features, theme_map)
-    mood = get_best_match(image_features, mood_map)
+    # 장르, 테마, 분위기 각각의 매칭 결과를 한 번에 도출
+    ranking = loader.get("keyword_index").search(image_features, top_k=3, aggregation=label_aggregation, top_m=label_top_m)[0]
 
     return {
-        "genre": genre,
-        "theme": theme,
-        "mood": mood
+        "genre": ranking["genre"][0][0],
+        "theme": ranking["theme"][0][0],
+        "mood": ranking["mood"][0][0],
+        "ranking": ranking,
     }
 
 
+# 텍스트 프롬프트 준비 (필요하면 영어로 번역)
+async def prepare_text_prompt(text: str) -> str:
+    print("music generation request : ", text)
+    if not await needs_translation(text):
+        return text
+    translatedText = await translate_text(text)
+    print("번역이 완료되었습니다 : ", translatedText)
+    return translatedText
+
+
+# 이미지로부터 프롬프트 준비
+async def prepare_image_prompt(image_bytes: io.BytesIO) -> str:
+    music_details = await run_in_worker(recommend_music_details_from_image, image_bytes)
 
+    # 매핑 결과를 텍스트로 변환
+    translated_text = f"{music_details['genre']}, {music_details['theme']}, {music_details['mood']}"
+    print("Generated Text for Music:", translated_text)
+    return translated_text
 
 
+@app.post("/jobs/generate-music/")
+async def submit_generate_music(request: MusicRequest):
+    job = submit_job(request.seed, prepare_text_prompt, request.text)
+    return {"job_id": job.id}
 
 
+@app.post("/jobs/generate-music-from-image/")
+async def submit_generate_music_from_image(image: UploadFile = File(...), seed: Optional[int] = Form(None)):
+    image_bytes = io.BytesIO(await image.read())
+    job = submit_job(seed, prepare_image_prompt, image_bytes)
+    return {"job_id": job.id}
+
+
+def get_job(job_id: str) -> GenerationJob:
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return jobs[job_id]
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "progress": job.progress,
+        "text": job.text,
+        "error": job.error,
+    }
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return FileResponse(job.file_path, media_type="audio/wav")
+
+
+# 기존 동기식 API: 작업을 제출하고 완료될 때까지 기다림
 @app.post("/generate-music/")
 async def generate_music(request: MusicRequest):
-    try:
-        if not os.path.exists('audio_files'):
-            os.mkdir('audio_files')
+    return await wait_job(submit_job(request.seed, prepare_text_prompt, request.text))
 
-        print("music generation request : ", request)
+@app.post("/generate-music-from-image/")
+async def generate_music_from_image(image: UploadFile = File(...), seed: Optional[int] = Form(None)):
+    image_bytes = io.BytesIO(await image.read())
+    return await wait_job(submit_job(seed, prepare_image_prompt, image_bytes))
 
-        # 비동기적으로 번역을 진행하고, 완료될 때까지 기다림
-        detected_language = langdetect.detect(request.text)
 
-        if detected_language == 'en':
-            translatedText = request.text
-        else:
-            translatedText = await translate_text(request.text)
-            print("번역이 완료되었습니다 : ", translatedText)
-        translatedText = [translatedText]
+# 스트리밍 생성: 생성이 끝나기를 기다리지 않고 만들어진 부분부터 WAV (16bit PCM)로 전송
+def _wav_header(sample_rate: int, channels: int, num_samples: int) -> bytes:
+    data_size = num_samples * channels * 2
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels, sample_rate,
+                       sample_rate * channels * 2, channels * 2, 16, b'data', data_size)
 
-        # 번역된 텍스트를 기반으로 음악 생성
-        output_files = await generate_music_async(translatedText)
 
-        return {"file_paths": output_files[0]}
+def _to_pcm16(chunk: torch.Tensor) -> bytes:
+    # [C, T] -> 채널이 번갈아 나오는 int16
+    return (chunk.cpu().float().clamp(-1, 1) * 32767).short().t().contiguous().numpy().tobytes()
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/generate-music-from-image/")
-async def generate_music_from_image(image: UploadFile = File(...)):
-    try:
-        # 이미지 처리
-        image_bytes = io.BytesIO(await image.read())
-        music_details = recommend_music_details_from_image(image_bytes)
+async def stream_music(translated_text: str, seed: Optional[int]):
+    seed = default_seed if seed is None else seed
+    key = result_key(translated_text, seed)
+    path = result_store.get(key)
+    if count_lookup("result", path):
+        return FileResponse(path, media_type="audio/wav")
 
-        # 매핑 결과를 텍스트로 변환
-        translated_text = f"{music_details['genre']}, {music_details['theme']}, {music_details['mood']}"
-        print("Generated Text for Music:", translated_text)
+    musicgen = await run_in_worker(model_registry.get, musicgen_model_name)
+    num_samples = int(duration * musicgen.frame_rate) * (musicgen.sample_rate // musicgen.frame_rate)
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue()
+    future = scheduler.submit(translated_text, musicgen_model_name, duration, seed=seed,
+                              stream_callback=lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk),
+                              chunk_duration=stream_chunk_duration,
+                              top_k=topk, top_p=topp, temperature=temperature, cfg_coef=cfg_coef)
+    # 생성이 끝나면 (실패해도) 스트림 종료
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(chunks.put_nowait, None))
 
-        # 음악 생성
-        if not os.path.exists('audio_files'):
-            os.mkdir('audio_files')
-        output_files = await generate_music_async([translated_text])
+    async def _stream():
+        yield _wav_header(musicgen.sample_rate, musicgen.audio_channels, num_samples)
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield _to_pcm16(chunk)
+        if future.exception() is not None:
+            print("스트리밍 생성 실패 : ", future.exception())
+            return
+        # 다음 요청부터는 저장된 결과를 사용 (일반 API와 같은 loudness 정규화)
+        output = future.result()
+        await run_in_worker(result_store.put, key, lambda tmp_path: _save_audio(output, tmp_path, musicgen.sample_rate))
 
-        return {"file_paths": output_files[0]}
+    return StreamingResponse(_stream(), media_type="audio/wav")
+
+
+@app.post("/stream/generate-music/")
+async def stream_generate_music(request: MusicRequest):
+    return await stream_music(await prepare_text_prompt(request.text), request.seed)
+
+
+@app.post("/stream/generate-music-from-image/")
+async def stream_generate_music_from_image(image: UploadFile = File(...), seed: Optional[int] = Form(None)):
+    image_bytes = io.BytesIO(await image.read())
+    return await stream_music(await prepare_image_prompt(image_bytes), seed)
+
+
+@app.on_event("startup")
+async def start_loading():
+    # 기다리지 않고 바로 반환해서 서버가 먼저 요청을 받을 수 있게 함
+    loader.start()
+
+
+@app.get("/healthz")
+async def healthz():
+    # 프로세스가 살아있는지만 확인
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # 모든 모델 로딩 (와 워밍업)이 끝나야 요청을 받을 준비가 된 것으로 봄
+    ready = loader.ready()
+    content = {
+        "ready": ready,
+        "models": loader.status(),
+        "timings": loader.timings,
+        "total": loader.ready_at - loader.started_at if loader.ready_at is not None else None,
+    }
+    return JSONResponse(content, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Prometheus 텍스트 형식: 단계별 소요 시간, 초당 토큰 수, 대기열 길이, 배치 크기, 캐시 적중 횟수
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/batching-stats/")
+async def batching_stats():
+    # 실제로 만들어진 배치 크기와 요청들의 대기 시간 (window 튜닝용)
+    return scheduler.stats()
 
 
 if __name__ == "__main__":
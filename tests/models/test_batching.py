@@ -0,0 +1,103 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.models import MusicGen
+from audiocraft.models.batching import BatchingScheduler
+
+
+class TestBatchingScheduler:
+    def get_scheduler(self, **kwargs):
+        mg = MusicGen.get_pretrained(name='debug', device='cpu')
+        self.batches = []
+
+        def _generate(descriptions, progress=False, **params):
+            self.batches.append((list(descriptions), params.get('duration', mg.duration)))
+            return MusicGen.generate(mg, descriptions, progress, **params)
+        mg.generate = _generate  # type: ignore
+        return BatchingScheduler(lambda name: mg, **kwargs)
+
+    def test_batches_by_bucket(self):
+        scheduler = self.get_scheduler(window=0.5)
+        futures = [
+            scheduler.submit('youpi', 'debug', 1.),
+            scheduler.submit('lapin dort', 'debug', 1.),
+            scheduler.submit('encore', 'debug', 2.),
+        ]
+        wavs = [future.result() for future in futures]
+        scheduler.close()
+        assert [list(wav.shape) for wav in wavs] == [[1, 32000], [1, 32000], [1, 64000]]
+        assert sorted(self.batches) == [(['encore'], 2.), (['youpi', 'lapin dort'], 1.)]
+        stats = scheduler.stats()
+        assert stats['batch_sizes'] == {1: 1, 2: 1}
+        assert stats['num_requests'] == 3
+        assert stats['queue_wait_max'] >= 0
+
+    def test_max_batch_size(self):
+        scheduler = self.get_scheduler(window=60., max_batch_size=2)
+        futures = [scheduler.submit(str(idx), 'debug', 1.) for idx in range(5)]
+        # the last request is flushed when closing rather than after the window.
+        scheduler.close()
+        assert all(future.result().shape[-1] == 32000 for future in futures)
+        assert [len(descriptions) for descriptions, _ in self.batches] == [2, 2, 1]
+
+    def test_seed(self):
+        scheduler = self.get_scheduler(window=0.)
+        wavs = [scheduler.submit('youpi', 'debug', 1., seed=42).result() for _ in range(2)]
+        other = scheduler.submit('youpi', 'debug', 1., seed=43).result()
+        scheduler.close()
+        assert (wavs[0] == wavs[1]).all()
+        assert not (wavs[0] == other).all()
+
+    def test_seed_independent_of_batch(self):
+        scheduler = self.get_scheduler(window=0.5)
+        alone = scheduler.submit('youpi', 'debug', 1., seed=42, temperature=1.).result()
+        futures = [
+            scheduler.submit('lapin dort dans son terrier', 'debug', 1., seed=7, temperature=1.5),
+            scheduler.submit('youpi', 'debug', 1., seed=42, temperature=1.),
+            scheduler.submit('youpi', 'debug', 1., seed=43, temperature=1.),
+        ]
+        wavs = [future.result() for future in futures]
+        scheduler.close()
+        assert [len(descriptions) for descriptions, _ in self.batches] == [1, 3]
+        assert torch.allclose(wavs[1], alone, atol=1e-5)
+        assert not torch.allclose(wavs[2], alone, atol=1e-5)
+
+    def test_progress_callback(self):
+        scheduler = self.get_scheduler(window=0.)
+        progress = []
+        future = scheduler.submit('youpi', 'debug', 1., progress_callback=lambda *args: progress.append(args))
+        future.result()
+        scheduler.close()
+        assert len(progress) > 0
+        assert progress[-1][1] == 25
+
+    def test_stream(self):
+        scheduler = self.get_scheduler(window=0.5)
+        chunks = [[], []]
+        futures = [scheduler.submit(description, 'debug', 1., stream_callback=chunks[idx].append, chunk_duration=0.4)
+                   for idx, description in enumerate(['youpi', 'lapin dort'])]
+        other = scheduler.submit('encore', 'debug', 1.)
+        wavs = [future.result() for future in futures]
+        other.result()
+        scheduler.close()
+        assert [descriptions for descriptions, _ in self.batches] == [['encore']]
+        for wav, wav_chunks in zip(wavs, chunks):
+            assert [chunk.shape[-1] for chunk in wav_chunks] == [12800, 12800, 6400]
+            assert (torch.cat(wav_chunks, dim=-1) == wav).all()
+
+    def test_per_sample_params(self):
+        scheduler = self.get_scheduler(window=0.5)
+        futures = [
+            scheduler.submit('youpi', 'debug', 1., temperature=0.5, top_k=10),
+            scheduler.submit('lapin dort', 'debug', 1., temperature=1.5, top_k=50),
+            scheduler.submit('encore', 'debug', 1., temperature=1., top_k=50, use_sampling=False),
+        ]
+        wavs = [future.result() for future in futures]
+        scheduler.close()
+        assert all(wav.shape[-1] == 32000 for wav in wavs)
+        assert sorted(self.batches) == [(['encore'], 1.), (['youpi', 'lapin dort'], 1.)]
@@ -0,0 +1,58 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.models.builders import get_debug_lm_model
+from audiocraft.models.continuous_batching import ContinuousBatchingEngine
+from audiocraft.modules.conditioners import ConditioningAttributes
+
+
+class TestContinuousBatchingEngine:
+
+    def get_lm(self):
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        lm.eval()
+        return lm
+
+    def test_same_as_generate(self):
+        lm = self.get_lm()
+        conditions = ConditioningAttributes(text={'description': 'a b c'})
+        lengths = [20, 35, 12, 28, 9]
+        prompts = [None, torch.randint(lm.card, (4, 5)), None, torch.randint(lm.card, (4, 3)), None]
+        expected = [lm.generate(None if prompt is None else prompt[None], [conditions],
+                                max_gen_len=length, use_sampling=False)[0]
+                    for length, prompt in zip(lengths, prompts)]
+        with ContinuousBatchingEngine(lm, max_batch_size=2, max_gen_len=40, use_sampling=False) as engine:
+            rows = [engine.add(conditions, length, prompt) for length, prompt in zip(lengths, prompts)]
+            assert engine.generate(rows) is rows
+            assert engine.is_idle
+        for row, tokens in zip(rows, expected):
+            assert row.tokens is not None
+            assert torch.equal(row.tokens, tokens)
+            assert row.added_at <= row.admitted_at <= row.finished_at
+
+    def test_step(self):
+        lm = self.get_lm()
+        conditions = ConditioningAttributes(text={'description': 'a b c'})
+        with ContinuousBatchingEngine(lm, max_batch_size=2, max_gen_len=12, top_k=10) as engine:
+            short = engine.add(conditions, 4)
+            long = engine.add(conditions, 12)
+            queued = engine.add(conditions, 4)
+            finished = []
+            num_steps = 0
+            while not engine.is_idle:
+                finished += engine.step()
+                num_steps += 1
+                assert engine.num_active <= 2
+        # the queued sequence takes the slot of the short one as soon as it is done.
+        assert [id(row) for row in finished] == [id(short), id(queued), id(long)]
+        assert short.slot == queued.slot != long.slot
+        assert num_steps == long.max_gen_len + lm.num_codebooks - 1
+        for row in finished:
+            assert row.tokens is not None
+            assert row.tokens.shape == (lm.num_codebooks, row.max_gen_len)
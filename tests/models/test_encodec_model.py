@@ -58,3 +58,56 @@ class TestEncodecModel:
             codes, scales = model_nonorm.encode(x)
             codes, scales = model_renorm.encode(x)
             assert scales is not None
+
+    def test_streaming(self):
+        model = self._create_encodec_model(24_000, 1)
+        x = torch.randn(2, 1, 5000)
+        codes, _ = model.encode(x)
+        out_ref = model.decode(codes)
+        with model.streaming():
+            chunks = [model.encode(chunk)[0] for chunk in x.split(777, dim=-1)]
+            streamed_codes = torch.cat(chunks + [model.flush_encoder()], dim=-1)
+            # the dummy quantizer returns the embeddings as codes.
+            assert torch.allclose(streamed_codes, codes, atol=1e-5)
+
+            # the memory used by the decoder does not grow with the number of frames.
+            out = []
+            for frame in range(codes.shape[-1]):
+                out.append(model.decode(codes[..., frame:frame + 1]))
+                if frame == 10:
+                    state_size = sum(value.numel() for value in model.get_streaming_state().values()
+                                     if isinstance(value, torch.Tensor))
+            assert state_size == sum(value.numel() for value in model.get_streaming_state().values()
+                                     if isinstance(value, torch.Tensor))
+            out.append(model.flush_decoder())
+            assert torch.allclose(torch.cat(out, dim=-1), out_ref, atol=1e-5)
+
+    def test_decode_chunked(self):
+        model = self._create_encodec_model(24_000, 1).eval()
+        codes, _ = model.encode(torch.randn(2, 1, 24_000))
+        out_ref = model.decode(codes)
+        # without overlap, the chunks are decoded independently.
+        out = model.decode_chunked(codes, chunk_length=codes.shape[-1] // 3, overlap=0)
+        assert out.shape == out_ref.shape
+        out = model.decode_chunked(codes, chunk_length=codes.shape[-1] // 3, overlap=8)
+        assert out.shape == out_ref.shape
+        assert (out - out_ref).abs().max() < 0.1 * out_ref.abs().max()
+        # decoding the chunks in parallel threads gives the same output.
+        out_parallel = model.decode_chunked(codes, chunk_length=codes.shape[-1] // 3, overlap=8, num_workers=2)
+        assert torch.allclose(out_parallel, out)
+        # short enough to be decoded in one go.
+        assert torch.equal(model.decode_chunked(codes, chunk_length=codes.shape[-1]), out_ref)
+
+    def test_encode_batch(self):
+        # with a constant padding, padding the inputs with zeros does not change their codes.
+        kwargs = dict(dimension=16, n_filters=4, n_residual_layers=1, ratios=[5, 4, 3, 2], pad_mode='constant')
+        model = EncodecModel(SEANetEncoder(**kwargs), SEANetDecoder(**kwargs), DummyQuantizer(),
+                             frame_rate=200, sample_rate=24_000, channels=1, renormalize=True)
+        wavs = [torch.randn(1, length) for length in [5000, 1234, 120, 3001]]
+        codes, scales = model.encode_batch(wavs)
+        assert scales is not None
+        for wav, item_codes, scale in zip(wavs, codes, scales):
+            ref_codes, ref_scale = model.encode(wav[None])
+            assert item_codes.shape == ref_codes.shape[1:]
+            assert torch.allclose(item_codes, ref_codes[0], atol=1e-5)
+            assert torch.allclose(scale, ref_scale[0])
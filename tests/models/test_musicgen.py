@@ -8,6 +8,7 @@ import pytest
 import torch
 
 from audiocraft.models import MusicGen
+from audiocraft.modules.conditioners import WavCondition
 
 
 class TestSEANetModel:
@@ -43,6 +44,36 @@ class TestSEANetModel:
             wav = mg.generate_continuation(
                 prompt, 32000, ['youpi', 'lapin dort', 'one too many'])
 
+    def test_generate_continuation_variable_lengths(self):
+        mg = self.get_musicgen()
+        prompts = [torch.randn(1, 32000), torch.randn(1, 12000), torch.randn(1, 20000)]
+        wav = mg.generate_continuation(prompts, 32000)
+        assert list(wav.shape) == [3, 1, 64000]
+
+        # each sample keeps the tokens of its own prompt, then continues it.
+        attributes, prompt_tokens = mg._prepare_tokens_and_attributes([None] * 3, prompts)
+        assert prompt_tokens is not None
+        assert mg.lm.get_prompt_length(prompt_tokens) == 10
+        for sliding_window, duration in [(False, 2.), (False, 4.), (True, 4.)]:
+            mg.max_duration = 3.
+            tokens = torch.cat(list(mg._generate_tokens_stream(
+                attributes, prompt_tokens, duration=duration, sliding_window=sliding_window)), dim=-1)
+            assert tokens.shape[-1] == duration * mg.frame_rate
+            known = prompt_tokens != -1
+            assert torch.equal(tokens[..., :prompt_tokens.shape[-1]][known], prompt_tokens[known])
+
+        # the same prompts, padded in a single tensor.
+        mg.max_duration = 30.
+        mg.set_generation_params(duration=2.0, use_sampling=False)
+        padded = torch.zeros(3, 1, 32000)
+        for item, prompt in zip(padded, prompts):
+            item[..., :prompt.shape[-1]] = prompt
+        wav = mg.generate_continuation(prompts, 32000)
+        wav_padded = mg.generate_continuation(padded, 32000, prompt_lengths=[32000, 12000, 20000])
+        assert torch.allclose(wav, wav_padded, atol=1e-5)
+        with pytest.raises(ValueError):
+            mg.generate_continuation(padded, 32000, prompt_lengths=[32000])
+
     def test_generate(self):
         mg = self.get_musicgen()
         wav = mg.generate(
@@ -56,3 +87,160 @@ class TestSEANetModel:
         wav = mg.generate(
             ['youpi', 'lapin dort'])
         assert list(wav.shape) == [2, 1, 32000 * 4]
+
+    def test_generate_long_reuses_conditions(self):
+        mg = self.get_musicgen()
+        mg.max_duration = 3.
+        mg.set_generation_params(duration=6., extend_stride=1.)
+        provider = mg.lm.condition_provider
+        calls = []
+        handle = provider.register_forward_hook(lambda module, inputs, output: calls.append(output))
+        try:
+            wav = mg.generate(['youpi', 'lapin dort'])
+        finally:
+            handle.remove()
+        assert list(wav.shape) == [2, 1, 32000 * 6]
+        # the conditions are computed once for all the windows.
+        assert len(calls) == 1
+        # and give the same tokens as computing them in `generate`.
+        attributes, _ = mg._prepare_tokens_and_attributes(['youpi', 'lapin dort'], None)
+        cfg_conditions = mg.lm._get_cfg_conditions(attributes, two_step_cfg=False)
+        torch.manual_seed(1234)
+        tokens = mg.lm.generate(None, attributes, max_gen_len=20, cfg_conditions=cfg_conditions)
+        torch.manual_seed(1234)
+        assert torch.equal(tokens, mg.lm.generate(None, attributes, max_gen_len=20))
+
+    def test_generate_long_sliding_window(self):
+        mg = self.get_musicgen()
+        mg.max_duration = 3.
+        mg.set_generation_params(duration=3., extend_stride=2., use_sampling=False)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        wav_long = mg.generate(['youpi', 'lapin dort'], duration=5., sliding_window=True)
+        assert list(wav_long.shape) == [2, 1, 32000 * 5]
+        # the window only starts sliding after the maximum duration.
+        assert torch.allclose(wav_long[..., :32000 * 2], wav[..., :32000 * 2], atol=1e-5)
+        # with a seed, the sliding window samples the same first window as the default extension.
+        params = dict(duration=5., use_sampling=True, seed=0)
+        wav_windows = mg.generate(['youpi', 'lapin dort'], **params)
+        wav_sliding = mg.generate(['youpi', 'lapin dort'], sliding_window=True, **params)
+        assert torch.allclose(wav_sliding[..., :32000 * 2], wav_windows[..., :32000 * 2], atol=1e-5)
+        assert not torch.allclose(wav_sliding[..., 32000 * 4:], wav_windows[..., 32000 * 4:], atol=1e-5)
+
+    def test_generate_long_sliding_window_melody(self):
+        mg = self.get_musicgen()
+        mg.max_duration = 3.
+        # only the presence of a melody conditioner is checked before generating.
+        mg.lm.condition_provider.conditioners['self_wav'] = torch.nn.Identity()
+        attributes, _ = mg._prepare_tokens_and_attributes(['youpi', 'lapin dort'], None)
+        attributes[1].wav['self_wav'] = WavCondition(torch.randn(1, 1, 32000), torch.tensor([32000]))
+        with pytest.raises(ValueError):
+            next(mg._generate_tokens_stream(attributes, None, duration=5., sliding_window=True))
+        # null melodies do not condition anything.
+        stream = mg._generate_tokens_stream(attributes[:1], None, duration=5., sliding_window=True)
+        assert next(stream).shape[:2] == (1, mg.lm.num_codebooks)
+        stream.close()
+
+    def test_generate_stream(self):
+        mg = self.get_musicgen()
+        torch.manual_seed(1234)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        torch.manual_seed(1234)
+        chunks = list(mg.generate_stream(['youpi', 'lapin dort'], chunk_duration=0.4))
+        assert [chunk.shape[-1] for chunk in chunks] == [12800] * 5
+        assert torch.allclose(torch.cat(chunks, dim=-1), wav, atol=1e-5)
+
+    def test_generate_stream_long(self):
+        mg = self.get_musicgen()
+        mg.max_duration = 3.
+        mg.set_generation_params(duration=4., extend_stride=2.)
+        torch.manual_seed(1234)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        torch.manual_seed(1234)
+        chunks = list(mg.generate_stream(['youpi', 'lapin dort'], chunk_duration=0.3))
+        assert torch.cat(chunks, dim=-1).shape == wav.shape
+        assert torch.allclose(torch.cat(chunks, dim=-1), wav, atol=1e-5)
+
+    def test_generate_static_kv_cache(self):
+        mg = self.get_musicgen()
+        torch.manual_seed(1234)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        mg.set_generation_params(duration=2.0, extend_stride=2., static_kv_cache=True)
+        torch.manual_seed(1234)
+        wav_static = mg.generate(['youpi', 'lapin dort'])
+        assert torch.allclose(wav, wav_static, atol=1e-5)
+
+    def test_generate_sampling_params(self):
+        mg = self.get_musicgen()
+        mg.set_generation_params(duration=2.0, extend_stride=2., min_p=0.1, repetition_penalty=1.2)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        assert list(wav.shape) == [2, 1, 64000]
+
+    def test_generate_per_sample_params(self):
+        mg = self.get_musicgen()
+        mg.set_generation_params(duration=1.0)
+        descriptions = ['youpi', 'youpi']
+        # a temperature of 0 means greedy decoding for that sample only.
+        wav = mg.generate(descriptions, temperature=[0., 0.], cfg_coef=[3., 1.])
+        greedy = [mg.generate(descriptions[:1], use_sampling=False, cfg_coef=cfg_coef) for cfg_coef in [3., 1.]]
+        assert torch.allclose(wav, torch.cat(greedy), atol=1e-5)
+        # two step CFG gives the same logits as the batched one.
+        two_step = mg.generate(descriptions, temperature=[0., 0.], cfg_coef=[3., 1.], two_step_cfg=True)
+        assert torch.allclose(wav, two_step, atol=1e-5)
+        wav = mg.generate(descriptions, duration=2.0, temperature=[0.5, 1.], top_k=[10, 0], top_p=[0., 0.9])
+        assert list(wav.shape) == [2, 1, 64000]
+        # the parameters given to a call do not change the ones of the model.
+        assert mg.duration == 1.0 and mg.generation_params['temp'] == 1.0
+        with pytest.raises(ValueError):
+            mg.generate(descriptions, temperature=[1.])
+
+    def test_mask_condition_padding(self):
+        mg = self.get_musicgen()
+        descriptions = ['youpi', 'lapin dort dans son terrier']
+        codes = torch.randint(mg.lm.card, (2, mg.lm.num_codebooks, 10))
+
+        def _predictions(num_items: int) -> torch.Tensor:
+            attributes, _ = mg._prepare_tokens_and_attributes(descriptions[:num_items], None)
+            with torch.no_grad():
+                output = mg.lm.compute_predictions(codes[:num_items], attributes)
+            # the logits are only defined where the codebooks pattern is valid.
+            return output.logits[0][output.mask[0]]
+
+        # by default, as in training, the first item attends to the padding up to the longest description.
+        assert not torch.allclose(_predictions(1), _predictions(2), atol=1e-5)
+        with mg.lm.mask_condition_padding():
+            assert torch.allclose(_predictions(1), _predictions(2), atol=1e-5)
+        assert not torch.allclose(_predictions(1), _predictions(2), atol=1e-5)
+
+    def test_generate_compile_decode(self):
+        mg = self.get_musicgen()
+        mg.set_generation_params(duration=1.0, use_sampling=False)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        wav_compiled = mg.generate(['youpi', 'lapin dort'], compile_decode=True)
+        assert torch.allclose(wav, wav_compiled, atol=1e-5)
+
+    def test_generate_quantized(self):
+        mg = MusicGen.get_pretrained(name='debug', device='cpu', quantize=True)
+        mg.set_generation_params(duration=2.0, extend_stride=2.)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        assert list(wav.shape) == [2, 1, 64000]
+
+    def test_generate_speculative(self):
+        mg = self.get_musicgen()
+        draft = MusicGen.get_pretrained(name='debug', device='cpu')
+        mg.set_generation_params(duration=2.0, extend_stride=2., use_sampling=False)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        # with greedy decoding, the output does not depend on the draft model.
+        mg.set_draft_model(draft, num_draft_steps=3)
+        wav_speculative = mg.generate(['youpi', 'lapin dort'])
+        assert torch.allclose(wav, wav_speculative, atol=1e-5)
+        mg.set_generation_params(duration=2.0, extend_stride=2.)
+        wav_speculative = mg.generate(['youpi', 'lapin dort'])
+        assert list(wav_speculative.shape) == [2, 1, 64000]
+        assert mg.lm.last_acceptance_rate is not None and 0 <= mg.lm.last_acceptance_rate <= 1
+
+    def test_generate_decode_chunked(self):
+        mg = self.get_musicgen()
+        mg.set_generation_params(duration=2.0, extend_stride=2.)
+        mg.set_decoding_params(chunk_duration=0.5, overlap_duration=0.1)
+        wav = mg.generate(['youpi', 'lapin dort'])
+        assert list(wav.shape) == [2, 1, 64000]
@@ -0,0 +1,58 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.models import MusicGen, ModelRegistry
+from audiocraft.models.registry import get_model_memory
+
+
+class TestModelRegistry:
+    def get_registry(self, **kwargs):
+        self.loaded = []
+
+        def _loader(name, device=None):
+            self.loaded.append(name)
+            return MusicGen.get_pretrained('debug', device='cpu')
+        return ModelRegistry(loader=_loader, **kwargs)
+
+    def test_shared_instance(self):
+        registry = self.get_registry()
+        mg = registry.get('small')
+        assert registry.get('small') is mg
+        assert self.loaded == ['small']
+        assert 'small' in registry
+        assert registry.memory_usage == get_model_memory(mg)
+
+    def test_model_memory_conditioners(self):
+        mg = MusicGen.get_pretrained('debug', device='cpu')
+        size = get_model_memory(mg)
+        # models hidden from the parameters of their conditioner, like T5, are counted too.
+        hidden = torch.nn.Linear(16, 16)
+        conditioner = mg.lm.condition_provider.conditioners['description']
+        conditioner.__dict__['t5'] = hidden
+        assert not any(param is hidden.weight for param in mg.lm.parameters())
+        assert get_model_memory(mg) == size + (16 * 16 + 16) * 4
+
+    def test_lru_eviction(self):
+        size = get_model_memory(MusicGen.get_pretrained('debug', device='cpu'))
+        registry = self.get_registry(memory_budget=2 * size)
+        registry.get('small')
+        registry.get('medium')
+        registry.get('small')
+        registry.get('large')
+        assert registry.loaded_models == ['small', 'large']
+        registry.get('medium')
+        assert registry.loaded_models == ['large', 'medium']
+        assert self.loaded == ['small', 'medium', 'large', 'medium']
+
+    def test_keeps_model_above_budget(self):
+        registry = self.get_registry(memory_budget=1)
+        mg = registry.get('small')
+        assert registry.loaded_models == ['small']
+        assert registry.get('small') is mg
+        registry.get('large')
+        assert registry.loaded_models == ['large']
@@ -78,6 +78,17 @@ class TestDelayedPatternProvider:
         assert pattern.max_delay == max(delay)
         assert len(pattern.valid_layout) == len(pattern.layout) - pattern.max_delay
 
+    @pytest.mark.parametrize("timesteps", [0, 1, 16])
+    @pytest.mark.parametrize("delay", [[0, 1, 2, 3], [0, 3, 3, 3], [0, 0]])
+    @pytest.mark.parametrize("flatten_first,empty_initial", [(0, 0), (2, 1), (20, 0)])
+    def test_pattern_coords(self, timesteps: int, delay: list, flatten_first: int, empty_initial: int):
+        provider = DelayedPatternProvider(len(delay), delay, flatten_first, empty_initial)
+        pattern = provider.get_pattern(timesteps)
+        # the closed form coordinates match the ones of the layout.
+        layout_pattern = Pattern(pattern.layout, timesteps=timesteps, n_q=len(delay))
+        for coords, layout_coords in zip(pattern._build_coords(), layout_pattern._build_coords()):
+            assert (coords == layout_coords).all()
+
 
 class TestUnrolledPatternProvider:
 
@@ -221,6 +232,8 @@ class TestPattern:
             out, indexes, mask = pattern.revert_pattern_sequence(s, special_token)
             assert out.shape == ref_out.shape
             assert (out == ref_out).float().mean() == 1.0
+            partial, _, _ = pattern.revert_pattern_sequence(s, special_token, timesteps=slice(3, 11))
+            assert torch.equal(partial, out[..., 3:11])
 
     @pytest.mark.parametrize("n_q", [1, 4, 32])
     @pytest.mark.parametrize("timesteps", [16, 72])
@@ -244,3 +257,27 @@ class TestPattern:
             out, indexes, mask = pattern.revert_pattern_logits(logits, logits_special_token)
             assert out.shape == ref_out.shape
             assert (out == ref_out).float().mean() == 1.0
+
+    @pytest.mark.parametrize("n_q", [1, 4])
+    @pytest.mark.parametrize("timesteps", [16, 72])
+    def test_get_first_step_with_timesteps(self, n_q: int, timesteps: int):
+        for pattern_provider in self._get_pattern_providers(n_q):
+            pattern = pattern_provider.get_pattern(timesteps)
+            for t in range(timesteps + 1):
+                for q in [None] + list(range(n_q + 1)):
+                    steps = pattern.get_steps_with_timestep(t, q)
+                    assert pattern.get_first_step_with_timesteps(t, q) == (steps[0] if steps else None)
+
+    @pytest.mark.parametrize("n_q", [1, 4, 32])
+    @pytest.mark.parametrize("timesteps", [16, 72])
+    def test_get_num_complete_timesteps(self, n_q: int, timesteps: int):
+        for pattern_provider in self._get_pattern_providers(n_q):
+            pattern = pattern_provider.get_pattern(timesteps)
+            for step in range(len(pattern.layout)):
+                filled = pattern.layout[:step + 1]
+                ref = 0
+                while ref < timesteps and sum(
+                        coords.t == ref for coords_list in filled for coords in coords_list) == n_q:
+                    ref += 1
+                assert pattern.get_num_complete_timesteps(step) == ref
+            assert pattern.get_num_complete_timesteps(len(pattern.layout) - 1) == timesteps
@@ -7,6 +7,7 @@
 from itertools import product
 import math
 import random
+import typing as tp
 
 import pytest
 import torch
@@ -22,6 +23,24 @@ from audiocraft.modules import (
 )
 
 
+def _stream(module, x: torch.Tensor, chunk_sizes) -> torch.Tensor:
+    outputs = []
+    with module.streaming():
+        offset = 0
+        for chunk_size in chunk_sizes:
+            outputs.append(module(x[..., offset:offset + chunk_size]))
+            offset += chunk_size
+        outputs.append(module.flush())
+    return torch.cat(outputs, dim=-1)
+
+
+def _random_chunk_sizes(length: int, max_size: int = 7):
+    chunk_sizes: tp.List[int] = []
+    while sum(chunk_sizes) < length:
+        chunk_sizes.append(random.randint(0, max_size))
+    return chunk_sizes
+
+
 def test_get_extra_padding_for_conv1d():
     # TODO: Implement me!
     pass
@@ -172,6 +191,19 @@ class TestStreamableConv1d:
             print(list(out.shape), [N, C_out, expected_out_length])
             assert list(out.shape) == [N, C_out, expected_out_length]
 
+    @pytest.mark.parametrize('pad_mode', ['reflect', 'constant', 'replicate'])
+    def test_streaming(self, pad_mode):
+        random.seed(1234)
+        conv_params = [(4, 1, 1), (4, 2, 1), (3, 1, 3), (10, 5, 1), (7, 1, 1), (16, 8, 1)]
+        for causal, (kernel_size, stride, dilation) in product([False, True], conv_params):
+            sconv = StreamableConv1d(2, 3, kernel_size=kernel_size, stride=stride, dilation=dilation,
+                                     causal=causal, pad_mode=pad_mode)
+            # short inputs are padded differently, they should also match.
+            for T in [1, 3, 10, 101]:
+                x = torch.randn(2, 2, T)
+                out = _stream(sconv, x, _random_chunk_sizes(T))
+                assert torch.allclose(out, sconv(x), atol=1e-6)
+
 
 class TestStreamableConvTranspose1d:
 
@@ -201,3 +233,15 @@ class TestStreamableConvTranspose1d:
             out = sconvtr(t0)
             assert isinstance(out, torch.Tensor)
             assert list(out.shape) == [N, C_out, expected_out_length]
+
+    def test_streaming(self):
+        random.seed(1234)
+        causal_params = [(False, 1.0), (True, 1.0), (True, 0.5), (True, 0.0)]
+        conv_params = [(4, 1), (4, 2), (3, 1), (10, 5)]
+        for ((causal, trim_right_ratio), (kernel_size, stride)) in product(causal_params, conv_params):
+            sconvtr = StreamableConvTranspose1d(2, 3, kernel_size=kernel_size, stride=stride,
+                                                causal=causal, trim_right_ratio=trim_right_ratio)
+            for T in [1, 20]:
+                x = torch.randn(2, 2, T)
+                out = _stream(sconvtr, x, _random_chunk_sizes(T, max_size=3))
+                assert torch.allclose(out, sconvtr(x), atol=1e-6)
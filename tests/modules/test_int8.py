@@ -0,0 +1,49 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+
+import torch
+from torch import nn
+
+from audiocraft.modules.int8 import Int8Linear, quantize_linears_
+
+
+class TestInt8Linear:
+
+    def test_same_as_linear(self):
+        torch.manual_seed(1234)
+        linear = nn.Linear(32, 24)
+        quantized = Int8Linear.from_float(linear.weight, linear.bias)
+        assert quantized.weight.dtype == torch.int8
+        assert (quantized.dequantize() - linear.weight).abs().max() <= quantized.scale.max() / 2 + 1e-6
+        x = torch.randn(3, 5, 32)
+        with torch.no_grad():
+            y = linear(x)
+        y_quantized = quantized(x)
+        assert y_quantized.shape == y.shape
+        assert (y_quantized - y).norm() / y.norm() < 0.02
+
+    def test_state_dict(self):
+        torch.manual_seed(1234)
+        quantized = Int8Linear.from_float(torch.randn(8, 16), torch.randn(8))
+        x = torch.randn(2, 16)
+        y = quantized(x)
+        buffer = io.BytesIO()
+        torch.save(quantized.state_dict(), buffer)
+        buffer.seek(0)
+        loaded = Int8Linear(16, 8)
+        loaded(x)
+        # the weights packed for the previous values should not be used anymore.
+        loaded.load_state_dict(torch.load(buffer, weights_only=True))
+        assert torch.equal(loaded(x), y)
+
+    def test_quantize_linears(self):
+        model = nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Sequential(nn.Linear(8, 2, bias=False)))
+        quantize_linears_(model)
+        assert isinstance(model[0], Int8Linear) and isinstance(model[2][0], Int8Linear)
+        assert model[2][0].bias is None
+        assert model(torch.randn(3, 4)).shape == (3, 2)
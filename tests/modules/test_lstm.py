@@ -30,3 +30,16 @@ class TestStreamableLSTM:
         y = lstm(x)
 
         assert y.shape == torch.Size([B, C, T])
+
+    def test_lstm_streaming(self):
+        B, C, T = 4, 2, random.randint(1, 100)
+
+        lstm = StreamableLSTM(C, 3, skip=True)
+        x = torch.randn(B, C, T)
+        with lstm.streaming():
+            y = torch.cat([lstm(chunk) for chunk in x.split(7, dim=-1)], dim=-1)
+            # flushing starts over from a new hidden state.
+            lstm.flush()
+            y_first = lstm(x[..., :1])
+        assert torch.allclose(y, lstm(x), atol=1e-6)
+        assert torch.allclose(y_first, lstm(x[..., :1]), atol=1e-6)
@@ -55,6 +55,31 @@ class TestSEANetModel:
         y = decoder(z)
         assert y.shape == x.shape, (x.shape, y.shape)
 
+    @pytest.mark.parametrize('causal', [False, True])
+    def test_streaming(self, causal):
+        encoder = SEANetEncoder(n_filters=4, dimension=8, ratios=[4, 2], lstm=2, true_skip=False, causal=causal)
+        decoder = SEANetDecoder(n_filters=4, dimension=8, ratios=[4, 2], lstm=2, causal=causal)
+        x = torch.randn(2, 1, 800)
+        with encoder.streaming():
+            z = torch.cat([encoder(chunk) for chunk in x.split(37, dim=-1)] + [encoder.flush()], dim=-1)
+        assert torch.allclose(z, encoder(x), atol=1e-5)
+        with decoder.streaming():
+            y = torch.cat([decoder(frame) for frame in z.split(1, dim=-1)] + [decoder.flush()], dim=-1)
+        assert torch.allclose(y, decoder(z), atol=1e-5)
+
+    @pytest.mark.parametrize('causal', [False, True])
+    def test_encoder_lengths(self, causal):
+        encoder = SEANetEncoder(n_filters=4, dimension=8, ratios=[4, 2], lstm=2, true_skip=False,
+                                causal=causal, pad_mode='constant')
+        lengths = [800, 333, 8, 1]
+        x = torch.zeros(len(lengths), 1, max(lengths))
+        for item, length in zip(x, lengths):
+            item[..., :length] = torch.randn(1, length)
+        z = encoder(x, torch.tensor(lengths))
+        for item, length, item_z in zip(x, lengths, z):
+            ref = encoder(item[None, :, :length])[0]
+            assert torch.allclose(item_z[..., :ref.shape[-1]], ref, atol=1e-5)
+
     def _check_encoder_blocks_norm(self, encoder: SEANetEncoder, n_disable_blocks: int, norm: str):
         n_blocks = 0
         for layer in encoder.model:
@@ -77,7 +77,8 @@ def test_streaming_api():
     with torch.no_grad():
         with tr.streaming():
             _ = tr(x[:, :1])
-            state = {k: v.clone() for k, v in tr.get_streaming_state().items()}
+            state = {k: v.clone() if isinstance(v, torch.Tensor) else v
+                     for k, v in tr.get_streaming_state().items()}
             y = tr(x[:, 1:2])
             tr.set_streaming_state(state)
             y2 = tr(x[:, 1:2])
@@ -85,6 +86,134 @@ def test_streaming_api():
             assert tr.flush() is None
 
 
+def test_causal_mask():
+    attn = StreamingMultiheadAttention(16, 4, causal=True, past_context=4, custom=True)
+    mask = attn._get_mask(3, torch.device('cpu'), torch.float32)
+    assert mask is not None
+    assert attn._get_mask(3, torch.device('cpu'), torch.float32) is mask
+    x = torch.randn(1, 3, 16)
+    with torch.no_grad(), attn.streaming():
+        attn(x, x, x)
+        assert isinstance(attn._streaming_state['offset'], int)
+        # decoding steps only need a mask once the past context is exceeded.
+        assert attn._get_mask(1, torch.device('cpu'), torch.float32) is None
+        attn(x, x, x)
+        # the keys beyond the past context are dropped, so a single query still attends to all of them.
+        assert attn._get_mask(1, torch.device('cpu'), torch.float32) is None
+        mask = attn._get_mask(3, torch.device('cpu'), torch.float32)
+        assert mask is not None
+        assert (mask[0] == 0).sum() == 5
+
+
+def test_static_kv_cache():
+    torch.manual_seed(1234)
+    for context, kv_repeat in product([None, 6], [1, 2]):
+        tr = StreamingTransformer(16, 4, 2, causal=True, past_context=context, custom=True,
+                                  cross_attention=True, kv_repeat=kv_repeat, dropout=0.)
+        tr.eval()
+        steps = 12
+        x = torch.randn(3, steps, 16)
+        cross_x = torch.randn(3, 5, 16)
+        with torch.no_grad():
+            y = tr(x, cross_attention_src=cross_x)
+            ys = []
+            with tr.streaming(), tr.static_kv_cache(steps):
+                ys.append(tr(x[:, :4], cross_attention_src=cross_x))
+                state = {k: v.clone() if isinstance(v, torch.Tensor) else v
+                         for k, v in tr.get_streaming_state().items()}
+                for k in range(4, steps):
+                    ys.append(tr(x[:, k:k + 1], cross_attention_src=cross_x))
+                # restoring a state still works, even though keys are written in place.
+                tr.set_streaming_state(state)
+                y2 = tr(x[:, 4:5], cross_attention_src=cross_x)
+                with pytest.raises(RuntimeError):
+                    tr(x, cross_attention_src=cross_x)
+        y_stream = torch.cat(ys, dim=1)
+        assert torch.allclose(y_stream, y, atol=1e-6), (y_stream - y).norm()
+        assert torch.allclose(y2, ys[1], atol=1e-6)
+        assert all(layer.self_attn.kv_cache_capacity is None for layer in tr.layers)
+
+
+def test_cross_attention_kv_cache():
+    torch.manual_seed(1234)
+    tr = StreamingTransformer(16, 4, 2, causal=True, custom=True, cross_attention=True, dropout=0.)
+    tr.eval()
+    x = torch.randn(3, 6, 16)
+    cross_x = torch.randn(3, 5, 16)
+    with torch.no_grad():
+        y = tr(x, cross_attention_src=cross_x)
+        ys = []
+        with tr.streaming():
+            ys.append(tr(x[:, :2], cross_attention_src=cross_x))
+            keys = [layer.cross_attention._streaming_state['cross_keys'] for layer in tr.layers]
+            for k in range(2, 6):
+                ys.append(tr(x[:, k:k + 1], cross_attention_src=cross_x))
+            # the keys are projected once and then reused.
+            assert all(layer.cross_attention._streaming_state['cross_keys'] is key
+                       for layer, key in zip(tr.layers, keys))
+        assert all('cross_keys' not in layer.cross_attention._streaming_state for layer in tr.layers)
+    y_stream = torch.cat(ys, dim=1)
+    assert torch.allclose(y_stream, y, atol=1e-6), (y_stream - y).norm()
+
+
+def test_quantize():
+    torch.manual_seed(1234)
+    tr = StreamingTransformer(16, 4, 2, causal=True, custom=True, cross_attention=True, dropout=0.)
+    tr.eval()
+    x = torch.randn(3, 6, 16)
+    cross_x = torch.randn(3, 5, 16)
+    with torch.no_grad():
+        y = tr(x, cross_attention_src=cross_x)
+        tr.quantize_()
+        assert not any(isinstance(module, torch.nn.Linear) for module in tr.modules())
+        y_quantized = tr(x, cross_attention_src=cross_x)
+        with tr.streaming():
+            y_stream = torch.cat([tr(x[:, k:k + 1], cross_attention_src=cross_x) for k in range(6)], dim=1)
+    # the activations are quantized with the range of each call, so streaming only matches approximately.
+    for output in [y_quantized, y_stream]:
+        assert (output - y).norm() / y.norm() < 0.05, (output - y).norm()
+
+
+def test_sliding_window():
+    torch.manual_seed(1234)
+    tr = StreamingTransformer(16, 4, 2, causal=True, custom=True, dropout=0.)
+    tr.eval()
+    x = torch.randn(3, 40, 16)
+    with torch.no_grad(), tr.sliding_window(5):
+        y = tr(x)
+        for chunks in [[1] * 40, [3, 1, 1, 7, 1, 1, 1, 10, 1, 1, 13]]:
+            ys = []
+            offset = 0
+            with tr.streaming():
+                for chunk in chunks:
+                    ys.append(tr(x[:, offset:offset + chunk]))
+                    offset += chunk
+                # the ring buffers never grow past the context.
+                assert all(layer._streaming_state['ring_keys'].numel() == 3 * 6 * 16
+                           for _, layer in tr._self_attention_layers())
+            y_stream = torch.cat(ys, dim=1)
+            assert torch.allclose(y_stream, y, atol=1e-6), (y_stream - y).norm()
+    assert all(layer.past_context is None for _, layer in tr._self_attention_layers())
+    with torch.no_grad():
+        assert not torch.allclose(tr(x), y)
+
+
+def test_rollback():
+    torch.manual_seed(1234)
+    for capacity in [None, 8]:
+        tr = StreamingTransformer(16, 4, 2, causal=True, custom=True, dropout=0.)
+        tr.eval()
+        x = torch.randn(3, 8, 16)
+        other = torch.randn(3, 2, 16)
+        with torch.no_grad():
+            y = tr(torch.cat([x[:, :4], other, x[:, 6:]], dim=1))
+            with tr.streaming(), tr.static_kv_cache(capacity):
+                tr(x[:, :6])
+                tr.rollback(2)
+                y_stream = tr(torch.cat([other, x[:, 6:]], dim=1))
+        assert torch.allclose(y_stream, y[:, 4:], atol=1e-6), (y_stream - y[:, 4:]).norm()
+
+
 def test_memory_efficient():
     for backend in ['torch', 'xformers']:
         torch.manual_seed(1234)
@@ -0,0 +1,64 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+from audiocraft.utils.cache import ContentStore
+from ..common_utils import TempDirMixin
+
+
+class TestContentStore(TempDirMixin):
+
+    def _write(self, content: bytes):
+        def _write(path):
+            path.write_bytes(content)
+        return _write
+
+    def test_key(self):
+        assert ContentStore.key(text='a', seed=1) == ContentStore.key(seed=1, text='a')
+        assert ContentStore.key(text='a', seed=1) != ContentStore.key(text='a', seed=2)
+
+    def test_put_get(self):
+        store = ContentStore(self.get_temp_dir('put_get'), suffix='.wav')
+        key = ContentStore.key(text='a')
+        assert store.get(key) is None
+        path = store.put(key, self._write(b'1234'))
+        assert path.name == key + '.wav'
+        assert store.get(key) == path
+        assert path.read_bytes() == b'1234'
+        assert store.size == 4
+        assert [p.name for p in path.parent.iterdir()] == [path.name]
+
+    def test_failed_write(self):
+        store = ContentStore(self.get_temp_dir('failed_write'))
+
+        def _write(path):
+            path.write_bytes(b'12')
+            raise RuntimeError('oops')
+        with pytest.raises(RuntimeError):
+            store.put('a', _write)
+        assert 'a' not in store
+        assert list(store.root.iterdir()) == []
+
+    def test_eviction(self):
+        store = ContentStore(self.get_temp_dir('eviction'), max_size=10)
+        store.put('a', self._write(b'1234'))
+        store.put('b', self._write(b'1234'))
+        store.get('a')
+        store.put('c', self._write(b'1234'))
+        assert 'b' not in store and not store.path('b').exists()
+        assert 'a' in store and 'c' in store
+        # a single entry larger than the budget is kept.
+        store.put('d', self._write(b'0' * 20))
+        assert len(store) == 1 and 'd' in store
+
+    def test_reload(self):
+        root = self.get_temp_dir('reload')
+        store = ContentStore(root, suffix='.wav')
+        store.put('a', self._write(b'1234'))
+        store = ContentStore(root, suffix='.wav')
+        assert store.get('a') is not None
+        assert store.size == 4
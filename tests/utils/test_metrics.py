@@ -0,0 +1,56 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+from audiocraft.utils.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry:
+
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('lookups', "Lookups.", ['result'])
+        counter.inc(result='hit')
+        counter.inc(2, result='hit')
+        counter.inc(result='miss')
+        assert registry.counter('lookups', "Lookups.", ['result']) is counter
+        assert counter.get(result='hit') == 3
+        with pytest.raises(ValueError):
+            counter.inc()
+        with pytest.raises(ValueError):
+            registry.gauge('lookups', "Lookups.")
+        assert registry.render() == (
+            '# HELP lookups Lookups.\n'
+            '# TYPE lookups counter\n'
+            'lookups_total{result="hit"} 3\n'
+            'lookups_total{result="miss"} 1\n')
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        registry.gauge('depth', "Depth.").set(4)
+        values = iter(range(10))
+        registry.gauge('calls', "Calls.", function=lambda: next(values))
+        lines = registry.render().splitlines()
+        assert 'depth 4' in lines and 'calls 0' in lines
+        assert 'calls 1' in registry.render().splitlines()
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency', "Latency.", ['stage'], buckets=[0.1, 1.])
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.1, stage='a')
+        histogram.observe(5, stage='a')
+        with histogram.time(stage='b'):
+            pass
+        assert histogram.get_count(stage='a') == 3
+        assert histogram.get_sum(stage='a') == pytest.approx(5.15)
+        lines = registry.render().splitlines()
+        assert 'latency_bucket{stage="a",le="0.1"} 2' in lines
+        assert 'latency_bucket{stage="a",le="1"} 2' in lines
+        assert 'latency_bucket{stage="a",le="+Inf"} 3' in lines
+        assert 'latency_count{stage="a"} 3' in lines
+        assert 'latency_count{stage="b"} 1' in lines
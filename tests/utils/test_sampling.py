@@ -0,0 +1,128 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from audiocraft.utils import utils
+from audiocraft.utils.sampling import (
+    apply_repetition_penalty, get_sampling_probs, sample_from_probs, sample_next_token, speculative_sample)
+
+
+def _histogram(tokens: torch.Tensor, card: int) -> torch.Tensor:
+    return torch.bincount(tokens.flatten(), minlength=card).float() / tokens.numel()
+
+
+class TestSampleNextToken:
+    card = 16
+    num_samples = 20000
+
+    def get_logits(self):
+        torch.manual_seed(1234)
+        logits = torch.randn(self.card) * 2
+        return logits.expand(self.num_samples, self.card)
+
+    def reference(self, logits, temp=1.0, top_k=0, top_p=0.0):
+        probs = torch.softmax(logits / temp, dim=-1)
+        if top_p > 0:
+            return utils.sample_top_p(probs, p=top_p)
+        elif top_k > 0:
+            return utils.sample_top_k(probs, k=top_k)
+        return utils.multinomial(probs, num_samples=1)
+
+    @pytest.mark.parametrize('gumbel', [True, False])
+    @pytest.mark.parametrize('params', [
+        {}, {'temp': 0.7}, {'top_k': 4}, {'top_k': 4, 'temp': 1.5},
+        {'top_p': 0.8}, {'top_p': 0.8, 'top_p_candidates': 4}, {'top_p': 0.3, 'top_p_candidates': 8},
+    ])
+    def test_same_distribution(self, params, gumbel):
+        logits = self.get_logits()
+        ref_params = {key: value for key, value in params.items() if key != 'top_p_candidates'}
+        expected = _histogram(self.reference(logits, **ref_params), self.card)
+        tokens = sample_next_token(logits, gumbel=gumbel, **params)
+        assert tokens.shape == (self.num_samples, 1)
+        actual = _histogram(tokens, self.card)
+        assert ((expected > 0) == (actual > 0)).all()
+        assert (expected - actual).abs().max() < 0.02, (expected, actual)
+
+    def test_top_k_top_p(self):
+        logits = self.get_logits()
+        probs = torch.softmax(logits[0], dim=-1)
+        top_probs, top_indices = probs.topk(4)
+        top_probs = top_probs / top_probs.sum()
+        # top-p is computed among the top-k candidates.
+        num_kept = int(((top_probs.cumsum(0) - top_probs) <= 0.5).sum())
+        tokens = sample_next_token(logits, top_k=4, top_p=0.5)
+        assert set(tokens.unique().tolist()) == set(top_indices[:num_kept].tolist())
+
+    def test_min_p(self):
+        logits = self.get_logits()
+        probs = torch.softmax(logits[0], dim=-1)
+        tokens = sample_next_token(logits, min_p=0.2)
+        allowed = (probs >= 0.2 * probs.max()).nonzero().flatten()
+        assert set(tokens.unique().tolist()) == set(allowed.tolist())
+
+    def test_repetition_penalty(self):
+        logits = torch.tensor([[2., -2., 2., -2.]])
+        seen = torch.tensor([[True, True, False, False]])
+        penalized = apply_repetition_penalty(logits, seen, 2.)
+        assert penalized.tolist() == [[1., -4., 2., -2.]]
+        logits = torch.tensor([[3., 1., -10.]]).expand(100, -1)
+        seen = torch.tensor([[True, False, False]]).expand(100, -1)
+        tokens = sample_next_token(logits, temp=0.01, repetition_penalty=10., seen=seen)
+        assert (tokens == 1).all()
+
+    def test_per_row(self):
+        logits = self.get_logits()
+        rows = [{'temp': 0.7}, {'top_k': 4, 'temp': 1.5}, {'top_p': 0.8}, {'top_k': 4, 'top_p': 0.5}]
+        per_row = {name: torch.tensor([float(row.get(name, default)) for row in rows])
+                   for name, default in [('temp', 1.), ('top_k', 0), ('top_p', 0.)]}
+        per_row['top_k'] = per_row['top_k'].long()
+        batched = logits.reshape(len(rows), -1, self.card)
+        tokens = sample_next_token(batched, **per_row)
+        probs = get_sampling_probs(batched[:, :1], **per_row)
+        assert tokens.shape == (len(rows), self.num_samples // len(rows), 1)
+        for row, row_tokens, row_probs in zip(rows, tokens, probs):
+            expected = get_sampling_probs(logits[:1], **row)[0]
+            assert torch.allclose(row_probs[0], expected, atol=1e-6)
+            actual = _histogram(row_tokens, self.card)
+            assert ((expected > 0) == (actual > 0)).all()
+            assert (expected - actual).abs().max() < 0.03
+        # rows with a temperature of 0 use greedy decoding.
+        greedy = sample_next_token(batched, temp=torch.tensor([0., 1., 0., 1.]))
+        assert (greedy[[0, 2]] == logits[0].argmax()).all()
+        assert not (greedy[[1, 3]] == logits[0].argmax()).all()
+
+    @pytest.mark.parametrize('params', [{}, {'top_k': 4}, {'top_p': 0.7}, {'min_p': 0.1, 'temp': 0.8}])
+    def test_sampling_probs(self, params):
+        logits = self.get_logits()
+        probs = get_sampling_probs(logits[:1], **params)[0]
+        actual = _histogram(sample_next_token(logits, **params), self.card)
+        assert ((probs > 0) == (actual > 0)).all()
+        assert (probs - actual).abs().max() < 0.02
+        greedy = get_sampling_probs(logits[:1], use_sampling=False)[0]
+        assert greedy.argmax() == logits[0].argmax() and greedy.sum() == 1
+
+
+class TestSpeculativeSample:
+
+    def test_target_distribution(self):
+        torch.manual_seed(1234)
+        card, num_samples = 8, 50000
+        target = torch.softmax(torch.randn(card) * 2, dim=-1).expand(num_samples, card)
+        draft = torch.softmax(torch.randn(card) * 2, dim=-1).expand(num_samples, card)
+        draft_tokens = sample_from_probs(draft)
+        tokens, accepted = speculative_sample(target, draft, draft_tokens)
+        assert tokens.shape == accepted.shape == (num_samples, 1)
+        assert (tokens[accepted] == draft_tokens[accepted]).all()
+        assert (_histogram(tokens, card) - target[0]).abs().max() < 0.01
+        expected_acceptance = torch.minimum(target[0], draft[0]).sum()
+        assert abs(accepted.float().mean() - expected_acceptance) < 0.01
+
+    def test_same_distribution(self):
+        probs = torch.softmax(torch.randn(100, 8), dim=-1)
+        _, accepted = speculative_sample(probs, probs, sample_from_probs(probs))
+        assert accepted.all()